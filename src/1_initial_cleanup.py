@@ -14,10 +14,14 @@ logger.info('import ok')
 # configuration
 input_path = '/Volumes/Boeynaems-Lab/Pilar/In vivo/CLN3 - C9 project/CLN3 brain tissue/Full KO/6 mo cohort/mTOR-Iba-Lamp/Thalamus/Combined/'
 output_folder = 'results/initial_cleanup/'
+stack_folder = 'results/initial_cleanup_zstacks/'  # full CZYX stacks for 3D puncta detection
+SAVE_ZSTACKS = False  # also keep full z-stacks next to the MIPs
+timeseries_folder = 'results/initial_cleanup_timeseries/'  # full TYX/CTYX time-series for time-lapse puncta tracking
+SAVE_TIMESERIES = False  # also keep full time-series next to the MIPs
 image_extensions = ['.czi', '.tif', '.tiff', '.lif']
 
 
-def image_converter(image_path, output_folder, tiff=False, MIP=False, array=True):
+def image_converter(image_path, output_folder, tiff=False, MIP=False, array=True, stack_folder=None, timeseries_folder=None, save=True):
     """Stack images from nested .czi files and save for subsequent processing
 
     Args:
@@ -26,8 +30,14 @@ def image_converter(image_path, output_folder, tiff=False, MIP=False, array=True
         tiff (bool, optional): Save tiff. Defaults to False.
         MIP (bool, optional): Save np array as maximum projected image along third to last axis. Defaults to False.
         array (bool, optional): Save np array. Defaults to True.
+        stack_folder (str, optional): Also save the full CZYX array of z-stacks here when MIP is True. Defaults to None.
+        timeseries_folder (str, optional): Also save the full TYX/CTYX array of time-series here when MIP is True. Defaults to None.
+        save (bool, optional): Write the MIP or array to output_folder, False to only return it. Defaults to True.
+
+    Returns:
+        tuple: (name, image) of the MIP or array as it would be saved, name without '.npy'; None if the file is missing.
     """
-    if not os.path.exists(output_folder):
+    if save and not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
     # check if image exists
@@ -56,7 +66,7 @@ def image_converter(image_path, output_folder, tiff=False, MIP=False, array=True
         image = bio_image.get_image_data("CZYX", B=0, V=0, T=0)
 
     # import multichannel single z-slice
-    if (image_shape['T'][0] == 1) & (image_shape['C'][0] > 1):
+    if (image_shape['T'][0] == 1) & (image_shape['C'][0] > 1) & (image_shape['Z'][0] == 1):
         image = bio_image.get_image_data("CYX", B=0, Z=0, V=0, T=0)
 
     # make more human readable name
@@ -70,17 +80,34 @@ def image_converter(image_path, output_folder, tiff=False, MIP=False, array=True
     if MIP == True:
         # save image as maximum intensity projection (MIP) numpy array 
         mip_image = np.max(image, axis=-3) # assuming axis for projection is third from last
-        np.save(f'{output_folder}{short_name}_mip.npy', mip_image)
+        if save:
+            np.save(f'{output_folder}{short_name}_mip.npy', mip_image)
+        if stack_folder is not None and image_shape['Z'][0] > 1:
+            # keep the full stack for 3D puncta detection
+            os.makedirs(stack_folder, exist_ok=True)
+            np.save(f'{stack_folder}{short_name}.npy', image)
+        if timeseries_folder is not None and image_shape['T'][0] > 1:
+            # keep every frame for time-lapse puncta tracking
+            os.makedirs(timeseries_folder, exist_ok=True)
+            np.save(f'{timeseries_folder}{short_name}.npy', image)
         array = False  # do not save original image as array if MIP is True
+        return f'{short_name}_mip', mip_image
 
-    if array == True:
+    if array == True and save:
         # save image as numpy array
         np.save(f'{output_folder}{short_name}.npy', image)
+    return short_name, image
 
 
-if __name__ == '__main__':
-    
-    # --------------- initalize file_list ---------------
+def find_images(input_path):
+    """Collect the unique image files under input_path that require analysis.
+
+    Args:
+        input_path (str): folder containing raw images, searched recursively unless it is 'raw_data/'
+
+    Returns:
+        list: image file paths
+    """
     if input_path == 'raw_data/':
         flat_file_list = [input_path + filename for filename in os.listdir(input_path) if any(sub in filename for sub in image_extensions)]
 
@@ -104,12 +131,20 @@ if __name__ == '__main__':
     image_names = [filename for filename in flat_file_list if not any(word in filename for word in do_not_quantitate)]
 
     # remove duplicates
-    image_names = list(dict.fromkeys(image_names))
+    return list(dict.fromkeys(image_names))
+
+
+if __name__ == '__main__':
+    
+    # --------------- initalize file_list ---------------
+    image_names = find_images(input_path)
 
     # --------------- collect image names and convert ---------------
     # collect and convert images to np arrays
     # make sure to change short_name to keep all relevant info
     for name in image_names:
-        image_converter(name, output_folder=f'{output_folder}', tiff=False, MIP=True)
+        image_converter(name, output_folder=f'{output_folder}', tiff=False, MIP=True,
+                        stack_folder=stack_folder if SAVE_ZSTACKS else None,
+                        timeseries_folder=timeseries_folder if SAVE_TIMESERIES else None)
 
     logger.info('initial cleanup complete :-)')
@@ -0,0 +1,121 @@
+"""
+Flat-field and background correction between initial cleanup and cellpose.
+
+Approximates a rolling-ball background with a grey opening on a block-mean downsampled copy
+of each channel, smoothed and interpolated back to full resolution, and subtracts it (top-hat).
+Only separable filters on the downsampled image are used, so each 2k x 2k channel takes well
+under a second. Corrected images are cached and only recomputed when their input changes.
+"""
+
+import os
+import json
+import numpy as np
+from scipy import ndimage
+from loguru import logger
+
+logger.info('import ok')
+
+# configuration
+image_folder = 'results/initial_cleanup/'
+output_folder = 'results/background_correction/'
+BALL_RADIUS = 50  # radius in pixels of the rolling ball, larger than the largest puncta
+DOWNSAMPLE = 8  # block size for background estimation
+SMOOTH_SIGMA = 1.0  # gaussian smoothing of the background, in downsampled pixels
+CHANNELS = None  # channels to correct, None corrects every channel
+
+
+def estimate_background(channel, radius=BALL_RADIUS, downsample=DOWNSAMPLE, sigma=SMOOTH_SIGMA):
+    """Estimate the smooth background of one channel at full resolution.
+
+    Args:
+        channel (np.array): 2D intensities.
+        radius (int, optional): rolling-ball radius in pixels. Defaults to BALL_RADIUS.
+        downsample (int, optional): block size for the block-mean downsampling. Defaults to DOWNSAMPLE.
+        sigma (float, optional): gaussian smoothing in downsampled pixels. Defaults to SMOOTH_SIGMA.
+
+    Returns:
+        np.array: float32 background with the shape of channel.
+    """
+    height, width = channel.shape
+    pad_h, pad_w = -height % downsample, -width % downsample
+    padded = np.pad(channel, ((0, pad_h), (0, pad_w)), mode='edge')
+
+    # block mean averages out pixel noise, so the opening below is not pulled down by it
+    small = padded.reshape(padded.shape[0] // downsample, downsample,
+                           padded.shape[1] // downsample, downsample).mean(axis=(1, 3), dtype=np.float32)
+
+    # flat square opening removes puncta and cells narrower than the ball, min and max filters are separable
+    size = max(2 * (radius // downsample) + 1, 3)
+    background = ndimage.grey_opening(small, size=(size, size), mode='nearest')
+    if sigma:
+        background = ndimage.gaussian_filter(background, sigma, mode='nearest')
+
+    background = ndimage.zoom(background, downsample, order=1, mode='nearest', grid_mode=True)
+    return background[:height, :width]
+
+
+def correct_image(image, channels=CHANNELS, **kwargs):
+    """Subtract the estimated background from each channel, keeping the input dtype.
+
+    Args:
+        image (np.array): image with shape (channels, height, width).
+        channels (list, optional): channels to correct, None for all. Defaults to CHANNELS.
+        **kwargs: passed to estimate_background.
+
+    Returns:
+        np.array: corrected image.
+    """
+    corrected = np.array(image, copy=True)
+    for ch in (range(image.shape[0]) if channels is None else channels):
+        channel = np.asarray(image[ch], dtype=np.float32)
+        flat = channel - estimate_background(channel, **kwargs)
+        if np.issubdtype(image.dtype, np.integer):
+            flat = np.rint(np.clip(flat, 0, np.iinfo(image.dtype).max))
+        else:
+            flat = np.clip(flat, 0, None)
+        corrected[ch] = flat.astype(image.dtype)
+    return corrected
+
+
+def correction_settings():
+    return {'BALL_RADIUS': BALL_RADIUS, 'DOWNSAMPLE': DOWNSAMPLE, 'SMOOTH_SIGMA': SMOOTH_SIGMA, 'CHANNELS': CHANNELS}
+
+
+def prepare_output_folder(output_folder):
+    """Create the output folder and drop cached outputs made with other settings."""
+    os.makedirs(output_folder, exist_ok=True)
+    settings_path = os.path.join(output_folder, 'settings.json')
+    settings = correction_settings()
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) == settings:
+                return
+    for fn in os.listdir(output_folder):
+        if fn.endswith('.npy'):
+            os.remove(os.path.join(output_folder, fn))
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f)
+
+
+def correct_file(fn, image_folder=image_folder, output_folder=output_folder):
+    """Correct one saved image unless its cached output is newer than the input."""
+    in_path, out_path = os.path.join(image_folder, fn), os.path.join(output_folder, fn)
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(in_path):
+        logger.info(f'{fn} already corrected, skipping')
+        return
+    corrected = correct_image(np.load(in_path))
+    tmp_path = out_path.replace('.npy', '.tmp.npy')
+    np.save(tmp_path, corrected)
+    os.replace(tmp_path, out_path)
+    logger.info(f'{fn} corrected')
+
+
+def find_images(image_folder=image_folder):
+    return sorted(fn for fn in os.listdir(image_folder) if fn.endswith('.npy'))
+
+
+if __name__ == '__main__':
+    prepare_output_folder(output_folder)
+    for fn in find_images(image_folder):
+        correct_file(fn, image_folder, output_folder)
+    logger.info('background correction complete')
@@ -3,6 +3,8 @@ Applies cellpose algorithms to determine cellular and nuclear masks
 """
 
 import os
+import sys
+import importlib.util
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
@@ -14,16 +16,171 @@ from loguru import logger
 from cellpose.io import logger_setup
 logger_setup();
 
+# special import, path to script
+dtype_policy_path = 'src/dtype_policy.py'
+
+# load the module dynamically to share the dtype policy between stages
+spec = importlib.util.spec_from_file_location('dtype_policy', dtype_policy_path)
+dtype_policy = importlib.util.module_from_spec(spec)
+sys.modules['dtype_policy'] = dtype_policy
+spec.loader.exec_module(dtype_policy)
+as_labels = dtype_policy.as_labels
+as_intensity = dtype_policy.as_intensity
+
+mask_store_path = 'src/mask_store.py'
+
+# load the module dynamically to write one mask entry per image
+spec = importlib.util.spec_from_file_location('mask_store', mask_store_path)
+mask_store = importlib.util.module_from_spec(spec)
+sys.modules['mask_store'] = mask_store
+spec.loader.exec_module(mask_store)
+
 logger.info('import ok')
 
-image_folder = 'results/initial_cleanup/'
+image_folder = 'results/background_correction/'  # 'results/initial_cleanup/' to segment uncorrected images
+fallback_folder = 'results/initial_cleanup/'  # segmented when stage 1b has not been run
 output_folder = 'results/cellpose_masking/'
+IMAGE_TYPE = 'sam'  # cellpose model
+USE_GPU = True  # False on CPU-only nodes
+TILE_SIZE = None  # e.g. 2048 to segment very large fields memory-mapped, at full resolution in overlapping tiles (also works on CPU-only nodes)
+TILE_OVERLAP = 256  # overlap between tiles in pixels, should exceed the largest cell diameter
+
+if not os.path.exists(image_folder):
+    logger.warning(f'{image_folder} not found, segmenting the uncorrected images in {fallback_folder}')
+    image_folder = fallback_folder
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
 
-def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4, cellprob_threshold=0.0, niter=None, use_gpu=True, big_images=False):
+def find_images(image_folder=image_folder):
+    """Names of the saved images, without the temporary files of writes in progress."""
+    return sorted(fn.removesuffix('.npy') for fn in os.listdir(image_folder)
+                  if fn.endswith('.npy') and not fn.endswith('.tmp.npy'))
+
+
+def tile_starts(length, tile_size, tile_overlap):
+    """Start positions of overlapping tiles covering an axis of the given length."""
+    if length <= tile_size:
+        return [0]
+    step = tile_size - tile_overlap
+    if step <= 0:
+        raise ValueError('tile_overlap must be smaller than tile_size')
+    starts = list(range(0, length - tile_size + 1, step))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def stitch_tile(stitched, tile_labels, y0, x0, cut_edges, next_label, min_overlap=0.5):
+    """Merge the labels of one tile into the stitched label plane, in place.
+
+    Objects touching an interior tile seam are dropped, as the neighbouring tile sees them whole.
+    Objects overlapping a label stitched from an earlier tile by at least min_overlap of their area
+    take that label, all others get a new label.
+
+    Args:
+        stitched (np.array): full-size label plane, updated in place.
+        tile_labels (np.array): labels of the tile, shape (tile height, tile width).
+        y0 (int): row of the tile origin in the stitched plane.
+        x0 (int): column of the tile origin in the stitched plane.
+        cut_edges (tuple): (top, bottom, left, right) flags for tile edges that are interior seams.
+        next_label (int): first unused label in the stitched plane.
+        min_overlap (float, optional): fraction of an object that must overlap an existing label to merge. Defaults to 0.5.
+
+    Returns:
+        int: next unused label after stitching this tile.
+    """
+    tile_labels = np.asarray(tile_labels)
+    n_labels = int(tile_labels.max())
+    if n_labels == 0:
+        return next_label
+
+    height, width = tile_labels.shape
+    region = stitched[y0:y0 + height, x0:x0 + width]
+
+    # objects cut by an interior seam
+    top, bottom, left, right = cut_edges
+    edge_pixels = [edge for flag, edge in zip(
+        (top, bottom, left, right),
+        (tile_labels[0], tile_labels[-1], tile_labels[:, 0], tile_labels[:, -1])) if flag]
+    keep = np.ones(n_labels + 1, dtype=bool)
+    keep[0] = False
+    if edge_pixels:
+        keep[np.concatenate(edge_pixels)] = False
+
+    # match objects to labels stitched from earlier tiles by their largest overlap
+    lut = np.zeros(n_labels + 1, dtype=stitched.dtype)
+    both = (tile_labels > 0) & (region > 0)
+    if both.any():
+        sizes = np.bincount(tile_labels.ravel(), minlength=n_labels + 1)
+        pairs, counts = np.unique(np.stack([tile_labels[both], region[both]]), axis=1, return_counts=True)
+        order = np.lexsort((-counts, pairs[0]))
+        pairs, counts = pairs[:, order], counts[order]
+        first = np.r_[True, pairs[0, 1:] != pairs[0, :-1]]
+        tile_lbl, stitched_lbl, counts = pairs[0, first], pairs[1, first], counts[first]
+        matched = counts / sizes[tile_lbl] >= min_overlap
+        lut[tile_lbl[matched]] = stitched_lbl[matched]
+
+    new = keep & (lut == 0)
+    n_new = int(np.count_nonzero(new))
+    lut[new] = np.arange(next_label, next_label + n_new)
+    lut[~keep] = 0
+
+    # only fill pixels not already claimed by an earlier tile
+    relabelled = lut[tile_labels]
+    write = (region == 0) & (relabelled > 0)
+    region[write] = relabelled[write]
+    return next_label + n_new
+
+
+def segment_tiled(model, image, tile_size=2048, tile_overlap=256, **eval_kwargs):
+    """Run cellpose on overlapping full-resolution tiles of one image and stitch the labels.
+
+    Only one tile is passed to the model at a time, so model memory is bounded by tile_size.
+    The image can be a memory-mapped array (np.load(..., mmap_mode='r')), or one wrapped in
+    PreparedTiles, in which case only the current tile is read into memory. tile_overlap should
+    exceed the largest cell diameter.
+
+    Args:
+        model (models.CellposeModel): loaded cellpose model.
+        image (np.array): input image with shape (channels, height, width).
+        tile_size (int, optional): height and width of each tile in pixels. Defaults to 2048.
+        tile_overlap (int, optional): overlap between neighbouring tiles in pixels. Defaults to 256.
+        **eval_kwargs: passed to model.eval.
+
+    Returns:
+        tuple: tuple containing:
+            - masks (np.array): stitched labels, shape (height, width) or (planes, height, width).
+            - styles (np.array): style vector averaged over tiles.
+    """
+    height, width = image.shape[-2:]
+    row_starts = tile_starts(height, tile_size, tile_overlap)
+    col_starts = tile_starts(width, tile_size, tile_overlap)
+
+    stitched, next_labels, styles = None, None, []
+    for y0 in row_starts:
+        for x0 in col_starts:
+            tile = np.asarray(image[:, y0:y0 + tile_size, x0:x0 + tile_size])
+            tile_masks, _, tile_styles = model.eval([tile], **eval_kwargs)
+            tile_masks = np.asarray(tile_masks[0])
+            styles.append(np.asarray(tile_styles[0]))
+
+            planes = tile_masks.reshape((-1,) + tile_masks.shape[-2:])
+            if stitched is None:
+                stitched = np.zeros((planes.shape[0], height, width), dtype=np.uint32)
+                next_labels = [1] * planes.shape[0]
+
+            cut_edges = (y0 > 0, y0 + planes.shape[-2] < height, x0 > 0, x0 + planes.shape[-1] < width)
+            for plane in range(planes.shape[0]):
+                next_labels[plane] = stitch_tile(stitched[plane], planes[plane], y0, x0, cut_edges, next_labels[plane])
+            logger.info(f'segmented tile at ({y0}, {x0})')
+
+    masks = stitched.reshape(tile_masks.shape[:-2] + (height, width))
+    return as_labels(masks), np.mean(styles, axis=0)
+
+
+def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4, cellprob_threshold=0.0, niter=None, use_gpu=True, big_images=False, tile_size=None, tile_overlap=256, model=None):
     """apply cellpose to a list of images. Return the masks, flows, and styles generated by the cellpose model.
 
     Args:
@@ -35,6 +192,9 @@ def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4,
         niter (int, optional): Number of iterations, increase for long cells. Defaults to None.
         use_gpu (bool, optional): Whether or not to use GPU for processing. Defaults to True.
         big_images (bool, optional): Whether or not cells are large (larger than (2000, 2000)). Defaults to False.
+        tile_size (int, optional): Segment each image at full resolution in overlapping tiles of this size instead of downscaling. Flows are not stitched and are returned as None. Defaults to None.
+        tile_overlap (int, optional): Overlap between tiles in pixels, should exceed the largest cell diameter. Defaults to 256.
+        model (models.CellposeModel, optional): Already loaded model, to avoid reloading it for every call. Defaults to None.
 
     Returns:
         tuple: tuple containing:
@@ -43,9 +203,20 @@ def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4,
             - styles (list): list of styles used by cellpose.
 
     """
-    model = models.CellposeModel(model_type=image_type, gpu=use_gpu)
+    if model is None:
+        model = models.CellposeModel(model_type=image_type, gpu=use_gpu)
+
+    if tile_size is not None:
+        masks, flows, styles = [], [], []
+        for img in images:
+            mask, style = segment_tiled(
+                model, img, tile_size=tile_size, tile_overlap=tile_overlap,
+                diameter=diameter, flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold, niter=niter)
+            masks.append(mask)
+            flows.append(None)
+            styles.append(style)
 
-    if big_images == True:
+    elif big_images == True:
         # sizes for resizing
         smol_size = (1024, 1024)
         orig_size = images[0].shape[1:]
@@ -56,7 +227,7 @@ def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4,
         for img in images:
             smol_arrs = []
             for ch in range(0, np.shape(img)[0]):
-                smol_arrs.append(resize(img[ch], smol_size, preserve_range=True))
+                smol_arrs.append(as_intensity(resize(img[ch], smol_size, preserve_range=True)))
             resized_images.append(smol_arrs)
         images = resized_images
 
@@ -69,8 +240,8 @@ def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4,
         for mask in masks:
             resized_mask = []
             for ch in range(0, np.shape(mask)[0]):
-                resized_mask.append(resize(mask[ch], orig_size, order=0, preserve_range=True, anti_aliasing=False).astype(int))
-            resized_masks.append(resized_mask)
+                resized_mask.append(resize(mask[ch], orig_size, order=0, preserve_range=True, anti_aliasing=False))
+            resized_masks.append(as_labels(resized_mask))
         masks = resized_masks
 
         # resize flows to original size
@@ -82,10 +253,39 @@ def apply_cellpose(images, image_type='sam', diameter=None, flow_threshold=0.4,
     else:
         masks, flows, styles = model.eval(
             images, diameter=diameter, flow_threshold=flow_threshold, cellprob_threshold=cellprob_threshold, niter=niter)
+        masks = [as_labels(mask) for mask in masks]
 
     return masks, flows, styles
 
 
+def prepare_images(images_dict):
+    """Combine the cellular stains into one cytoplasm channel and pair it with the nuclear channel.
+
+    Cellpose-SAM will use the first 3 channels of your image, truncating the rest. It has been trained with the cytoplasm and nuclear channels in any order, with the other channel set to zero.
+    You can combine two stains to create your "cytoplasm" channel.
+    In this example indices 0 and 1 (1st and 2nd) have two cellular stains, and nuclei are in index 2 (3rd channel).
+
+    Args:
+        images_dict (dict): image name -> np.array with shape (channels, height, width)
+
+    Returns:
+        list: np.array images with shape (2, height, width), in the order of images_dict
+    """
+    return [np.stack((img[[0,1]].sum(axis=0), img[2]), axis=0) for name, img in images_dict.items()]
+
+
+class PreparedTiles:
+    """prepare_images of one memory-mapped image, applied to each tile as segment_tiled reads it."""
+
+    def __init__(self, image):
+        self.image = image
+        self.shape = (2,) + image.shape[-2:]
+
+    def __getitem__(self, key):
+        _, rows, cols = key
+        return prepare_images({'tile': np.asarray(self.image[:, rows, cols])})[0]
+
+
 def visualise_cell_pose(images, masks, flows, big_images=False):
     """visualise the results of cellpose on a list of images, masks, and flows.
 
@@ -103,8 +303,9 @@ def visualise_cell_pose(images, masks, flows, big_images=False):
         # plot flow fields
         # flow = flows[idx] if big_images else flows[idx][0][0]
         flow = flows[idx]
-        ax[1].imshow(flow)
-        ax[1].set_title("flows")
+        if flow is not None:
+            ax[1].imshow(flow)
+        ax[1].set_title("flows" if flow is not None else "flows (not stitched)")
 
         # outlines
         outlines = utils.outlines_list(masks[idx][0])
@@ -123,27 +324,42 @@ def visualise_cell_pose(images, masks, flows, big_images=False):
 if __name__ == '__main__':
     
     # ---------------- initialise file list ----------------
-    file_list = [filename for filename in os.listdir(
-        image_folder) if 'npy' in filename]
+    file_list = find_images(image_folder)
 
-    images_dict = {filename.replace('.npy', ''): np.load(
-        f'{image_folder}{filename}') for filename in file_list}
+    # tiled segmentation reads each tile from disk, so large fields are never loaded whole
+    mmap_mode = 'r' if TILE_SIZE is not None else None
+    images_dict = {name: np.load(
+        f'{image_folder}{name}.npy', mmap_mode=mmap_mode) for name in file_list}
 
     # ---------------- prepare images ----------------
-    # Cellpose-SAM will use the first 3 channels of your image, truncating the rest. It has been trained with the cytoplasm and nuclear channels in any order, with the other channel set to zero.
-    # you can combine two stains to create your "cytoplasm" channel
-    # in this example indices 0 and 1 (1st and 2nd) have two cellular stains, and nuclei are in index 2 (3rd channel)
-    imgs_cp = [np.stack((img[[0,1]].sum(axis=0), img[2]), axis=0) for name, img in images_dict.items()]
+    # images are prepared one at a time in the loop below, with prepare_images or, tiled, PreparedTiles
 
     # other packages to preprocess images and improve segmentation if needed
     # gaussian_blur = [filters.gaussian(image, sigma=1, multichannel=True) for image in imgs_cp]
     # brightened = [np.clip(channel*5, 0, 65535).astype(np.uint16) for channel in imgs_cp] # assumes 16-bit images
 
-    # ---------------- apply cellpose ----------------
-    masks, flows, styles = apply_cellpose(imgs_cp, niter=2000, big_images=True)
-    # check the masks with visualisation, else you can skip this step
-    visualise_cell_pose(imgs_cp, masks, flows, big_images=True)
+    # ---------------- apply cellpose and save masks ----------------
+    # each image's masks are saved to the mask store as soon as its segmentation finishes
+    model = models.CellposeModel(model_type=IMAGE_TYPE, gpu=USE_GPU)
+    segmented, masks, flows = [], [], []
+    for name, image in images_dict.items():
+        if mask_store.has_masks(output_folder, name):
+            logger.info(f'masks already saved for {name}, skipping')
+            continue
+        if TILE_SIZE is not None:
+            img_masks, _, _ = apply_cellpose([PreparedTiles(image)], niter=2000, tile_size=TILE_SIZE,
+                                             tile_overlap=TILE_OVERLAP, model=model)
+            mask_store.save_masks(output_folder, name, img_masks[0])
+            logger.info(f'cell masks saved for {name}')
+            continue
+        img = prepare_images({name: image})[0]
+        img_masks, img_flows, _ = apply_cellpose([img], niter=2000, big_images=True, model=model)
+        mask_store.save_masks(output_folder, name, img_masks[0])
+        logger.info(f'cell masks saved for {name}')
+        segmented.append(img)
+        masks.extend(img_masks)
+        flows.extend(img_flows)
 
-    # ---------------- save masks ----------------
-    np.save(f'{output_folder}cellpose_cellmasks.npy', masks)
-    logger.info('cell masks saved')
+    # check the masks with visualisation, else you can skip this step (tiled runs have no flows to show)
+    if segmented:
+        visualise_cell_pose(segmented, masks, flows, big_images=True)
@@ -3,19 +3,65 @@ Quality control: use napari to validate Cellpose-generated masks.
 """
 
 import os
+import sys
+import importlib.util
 import numpy as np
 from skimage.segmentation import clear_border
 from skimage.io import imread
 from loguru import logger
 import napari
 
+# special import, path to script
+dtype_policy_path = 'src/dtype_policy.py'
+
+# load the module dynamically to share the dtype policy between stages
+spec = importlib.util.spec_from_file_location('dtype_policy', dtype_policy_path)
+dtype_policy = importlib.util.module_from_spec(spec)
+sys.modules['dtype_policy'] = dtype_policy
+spec.loader.exec_module(dtype_policy)
+as_labels = dtype_policy.as_labels
+
+mask_store_path = 'src/mask_store.py'
+
+# load the module dynamically to read one mask entry per image
+spec = importlib.util.spec_from_file_location('mask_store', mask_store_path)
+mask_store = importlib.util.module_from_spec(spec)
+sys.modules['mask_store'] = mask_store
+spec.loader.exec_module(mask_store)
+
+cell_qc_path = 'src/cell_qc.py'
+
+# load the module dynamically to measure each cell once
+spec = importlib.util.spec_from_file_location('cell_qc', cell_qc_path)
+cell_qc = importlib.util.module_from_spec(spec)
+sys.modules['cell_qc'] = cell_qc
+spec.loader.exec_module(cell_qc)
+
+tiling_path = 'src/tiling.py'
+
+# load the module dynamically to filter whole slides tile by tile
+spec = importlib.util.spec_from_file_location('tiling', tiling_path)
+tiling = importlib.util.module_from_spec(spec)
+sys.modules['tiling'] = tiling
+spec.loader.exec_module(tiling)
+
+label_index_path = 'src/label_index.py'
+
+# load the module dynamically to look up the pixels of each label without full-image scans
+spec = importlib.util.spec_from_file_location('label_index', label_index_path)
+label_index = importlib.util.module_from_spec(spec)
+sys.modules['label_index'] = label_index
+spec.loader.exec_module(label_index)
+
+puncta_preview_path = 'src/puncta_preview.py'  # loaded in validate_with_napari, it runs all of stage 4
+
 logger.info('import ok')
 
 # configuration
 image_folder = 'results/initial_cleanup/'
 mask_folder = 'results/cellpose_masking/'
 output_folder = 'results/napari_masking/'
-mask_filename = 'cellpose_cellmasks.npy'
+mask_filename = 'cellpose_cellmasks.npy'  # legacy stacked masks, only read if the mask store has no entry
 SATURATION_THRESHOLD = 60000
 SATURATION_FRAC_CUTOFF = 0.05
 NUCLEUS_AREA_THRESHOLD = 8000
@@ -23,6 +69,10 @@ BORDER_BUFFER_SIZE = 10
 COI = 1 # channel of interest for saturation check (e.g., 1 for channel 2)
 FLUORO_INTENSITY_THRESHOLD = 200  # threshold for significant fluorescence intensity in COI
 FLUORO_FRACTION_CUTOFF = 0.1  # fraction of pixels in a cell that must be above the threshold to keep it
+PUNCTA_PREVIEW = True  # dock sliders for the stage 4 puncta threshold and minimum size during manual QC
+TILED_MODE = False  # filter whole slides memory-mapped, tile by tile, without manual validation
+TILE_SIZE = tiling.TILE_SIZE  # core tile size in pixels, tiled mode
+TILE_HALO = tiling.TILE_HALO  # pixels read around each tile, must exceed the largest cell, tiled mode
 
 
 # Setup
@@ -31,60 +81,86 @@ def ensure_output_folder(path):
 
 
 # IO
-def load_images(image_folder):
+def load_images(image_folder, mmap_mode=None):
     return {
-        fname.replace('.npy', ''): np.load(os.path.join(image_folder, fname))
+        fname.replace('.npy', ''): np.load(os.path.join(image_folder, fname), mmap_mode=mmap_mode)
         for fname in os.listdir(image_folder) if fname.endswith('.npy')
     }
 
 
-def load_masks(mask_path, image_keys):
-    all_masks = np.load(mask_path)
-    return {
-        image_name: all_masks[i, :, :]
-        for i, image_name in enumerate(image_keys)
-    }
-
-
-def save_mask(image_name, mask_stack):
+def load_masks(mask_folder, image_keys):
+    """Open each image's masks from the mask store by name, memory-mapped."""
+    image_keys = list(image_keys)
+    missing = [name for name in image_keys if not mask_store.has_masks(mask_folder, name)]
+    legacy_path = os.path.join(mask_folder, mask_filename)
+    legacy = None
+    if missing and os.path.exists(legacy_path):
+        # older runs saved one stack, matched to images by the order of image_keys
+        logger.warning(f'{len(missing)} images not in mask store, falling back to {mask_filename}')
+        legacy = np.load(legacy_path, mmap_mode='r')
+
+    masks = {}
+    for i, image_name in enumerate(image_keys):
+        if image_name not in missing:
+            masks[image_name] = mask_store.load_masks(mask_folder, image_name)
+        elif legacy is not None:
+            masks[image_name] = legacy[i, :, :]
+        else:
+            logger.warning(f'no masks found for {image_name}')
+    return masks
+
+
+def compute_qc_table(image_stack, mask_stack):
+    """Per-cell QC table of one image with the thresholds configured here."""
+    return cell_qc.compute_qc_table(
+        image_stack, mask_stack, coi=COI,
+        saturation_threshold=SATURATION_THRESHOLD,
+        fluoro_threshold=FLUORO_INTENSITY_THRESHOLD,
+        border_buffer=BORDER_BUFFER_SIZE,
+    )
+
+
+def save_mask(image_name, mask_stack, image_stack=None):
+    """Save the masks, and their per-cell QC table next to them when the image is given."""
     out_path = os.path.join(output_folder, f'{image_name}_mask.npy')
+    mask_stack = as_labels(mask_stack)
     np.save(out_path, mask_stack)
     logger.info(f'Mask saved: {out_path}')
+    if image_stack is not None:
+        cell_qc.save_qc_table(output_folder, image_name, compute_qc_table(image_stack, mask_stack))
 
 
 # Mask Filtering
-def remove_saturated_cells(image_stack, mask_stack, COI=COI):
-    '''Remove masks for saturated cells based on intensity threshold.'''
-    raw = image_stack[COI, :, :]
-    cells = mask_stack[0, :, :]
-
-    valid_labels = []
-    for label in np.unique(cells)[1:]:
-        pixel_mask = (cells == label)
-        pixel_count = np.count_nonzero(pixel_mask)
-        saturated = np.count_nonzero(raw[pixel_mask] > SATURATION_THRESHOLD)
-        if saturated / pixel_count < SATURATION_FRAC_CUTOFF:
-            valid_labels.append(label)
+def remove_saturated_cells(image_stack, mask_stack, COI=COI, qc_table=None, index=None):
+    '''Remove masks for saturated cells based on intensity threshold.
 
+    With a label_index.LabelIndex of the cells, only the pixels of the removed cells are touched.
+    '''
+    cells = mask_stack[0, :, :]
+    if qc_table is None:
+        qc_table = cell_qc.compute_qc_table(image_stack, mask_stack, coi=COI,
+                                            saturation_threshold=SATURATION_THRESHOLD,
+                                            fluoro_threshold=FLUORO_INTENSITY_THRESHOLD,
+                                            border_buffer=BORDER_BUFFER_SIZE)
+
+    valid_labels = qc_table.loc[qc_table['saturated_fraction'] < SATURATION_FRAC_CUTOFF, 'cell_number']
+    if index is not None:
+        return index.remove_labels(cells, index.labels[~np.isin(index.labels, valid_labels)])
     filtered_cells = np.where(np.isin(cells, valid_labels), cells, 0)
     return filtered_cells
 
 
-def filter_cells_by_fluoro_expression(image_stack, cells_mask):
-    """Keep only cells with significant fluoro signal."""
-    fluoro = image_stack[COI, :, :]
-    valid_labels = []
+def filter_cells_by_fluoro_expression(image_stack, cells_mask, qc_table=None, index=None):
+    """Keep only cells with significant fluoro signal.
 
-    for label in np.unique(cells_mask)[1:]:
-        mask = (cells_mask == label)
-        pixel_count = np.count_nonzero(mask)
-
-        fluoro_pixels = fluoro[mask]
-        bright_pixels = np.count_nonzero(fluoro_pixels > FLUORO_INTENSITY_THRESHOLD)
-
-        if bright_pixels / pixel_count > FLUORO_FRACTION_CUTOFF:
-            valid_labels.append(label)
+    index is a label_index.LabelIndex of cells_mask or of the mask it was filtered from.
+    """
+    if qc_table is None:
+        qc_table = compute_qc_table(image_stack, np.stack([cells_mask, np.zeros_like(cells_mask)]))
 
+    valid_labels = qc_table.loc[qc_table['bright_fraction'] > FLUORO_FRACTION_CUTOFF, 'cell_number']
+    if index is not None:
+        return index.remove_labels(cells_mask, index.labels[~np.isin(index.labels, valid_labels)])
     filtered_cells = np.where(np.isin(cells_mask, valid_labels), cells_mask, 0)
     return filtered_cells
 
@@ -93,7 +169,10 @@ def remove_border_objects(mask):
     return clear_border(mask, buffer_size=BORDER_BUFFER_SIZE)
 
 
-def filter_small_nuclei(nuclei_mask):
+def filter_small_nuclei(nuclei_mask, index=None):
+    """Remove nuclei smaller than NUCLEUS_AREA_THRESHOLD, index is a label_index.LabelIndex of nuclei_mask itself."""
+    if index is not None:
+        return index.remove_labels(nuclei_mask, index.labels[index.sizes < NUCLEUS_AREA_THRESHOLD])
     new_mask = nuclei_mask.copy()
     for label in np.unique(nuclei_mask)[1:]:
         area = np.count_nonzero(nuclei_mask == label)
@@ -104,17 +183,65 @@ def filter_small_nuclei(nuclei_mask):
 
 def filter_masks_auto(image_stack, mask_stack, filter_fluoro=False):
     cells, nuclei = mask_stack[0], mask_stack[1]
+    qc_table = compute_qc_table(image_stack, mask_stack)
+    index = label_index.LabelIndex(cells)  # shared by the cell filters, which only remove whole cells
 
-    cells_filtered = remove_saturated_cells(image_stack, mask_stack)
+    cells_filtered = remove_saturated_cells(image_stack, mask_stack, qc_table=qc_table, index=index)
     cells_filtered = remove_border_objects(cells_filtered)
 
     if filter_fluoro:
-        cells_filtered = filter_cells_by_fluoro_expression(image_stack, cells_filtered)
+        cells_filtered = filter_cells_by_fluoro_expression(image_stack, cells_filtered, qc_table=qc_table, index=index)
 
     intra_nuclei = np.where(cells_filtered > 0, nuclei, 0)
-    filtered_nuclei = filter_small_nuclei(intra_nuclei)
-
-    return np.stack([cells_filtered, filtered_nuclei])
+    filtered_nuclei = filter_small_nuclei(intra_nuclei, index=label_index.LabelIndex(intra_nuclei))
+
+    return as_labels(np.stack([cells_filtered, filtered_nuclei]))
+
+
+def filter_masks_tiled(image_stack, mask_stack, out_stack, filter_fluoro=False):
+    """Run the filters of filter_masks_auto tile by tile, writing the filtered masks into out_stack.
+
+    Every filter decides per cell from the cell's own pixels, and a cell reaching into a core lies
+    fully inside that core's window. Each core therefore gets the same masks as filtering the whole
+    slide, as long as cells are smaller than the halo. Cells that reach past the window of any core
+    they lie in are larger than that; they are found in a first pass over the masks and removed from
+    every tile with a warning, as tiled stage 4 skips them. Only the border filter changes: it
+    clears cells at the slide edge instead of at the window edge.
+
+    Args:
+        image_stack (np.array): slide with shape (channels, height, width), e.g. memory-mapped.
+        mask_stack (np.array): cell and nuclei masks with shape (2, height, width), e.g. memory-mapped.
+        out_stack (np.array): array of the same shape as mask_stack to write into, e.g. np.lib.format.open_memmap.
+        filter_fluoro (bool, optional): also keep only cells with significant fluoro signal. Defaults to False.
+
+    Returns:
+        np.array: out_stack.
+    """
+    shape = mask_stack.shape[-2:]
+    tiles = tiling.tile_windows(shape, TILE_SIZE, TILE_HALO)
+    # cells cut by a window would be filtered on part of their pixels there
+    truncated = tiling.truncated_labels(mask_stack[0], tiles, shape)
+    tiling.warn_truncated(len(truncated))
+
+    for core, window in tiles:
+        image = np.asarray(image_stack[:, window[0], window[1]])
+        masks = as_labels(mask_stack[:, window[0], window[1]])
+        qc_table = compute_qc_table(image, masks)
+        index = label_index.LabelIndex(masks[0])
+
+        cells_filtered = remove_saturated_cells(image, masks, qc_table=qc_table, index=index)
+        cells_filtered = index.remove_labels(cells_filtered, tiling.slide_border_labels(cells_filtered, window, shape, BORDER_BUFFER_SIZE))
+
+        if filter_fluoro:
+            cells_filtered = filter_cells_by_fluoro_expression(image, cells_filtered, qc_table=qc_table, index=index)
+
+        cells_filtered = index.remove_labels(cells_filtered, truncated)
+        intra_nuclei = np.where(cells_filtered > 0, masks[1], 0)
+        filtered_nuclei = filter_small_nuclei(intra_nuclei, index=label_index.LabelIndex(intra_nuclei))
+        local = tiling.local_slices(core, window)
+        out_stack[0, core[0], core[1]] = cells_filtered[local]
+        out_stack[1, core[0], core[1]] = filtered_nuclei[local]
+    return out_stack
 
 
 # Manual QC
@@ -123,6 +250,15 @@ def validate_with_napari(image_stack, image_name, mask_stack):
     viewer = napari.view_image(image_stack, name='image_stack')
     viewer.add_labels(mask_stack[0], name='cells')
     viewer.add_labels(mask_stack[1], name='nuclei')
+    if PUNCTA_PREVIEW:
+        if 'puncta_preview' not in sys.modules:
+            # load the module dynamically, once, to preview puncta detection while reviewing masks
+            spec = importlib.util.spec_from_file_location('puncta_preview', puncta_preview_path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules['puncta_preview'] = module
+            spec.loader.exec_module(module)
+        puncta_preview = sys.modules['puncta_preview']
+        puncta_preview.add_preview_widget(viewer, image_stack, viewer.layers['cells'])
 
     # Block until viewer window is closed
     napari.run()
@@ -132,7 +268,7 @@ def validate_with_napari(image_stack, image_name, mask_stack):
     nuclei = viewer.layers['nuclei'].data
 
     out_stack = np.stack([cells, nuclei])
-    save_mask(image_name, out_stack)
+    save_mask(image_name, out_stack, image_stack=image_stack)
     return out_stack
 
 
@@ -141,12 +277,12 @@ def run_qc_pipeline(filter_fluoro=False):
     ensure_output_folder(output_folder)
 
     images = load_images(image_folder)
-    masks = load_masks(os.path.join(mask_folder, mask_filename), images.keys())
+    masks = load_masks(mask_folder, images.keys())
 
     logger.info('starting automated mask filtering')
     filtered_masks = {
         name: filter_masks_auto(image, masks[name], filter_fluoro=filter_fluoro)
-        for name, image in images.items()
+        for name, image in images.items() if name in masks
     }
 
     logger.info('starting manual validation in napari')
@@ -157,11 +293,38 @@ def run_qc_pipeline(filter_fluoro=False):
     }
 
     for name, image in images.items():
-        name
-        if name not in already_filtered:
+        if name in filtered_masks and name not in already_filtered:
             _ = validate_with_napari(image, name, filtered_masks[name])
 
 
+def run_tiled_qc_pipeline(filter_fluoro=False):
+    """Filter whole slides tile by tile and save their masks and QC tables, skipping manual validation."""
+    ensure_output_folder(output_folder)
+
+    images = load_images(image_folder, mmap_mode='r')
+    masks = load_masks(mask_folder, images.keys())
+
+    logger.info('starting tiled automated mask filtering')
+    for name, image in images.items():
+        out_path = os.path.join(output_folder, f'{name}_mask.npy')
+        if name not in masks or os.path.exists(out_path):
+            continue
+        # write the masks memory-mapped to a temporary file, the mask only appears once it is complete
+        tmp_path = os.path.join(output_folder, f'.{name}_mask.tmp.npy')
+        dtype = dtype_policy.label_dtype(int(masks[name].max()))
+        out_stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=masks[name].shape)
+        filter_masks_tiled(image, masks[name], out_stack, filter_fluoro=filter_fluoro)
+        out_stack.flush()
+        qc_table = tiling.compute_qc_table_tiled(image, out_stack, compute_qc_table, BORDER_BUFFER_SIZE, TILE_SIZE, TILE_HALO)
+        del out_stack
+        os.replace(tmp_path, out_path)
+        cell_qc.save_qc_table(output_folder, name, qc_table)
+        logger.info(f'Mask saved: {out_path}')
+
+
 # Entry Point
 if __name__ == '__main__':
-    run_qc_pipeline(filter_fluoro=True)
+    if TILED_MODE:
+        run_tiled_qc_pipeline(filter_fluoro=True)
+    else:
+        run_qc_pipeline(filter_fluoro=True)
@@ -13,19 +13,46 @@ from matplotlib_scalebar.scalebar import ScaleBar
 import skimage.io
 from skimage import measure, segmentation, morphology
 from skimage.morphology import remove_small_objects
-from scipy import stats
+from scipy import stats, ndimage
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from scipy.stats import skewtest
 from loguru import logger
 import functools
 # special import, path to script
-napari_utils_path = 'src/3_napari.py'
+dtype_policy_path = 'src/dtype_policy.py'
 
-# load the module dynamically due to annoying file name
-spec = importlib.util.spec_from_file_location("napari", napari_utils_path)
-napari_utils = importlib.util.module_from_spec(spec)
-sys.modules["napari_utils"] = napari_utils
-spec.loader.exec_module(napari_utils)
-remove_saturated_cells = napari_utils.remove_saturated_cells
+# load the module dynamically to share the dtype policy between stages
+spec = importlib.util.spec_from_file_location('dtype_policy', dtype_policy_path)
+dtype_policy = importlib.util.module_from_spec(spec)
+sys.modules['dtype_policy'] = dtype_policy
+spec.loader.exec_module(dtype_policy)
+as_labels = dtype_policy.as_labels
+
+cell_qc_path = 'src/cell_qc.py'
+
+# load the module dynamically to look up the per-cell QC table saved by stage 3
+spec = importlib.util.spec_from_file_location('cell_qc', cell_qc_path)
+cell_qc = importlib.util.module_from_spec(spec)
+sys.modules['cell_qc'] = cell_qc
+spec.loader.exec_module(cell_qc)
+
+tiling_path = 'src/tiling.py'
+
+# load the module dynamically to process whole slides tile by tile
+spec = importlib.util.spec_from_file_location('tiling', tiling_path)
+tiling = importlib.util.module_from_spec(spec)
+sys.modules['tiling'] = tiling
+spec.loader.exec_module(tiling)
+
+label_index_path = 'src/label_index.py'
+
+# load the module dynamically to look up the pixels of each label without full-image scans
+spec = importlib.util.spec_from_file_location('label_index', label_index_path)
+label_index = importlib.util.module_from_spec(spec)
+sys.modules['label_index'] = label_index
+spec.loader.exec_module(label_index)
 
 logger.info('import ok')
 
@@ -35,7 +62,10 @@ sns.set_palette('Paired')
 
 # --- configuration ---
 STD_THRESHOLD = 3.8
-SAT_FRAC_CUTOFF = 0.01  # for consistency with remove_saturated_cells
+SAT_FRAC_CUTOFF = 0.05  # as SATURATION_FRAC_CUTOFF in 3_napari.py
+SATURATION_THRESHOLD = 60000  # as in 3_napari.py, QC tables measured with other thresholds are remeasured
+FLUORO_INTENSITY_THRESHOLD = 200  # as in 3_napari.py
+BORDER_BUFFER_SIZE = 10  # as in 3_napari.py
 COI_1 = 1  # channel of interest for saturation check (e.g., 1 for channel 2)
 COI_2 = 0  # secondary channel of interest for comparisons
 COI_1_name = 'coi1'  # name of the first channel of interest, for plotting
@@ -43,10 +73,37 @@ COI_2_name  = 'coi2'  # name of the second channel of interest, flor plotting
 MIN_PUNCTA_SIZE = 16  # minimum size of puncta
 SCALE_PX = 0.0779907  # size of one pixel in units specified by the next constant
 SCALE_UNIT = 'um'  # units for the scale bar
+RIPLEY_RADIUS = 20  # radius in pixels for the per-cell Ripley's L clustering statistic
+Z_STACK_MODE = False  # also detect puncta in 3D on the full z-stacks saved by stage 1
+Z_CHUNK = 16  # z-slices read at a time in 3D mode, bounds memory on deep stacks
+MIN_PUNCTA_VOLUME = 27  # minimum size of puncta in voxels, 3D mode
+TIMESERIES_MODE = False  # also track puncta over time in the time-series saved by stage 1
+MAX_LINK_DISTANCE = 5  # largest displacement in pixels of a puncta between frames, time-lapse mode
+MANDERS_THRESHOLDS = {COI_1_name: 0, COI_2_name: 0}  # intensity above which a pixel counts as positive, Manders coefficients
+MULTICHANNEL_MODE = False  # also detect puncta in every channel of DETECTION_CHANNELS and report their overlap
+DETECTION_CHANNELS = {COI_1_name: COI_1, COI_2_name: COI_2}  # name -> channel index, multi-channel mode
+SWEEP_MODE = False  # also count puncta for every STD_THRESHOLD and MIN_PUNCTA_SIZE in the grids below
+SWEEP_STD_THRESHOLDS = [round(2.0 + 0.2 * i, 1) for i in range(20)]
+SWEEP_MIN_SIZES = [4, 8, 16, 32]
+TILED_MODE = False  # process whole slides memory-mapped, tile by tile, instead of one array per image
+TILE_SIZE = tiling.TILE_SIZE  # core tile size in pixels, tiled mode
+TILE_HALO = tiling.TILE_HALO  # pixels read around each tile, must exceed the largest cell, tiled mode
+USE_BACKGROUND_CORRECTION = False  # detect puncta on background corrected images, STD_THRESHOLD is tuned on raw images
 image_folder = 'results/initial_cleanup/'
+background_folder = 'results/background_correction/'
 mask_folder = 'results/napari_masking/'
 output_folder = 'results/summary_calculations/'
 proofs_folder = 'results/proofs/'
+checkpoint_folder = 'results/summary_calculations/checkpoints/'  # per-image feature parts, redone when their inputs change
+stack_folder = 'results/initial_cleanup_zstacks/'
+timeseries_folder = 'results/initial_cleanup_timeseries/'
+FEATURE_COLS = ['puncta_area', 'puncta_eccentricity', 'puncta_aspect_ratio',
+                'puncta_circularity', 'puncta_cv', 'puncta_skew',
+                'coi2_partition_coeff', 'coi1_partition_coeff',
+                'cell_cv', 'cell_skew']  # features saved per replicate and normalized
+
+QC_SETTINGS = {'coi': COI_1, 'saturation_threshold': SATURATION_THRESHOLD,
+               'fluoro_threshold': FLUORO_INTENSITY_THRESHOLD, 'border_buffer': BORDER_BUFFER_SIZE}
 
 for folder in [output_folder, proofs_folder]:
     if not os.path.exists(folder):
@@ -64,120 +121,930 @@ def feature_extractor(mask, properties=None):
     return pd.DataFrame(props)
 
 
-def load_images(image_folder):
+def load_images(image_folder, mmap_mode=None):
     images = {}
     for fn in os.listdir(image_folder):
         if fn.endswith('.npy'):
             name = fn.removesuffix('.npy')
-            images[name] = np.load(f'{image_folder}/{fn}')
+            images[name] = np.load(f'{image_folder}/{fn}', mmap_mode=mmap_mode)
     return images
 
 
-def load_masks(mask_folder):
+def load_masks(mask_folder, mmap_mode=None):
     masks = {}
     for fn in os.listdir(mask_folder):
         if fn.endswith('_mask.npy'):
             name = fn.removesuffix('_mask.npy')
-            masks[name] = np.load(f'{mask_folder}/{fn}', allow_pickle=True)
+            masks[name] = np.load(f'{mask_folder}/{fn}', mmap_mode=mmap_mode, allow_pickle=True)
     return masks
 
 
-def generate_cytoplasm_masks(masks):
+def build_label_indexes(masks):
+    """label_index.LabelIndex of the cell mask of every image, built once and shared by the label-wise steps."""
+    return {name: label_index.LabelIndex(as_labels(img[0])) for name, img in masks.items()}
+
+
+def generate_cytoplasm_masks(masks, indexes=None):
+    """Cell masks without their nuclei, by name; indexes from build_label_indexes skip the per-cell scans."""
     logger.info('removing nuclei from cell masks...')
     cyto_masks = {}
     for name, img in masks.items():
-        cell_mask, nuc_mask = img[0], img[1]
-        cell_bin = (cell_mask > 0).astype(int) # make binary masks
-        nuc_bin = (nuc_mask > 0).astype(int)
+        cell_mask, nuc_mask = as_labels(img[0]), as_labels(img[1])
+        cell_bin = cell_mask > 0 # make binary masks
+        nuc_bin = nuc_mask > 0
+
+        if indexes is not None:
+            # every labelled pixel outside a nucleus keeps its label
+            index = indexes[name]
+            cyto_pixels = index.order[~nuc_bin.ravel()[index.order]]
+            cyto_masks[name] = np.zeros_like(cell_mask)
+            cyto_masks[name].reshape(-1)[cyto_pixels] = cell_mask.ravel()[cyto_pixels]
+            continue
 
         single_cyto = []
         labels = np.unique(cell_mask)
         if labels.size > 1:
             for lbl in labels[labels != 0]:
-                cyto = np.where(cell_mask == lbl, cell_bin, 0)
+                cyto = (cell_mask == lbl) & cell_bin
                 cyto_minus_nuc = cyto & ~nuc_bin
                 if np.any(cyto_minus_nuc):
-                    single_cyto.append(np.where(cyto_minus_nuc, lbl, 0))
+                    single_cyto.append(np.where(cyto_minus_nuc, lbl, 0).astype(cell_mask.dtype))
                 else:
-                    single_cyto.append(np.zeros_like(cell_mask, dtype=int))
+                    single_cyto.append(np.zeros_like(cell_mask))
         else:
-            single_cyto.append(np.zeros_like(cell_mask, dtype=int))
+            single_cyto.append(np.zeros_like(cell_mask))
 
         cyto_masks[name] = sum(single_cyto)
     logger.info('cytoplasm masks created.')
     return cyto_masks
 
 
-def filter_saturated_images(images, cytoplasm_masks, masks):
+def load_qc_tables(mask_folder, names):
+    """Per-cell QC tables saved by stage 3 next to the masks, skipping images without one."""
+    tables = {name: cell_qc.load_qc_table(mask_folder, name) for name in names}
+    return {name: table for name, table in tables.items() if table is not None}
+
+
+def filter_saturated_images(images, cytoplasm_masks, masks, corrected=None, qc_tables=None, indexes=None):
+    """Drop saturated cells and pair the remaining cell masks with the intensities for detection.
+
+    Args:
+        images (dict): raw images by name, used for the saturation check.
+        cytoplasm_masks (dict): cytoplasm masks by name.
+        masks (dict): cell and nuclei masks by name.
+        corrected (dict, optional): background corrected images by name, measured instead of the
+            raw images when given. Defaults to None.
+        qc_tables (dict, optional): per-cell QC tables by name from load_qc_tables. Images without
+            a table, or with a table measured with other QC_SETTINGS, are measured here. Defaults to None.
+        indexes (dict, optional): label indexes of the cell masks by name, from build_label_indexes,
+            so that only the pixels of saturated cells are touched. Defaults to None.
+
+    Returns:
+        dict: (stain, coi, cell mask) tuples by name.
+    """
     logger.info('filtering saturated cells...')
+    qc_tables = qc_tables or {}
     filtered = {}
     for name, img in images.items():
-        # Build a stack: [stain, coi, cytoplasm mask]
-        stack = np.stack([
-            img[COI_2], img[COI_1], cytoplasm_masks[name]
-        ])
-        # apply  imported saturation check function
-        cells = remove_saturated_cells(
-            image_stack=stack,
-            mask_stack=masks[name],
-            COI=COI_1
-        )
-        filtered[name] = np.stack([stack[COI_2], stack[COI_1], cells])
+        table = qc_tables.get(name)
+        if table is None or not cell_qc.measured_with(table, **QC_SETTINGS):
+            table = cell_qc.compute_qc_table(img, masks[name], **QC_SETTINGS)
+        cells = masks[name][0]
+        valid_labels = table.loc[table['saturated_fraction'] < SAT_FRAC_CUTOFF, 'cell_number']
+        if indexes is None:
+            cells = np.where(np.isin(cells, valid_labels), cells, 0)
+        else:
+            index = indexes[name]
+            cells = index.remove_labels(as_labels(cells), index.labels[~np.isin(index.labels, valid_labels)])
+        measured = img if corrected is None else corrected[name]
+        # keep (stain, coi, cell mask) as a tuple so intensities and labels keep their own dtypes
+        filtered[name] = (measured[COI_2], measured[COI_1], as_labels(cells))
     logger.info('saturated cells filtered.')
     return filtered
 
 
-def collect_features(image_dict, STD_THRESHOLD=STD_THRESHOLD):
-    logger.info('collecting cell & puncta features...')
+def skewtest_statistic(n, skewness):
+    """Z of scipy.stats.skewtest for a sample of size n with the given (biased) skewness."""
+    y = skewness * np.sqrt((n + 1) * (n + 3) / (6.0 * (n - 2)))
+    beta2 = 3.0 * (n ** 2 + 27 * n - 70) * (n + 1) * (n + 3) / ((n - 2.0) * (n + 5) * (n + 7) * (n + 9))
+    w2 = -1 + np.sqrt(2 * (beta2 - 1))
+    delta = 1 / np.sqrt(0.5 * np.log(w2))
+    alpha = np.sqrt(2.0 / (w2 - 1))
+    y = 1.0 if y == 0 else y
+    return delta * np.log(y / alpha + np.sqrt((y / alpha) ** 2 + 1))
+
+
+def placeholder_stats(coi1, coi2, windows=None):
+    """Puncta statistics of the placeholder row of a cell without puncta.
+
+    The placeholder has puncta_label 0, which selects every pixel of the frame, so its puncta_cv,
+    puncta_skew, puncta_intensity_mean and puncta_intensity_mean_in_coi2 are those of the whole
+    image. They are measured once per image, in two passes over windows so that a memory-mapped
+    slide is read one window at a time.
+
+    Args:
+        coi1 (np.array): coi1 frame.
+        coi2 (np.array): coi2 frame.
+        windows (list, optional): (row slice, column slice) covering the frame once. Defaults to the whole frame.
+
+    Returns:
+        tuple: (cv, skew, mean coi1, mean coi2), as measured on the placeholder's pixels.
+    """
+    windows = windows or [(slice(None), slice(None))]
+    n, total1, total2 = 0, 0.0, 0.0
+    for window in windows:
+        frame = np.asarray(coi1[window], dtype=np.float64)
+        n += frame.size
+        total1 += frame.sum()
+        total2 += np.asarray(coi2[window], dtype=np.float64).sum()
+    mean1 = total1 / n
+    m2, m3 = 0.0, 0.0
+    for window in windows:
+        centred = np.asarray(coi1[window], dtype=np.float64) - mean1
+        m2 += (centred ** 2).sum()
+        m3 += (centred ** 3).sum()
+    m2, m3 = m2 / n, m3 / n
+    return np.sqrt(m2) / mean1, skewtest_statistic(n, m3 / m2 ** 1.5), mean1, total2 / n
+
+
+def collect_image_features(name, img, STD_THRESHOLD=STD_THRESHOLD, index=None, placeholder=None):
+    """Cell and puncta features of one image, an empty DataFrame if it has no cells.
+
+    With a label_index.LabelIndex of the cell mask (or of the mask it was filtered from), each
+    cell is measured in its bounding box instead of the whole image, with the same results. The
+    placeholder row of a cell without puncta takes the statistics of the whole image either way,
+    from placeholder_stats, computed once per image unless given as placeholder.
+    """
     results = []
-    for name, img in image_dict.items():
-        coi2, coi1, mask = img
-        unique_cells = np.unique(mask)[1:]
-        contours = measure.find_contours((mask > 0).astype(int), 0.8)
-        contour = [c for c in contours if len(c) >= 100]
-
-        for lbl in unique_cells:
-            cell_mask = mask == lbl
-            coi1_vals = coi1[cell_mask]
-            mean_coi1 = coi1_vals.mean()
-            std_coi1 = coi1_vals.std()
-
-            threshold = std_coi1 * STD_THRESHOLD
-            binary = (coi1 > threshold) & cell_mask
-            puncta_labels = morphology.label(binary)
-            puncta_labels = remove_small_objects(puncta_labels, min_size=MIN_PUNCTA_SIZE)
-
-            df_p = feature_extractor(puncta_labels).add_prefix('puncta_')
-            if df_p.empty:
-                df_p.loc[0] = 0
-
-            stats_list = []
-            for i, row in df_p.iterrows():
-                p_mask = puncta_labels == row['puncta_label']
-                puncta_vals = coi1[p_mask]
-                cv = puncta_vals.std() / puncta_vals.mean()
-                skew_stat = skewtest(puncta_vals).statistic
-                mean_p = puncta_vals.mean()
-                mean_coi2 = coi2[p_mask].mean()
-                stats_list.append((cv, skew_stat, mean_p, mean_coi2))
-
-            df_stats = pd.DataFrame(stats_list,
-                                    columns=['puncta_cv', 'puncta_skew',
-                                             'puncta_intensity_mean',
-                                             'puncta_intensity_mean_in_coi2'])
-            df = pd.concat([df_p.reset_index(drop=True), df_stats], axis=1)
-            df['image_name'], df['cell_number'] = name, lbl
-            df['cell_size'] = cell_mask.sum()
-            df['cell_cv'] = std_coi1 / mean_coi1  # coefficient of variation
-            df['cell_skew'] = skewtest(coi1_vals).statistic
-            df['cell_coi1_intensity_mean'] = mean_coi1
-            df['cell_coi2_intensity_mean'] = (coi2[cell_mask]).mean()
-            df['cell_coords'] = [contour] * len(df)
-
-            results.append(df)
+    coi2, coi1, mask = img
+    unique_cells = np.unique(mask)[1:] if index is None else index.present(mask)
+    contours = measure.find_contours(mask > 0, 0.8)
+    contour = [c for c in contours if len(c) >= 100]
+
+    for lbl in unique_cells:
+        window = (slice(None), slice(None)) if index is None else index.bbox(lbl)
+        cell_mask = mask[window] == lbl
+        coi1_cell, coi2_cell = coi1[window], coi2[window]
+        coi1_vals = coi1_cell[cell_mask]
+        mean_coi1 = coi1_vals.mean()
+        std_coi1 = coi1_vals.std()
+
+        threshold = std_coi1 * STD_THRESHOLD
+        binary = (coi1_cell > threshold) & cell_mask
+        puncta_labels = morphology.label(binary)
+        puncta_labels = remove_small_objects(puncta_labels, min_size=MIN_PUNCTA_SIZE)
+
+        df_p = feature_extractor(puncta_labels).add_prefix('puncta_')
+        if index is not None:
+            # coordinates of the bounding box back to the image
+            origin = np.array([window[0].start, window[1].start])
+            df_p['puncta_coords'] = [coords + origin for coords in df_p['puncta_coords']]
+
+        stats_list = []
+        for i, row in df_p.iterrows():
+            p_mask = puncta_labels == row['puncta_label']
+            puncta_vals = coi1_cell[p_mask]
+            cv = puncta_vals.std() / puncta_vals.mean()
+            skew_stat = skewtest(puncta_vals).statistic
+            mean_p = puncta_vals.mean()
+            mean_coi2 = coi2_cell[p_mask].mean()
+            stats_list.append((cv, skew_stat, mean_p, mean_coi2))
+        if df_p.empty:
+            df_p.loc[0] = 0
+            if placeholder is None:
+                placeholder = placeholder_stats(coi1, coi2)
+            stats_list.append(placeholder)
+
+        df_stats = pd.DataFrame(stats_list,
+                                columns=['puncta_cv', 'puncta_skew',
+                                         'puncta_intensity_mean',
+                                         'puncta_intensity_mean_in_coi2'])
+        df = pd.concat([df_p.reset_index(drop=True), df_stats], axis=1)
+        df['image_name'], df['cell_number'] = name, lbl
+        df['cell_size'] = cell_mask.sum()
+        df['cell_cv'] = std_coi1 / mean_coi1  # coefficient of variation
+        df['cell_skew'] = skewtest(coi1_vals).statistic
+        df['cell_coi1_intensity_mean'] = mean_coi1
+        df['cell_coi2_intensity_mean'] = (coi2_cell[cell_mask]).mean()
+        df['cell_coords'] = [contour] * len(df)
+
+        results.append(df)
+
+    if not results:
+        return pd.DataFrame()
+    features = pd.concat(results, ignore_index=True)
+    coloc = colocalization_features(coi1, coi2, mask, int(mask.max())).set_index('cell_number')
+    for col in coloc.columns:
+        features[col] = features['cell_number'].map(coloc[col])
+    return features
+
+
+def checkpoint_settings(STD_THRESHOLD):
+    return {'STD_THRESHOLD': STD_THRESHOLD, 'MIN_PUNCTA_SIZE': MIN_PUNCTA_SIZE, 'MANDERS_THRESHOLDS': MANDERS_THRESHOLDS,
+            'COI_1': COI_1, 'COI_2': COI_2, 'USE_BACKGROUND_CORRECTION': USE_BACKGROUND_CORRECTION,
+            'TILED_MODE': TILED_MODE}
+
+
+def input_files(name):
+    """Files the features of one image are computed from, to tell when a checkpoint part is stale."""
+    files = [f'{image_folder}{name}.npy', f'{mask_folder}{name}_mask.npy', cell_qc.qc_path(mask_folder, name)]
+    if USE_BACKGROUND_CORRECTION:
+        files.append(f'{background_folder}{name}.npy')
+    return files
+
+
+def input_fingerprint(files):
+    """Modification time and size of every existing file, a missing file counts as None."""
+    return {path: (os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path) else None
+            for path in files}
+
+
+def read_part(part_path, fingerprint):
+    """Features of a checkpoint part, None if there is none or it was computed from other settings or inputs."""
+    if not os.path.exists(part_path):
+        return None
+    part = pd.read_pickle(part_path)
+    if not isinstance(part, dict) or part['inputs'] != fingerprint:
+        return None
+    return part['features']
+
+
+def collect_features(image_dict, STD_THRESHOLD=STD_THRESHOLD, checkpoint_folder=None, image_features=collect_image_features,
+                     indexes=None, sources=None):
+    """Collect cell and puncta features of every image.
+
+    With a checkpoint_folder, each image's features are written to their own part file as soon as
+    the image is finished, and images with a part file are skipped, so a killed run resumes from the
+    last completed image and memory does not grow with the run. Each part keeps the settings it was
+    computed with and the modification time and size of the files in sources, and is recomputed
+    when either changed, e.g. after a new STD_THRESHOLD or after the masks were redone. The final table is read back from the part files in the order of
+    image_dict, and is the same as without checkpoints.
+
+    Args:
+        image_dict (dict): image name -> (coi2, coi1, cell mask).
+        STD_THRESHOLD (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+        checkpoint_folder (str, optional): folder for per-image part files. Defaults to None.
+        image_features (callable, optional): features of one image, name, img, STD_THRESHOLD -> pd.DataFrame;
+            collect_slide_features for whole slides. Defaults to collect_image_features.
+        indexes (dict, optional): label indexes of the cell masks by name, from build_label_indexes,
+            passed to image_features as index. Defaults to None.
+        sources (dict, optional): image name -> input files of that image, e.g. from input_files.
+            Defaults to None, which only checks the settings.
+
+    Returns:
+        pd.DataFrame: one row per puncta, with a placeholder row for cells without puncta.
+    """
+    logger.info('collecting cell & puncta features...')
+
+    def features_of(name, img):
+        if indexes is None:
+            return image_features(name, img, STD_THRESHOLD)
+        return image_features(name, img, STD_THRESHOLD, index=indexes[name])
+
+    if checkpoint_folder is None:
+        results = [features_of(name, img) for name, img in image_dict.items()]
+    else:
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        settings = checkpoint_settings(STD_THRESHOLD)
+        results = []
+        for name, img in image_dict.items():
+            part_path = os.path.join(checkpoint_folder, f'{name}.pkl')
+            fingerprint = {'settings': settings,
+                           'files': input_fingerprint(sources[name]) if sources is not None else {}}
+            features = read_part(part_path, fingerprint)
+            if features is not None:
+                logger.info(f'{name} already in checkpoint, skipping')
+            else:
+                if os.path.exists(part_path):
+                    logger.info(f'settings or inputs of {name} changed since its checkpoint, recomputing')
+                features = features_of(name, img)
+                tmp_path = f'{part_path}.tmp'
+                pd.to_pickle({'inputs': fingerprint, 'features': features}, tmp_path)
+                os.replace(tmp_path, part_path)  # a part only exists once it is complete
+            results.append(features)
 
     logger.info('feature extraction done.')
-    return pd.concat(results, ignore_index=True)
+    return pd.concat([df for df in results if not df.empty], ignore_index=True)
+
+
+def filter_saturated_slides(images, masks, corrected=None, qc_tables=None):
+    """Tiled counterpart of filter_saturated_images for memory-mapped whole slides.
+
+    Nothing is cut out here: the saturation check only picks the valid cell labels, measured tile
+    by tile when the slide has no QC table from stage 3.
+
+    Args:
+        images (dict): raw slides by name, used for the saturation check.
+        masks (dict): cell and nuclei masks by name.
+        corrected (dict, optional): background corrected slides by name, measured instead of the
+            raw slides when given. Defaults to None.
+        qc_tables (dict, optional): per-cell QC tables by name from load_qc_tables, used when
+            measured with QC_SETTINGS. Defaults to None.
+
+    Returns:
+        dict: (measured slide, mask stack, valid cell labels) tuples by name, for collect_slide_features.
+    """
+    logger.info('filtering saturated cells...')
+    qc_tables = qc_tables or {}
+    slides = {}
+    for name, img in images.items():
+        table = qc_tables.get(name)
+        if table is None or not cell_qc.measured_with(table, **QC_SETTINGS):
+            table = tiling.compute_qc_table_tiled(img, masks[name], functools.partial(cell_qc.compute_qc_table, **QC_SETTINGS),
+                                                  BORDER_BUFFER_SIZE, TILE_SIZE, TILE_HALO)
+        valid_labels = table.loc[table['saturated_fraction'] < SAT_FRAC_CUTOFF, 'cell_number'].to_numpy()
+        slides[name] = (img if corrected is None else corrected[name], masks[name], valid_labels)
+    logger.info('saturated cells filtered.')
+    return slides
+
+
+def collect_slide_features(name, slide, STD_THRESHOLD=STD_THRESHOLD):
+    """Cell and puncta features of one whole slide, measured tile by tile.
+
+    Each tile runs collect_image_features and spatial_features on its window, restricted to the
+    cells it owns (see tiling.py), and offsets the coordinates to the slide. The placeholder rows of
+    cells without puncta take the statistics of the whole slide, measured core by core. The rows
+    match those of the full slide, except that cell_coords holds the cell contours of the tile and
+    puncta_nucleus_distance is exact only while the nearest nucleus edge is within the halo.
+
+    Args:
+        name (str): slide name.
+        slide (tuple): (measured slide, mask stack, valid cell labels) from filter_saturated_slides.
+        STD_THRESHOLD (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+
+    Returns:
+        pd.DataFrame: features of every cell of the slide, empty if it has no cells.
+    """
+    measured, mask_stack, valid_labels = slide
+    shape = mask_stack.shape[-2:]
+    tiles = tiling.tile_windows(shape, TILE_SIZE, TILE_HALO)
+    placeholder = placeholder_stats(measured[COI_1], measured[COI_2], windows=[core for core, _ in tiles])
+    results = []
+    for core, window in tiles:
+        masks = as_labels(mask_stack[:, window[0], window[1]])
+        owned = tiling.owned_labels(masks[0], core, window, shape)
+        cells = np.where(np.isin(masks[0], owned[np.isin(owned, valid_labels)]), masks[0], 0)
+        if not cells.any():
+            continue
+        image = np.asarray(measured[:, window[0], window[1]])
+        cells = as_labels(cells)
+        features = collect_image_features(name, (image[COI_2], image[COI_1], cells), STD_THRESHOLD,
+                                          index=label_index.LabelIndex(cells), placeholder=placeholder)
+        features = spatial_features(features, {name: masks})
+
+        origin = tiling.window_origin(window)
+        features['puncta_coords'] = [coords + origin if label > 0 else coords
+                                     for coords, label in zip(features['puncta_coords'], features['puncta_label'])]
+        contour = [line + origin for line in features['cell_coords'].iloc[0]]
+        features['cell_coords'] = [contour] * len(features)
+        results.append(features)
+
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results).sort_values('cell_number', kind='stable', ignore_index=True)
+
+
+def label_sums(values, labels, n_labels):
+    """Per-label pixel count, sum and sum of squares of values, from one bincount each.
+
+    Args:
+        values (np.array): intensities, any shape.
+        labels (np.array): integer labels broadcastable to values.
+        n_labels (int): largest label.
+
+    Returns:
+        tuple: (count, sum, sum of squares), each of length n_labels + 1.
+    """
+    labels = np.broadcast_to(labels, values.shape).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    count = np.bincount(labels, minlength=n_labels + 1)
+    total = np.bincount(labels, weights=values, minlength=n_labels + 1)
+    total_sq = np.bincount(labels, weights=values ** 2, minlength=n_labels + 1)
+    return count, total, total_sq
+
+
+def moments_from_sums(count, total, total_sq):
+    """Mean and population standard deviation (as np.std) from label_sums, NaN for empty labels."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        var = np.maximum(total_sq / count - mean ** 2, 0)
+    return mean, np.sqrt(var)
+
+
+def colocalization_features(coi1, coi2, cells, n_cells, thresholds=MANDERS_THRESHOLDS):
+    """Per-cell Pearson and Manders coefficients between coi1 and coi2, for every cell at once.
+
+    Pearson's r comes from label-indexed sums of each channel, their squares and their product.
+    Manders M1 is the fraction of a cell's coi1 intensity in pixels where coi2 is above its
+    threshold, and M2 the fraction of coi2 intensity where coi1 is above its threshold.
+
+    Args:
+        coi1 (np.array): 2D intensities of the channel of interest.
+        coi2 (np.array): 2D intensities of the secondary channel.
+        cells (np.array): 2D cell labels.
+        n_cells (int): largest cell label.
+        thresholds (dict, optional): Manders threshold per channel name. Defaults to MANDERS_THRESHOLDS.
+
+    Returns:
+        pd.DataFrame: one row per cell with cell_pearson, cell_manders_m1 and cell_manders_m2.
+    """
+    coi1 = np.asarray(coi1, dtype=np.float64)
+    coi2 = np.asarray(coi2, dtype=np.float64)
+    count, sum1, sumsq1 = label_sums(coi1, cells, n_cells)
+    _, sum2, sumsq2 = label_sums(coi2, cells, n_cells)
+    labels = np.asarray(cells).ravel()
+    sum12 = np.bincount(labels, weights=(coi1 * coi2).ravel(), minlength=n_cells + 1)
+    mean1, std1 = moments_from_sums(count, sum1, sumsq1)
+    mean2, std2 = moments_from_sums(count, sum2, sumsq2)
+
+    positive1 = (coi1 > thresholds[COI_1_name]).ravel()
+    positive2 = (coi2 > thresholds[COI_2_name]).ravel()
+    sum1_in2 = np.bincount(labels[positive2], weights=coi1.ravel()[positive2], minlength=n_cells + 1)
+    sum2_in1 = np.bincount(labels[positive1], weights=coi2.ravel()[positive1], minlength=n_cells + 1)
+
+    present = np.flatnonzero(count[1:]) + 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pearson = (sum12 / count - mean1 * mean2) / (std1 * std2)
+        return pd.DataFrame({
+            'cell_number': present,
+            'cell_pearson': pearson[present],
+            'cell_manders_m1': (sum1_in2 / sum1)[present],
+            'cell_manders_m2': (sum2_in1 / sum2)[present],
+        })
+
+
+def sweep_image_thresholds(name, img, std_thresholds=SWEEP_STD_THRESHOLDS, min_sizes=SWEEP_MIN_SIZES):
+    """Per-cell puncta counts and areas of one image for every threshold and minimum size.
+
+    Cell statistics are computed once from label_sums. Each threshold then costs a single
+    labelling of the whole image, with puncta kept apart between cells by labelling the cell ids,
+    and every minimum size is a cut on the bincount areas of that labelling. Puncta match those of
+    collect_image_features for the same STD_THRESHOLD and MIN_PUNCTA_SIZE.
+
+    Args:
+        name (str): image name.
+        img (tuple): (coi2, coi1, cell mask) as returned by filter_saturated_images.
+        std_thresholds (list, optional): thresholds in cell standard deviations. Defaults to SWEEP_STD_THRESHOLDS.
+        min_sizes (list, optional): minimum puncta sizes in pixels. Defaults to SWEEP_MIN_SIZES.
+
+    Returns:
+        pd.DataFrame: one row per cell, threshold and minimum size.
+    """
+    _, coi1, mask = img
+    mask = np.asarray(mask)
+    n_cells = int(mask.max())
+    count, total, total_sq = label_sums(coi1, mask, n_cells)
+    _, std = moments_from_sums(count, total, total_sq)
+    cells = np.flatnonzero(count[1:]) + 1
+
+    results = []
+    for std_threshold in std_thresholds:
+        threshold = np.nan_to_num(std * std_threshold)[mask]
+        puncta = measure.label(np.where((coi1 > threshold) & (mask > 0), mask, 0))
+        areas = np.bincount(puncta.ravel())
+        owner = np.zeros(len(areas), dtype=np.int64)
+        foreground = puncta > 0
+        owner[puncta[foreground]] = mask[foreground]
+        areas, owner = areas[1:], owner[1:]
+
+        for min_size in min_sizes:
+            keep = areas >= min_size
+            puncta_count = np.bincount(owner[keep], minlength=n_cells + 1)[cells]
+            puncta_area = np.bincount(owner[keep], weights=areas[keep], minlength=n_cells + 1)[cells]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean_area = np.where(puncta_count > 0, puncta_area / puncta_count, 0)
+            results.append(pd.DataFrame({
+                'image_name': name, 'cell_number': cells, 'cell_size': count[cells],
+                'std_threshold': std_threshold, 'min_puncta_size': min_size,
+                'puncta_count': puncta_count, 'puncta_area_total': puncta_area, 'puncta_area_mean': mean_area,
+            }))
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def sweep_thresholds(image_dict, std_thresholds=SWEEP_STD_THRESHOLDS, min_sizes=SWEEP_MIN_SIZES):
+    """Run sweep_image_thresholds on every image of filter_saturated_images."""
+    logger.info(f'sweeping {len(std_thresholds)} thresholds and {len(min_sizes)} minimum sizes...')
+    results = [sweep_image_thresholds(name, img, std_thresholds, min_sizes) for name, img in image_dict.items()]
+    return pd.concat([df for df in results if not df.empty], ignore_index=True)
+
+
+def load_stacks(stack_folder):
+    """Memory-map the CZYX z-stacks or TYX/CTYX time-series saved by stage 1, so only the chunks in use are read."""
+    stacks = {}
+    if not os.path.exists(stack_folder):
+        return stacks
+    for fn in os.listdir(stack_folder):
+        if fn.endswith('.npy'):
+            stacks[fn.removesuffix('.npy')] = np.load(f'{stack_folder}/{fn}', mmap_mode='r')
+    return stacks
+
+
+def label_puncta_3d(stack, cells, threshold, z_chunk=Z_CHUNK):
+    """Label puncta voxels of a z-stack chunk by chunk along Z and accumulate per-puncta sums.
+
+    Each chunk is read with one slice of overlap with the previous chunk. Puncta labels in the
+    shared slice link the components of neighbouring chunks, which are merged at the end.
+
+    Args:
+        stack (np.array): CZYX stack, may be memory-mapped.
+        cells (np.array): 2D cell labels, shared by every slice.
+        threshold (np.array): intensity threshold per cell label, np.inf for background.
+        z_chunk (int, optional): slices per chunk. Defaults to Z_CHUNK.
+
+    Returns:
+        pd.DataFrame: one row per puncta with voxel sums, centroid sums and z range.
+    """
+    n_slices = stack.shape[1]
+    threshold_map = threshold[cells]
+    yy, xx = np.indices(cells.shape)
+    offset, prev_last, links, parts = 0, None, [], []
+
+    for z0 in range(0, n_slices, z_chunk):
+        lo, z1 = max(z0 - 1, 0), min(z0 + z_chunk, n_slices)
+        coi1 = np.asarray(stack[COI_1, lo:z1], dtype=np.float64)
+        coi2 = np.asarray(stack[COI_2, lo:z1], dtype=np.float64)
+
+        # puncta never cross cells, as label only joins voxels of the same cell value
+        seeds = np.where(coi1 > threshold_map, cells, 0)
+        local = measure.label(seeds)
+        n_local = int(local.max())
+        labels = np.where(local > 0, local + offset, 0)
+
+        if lo < z0 and prev_last is not None:
+            shared = (labels[0] > 0) & (prev_last > 0)
+            links.append(np.unique(np.stack([prev_last[shared], labels[0][shared]]), axis=1))
+        prev_last = labels[-1]
+
+        own = slice(z0 - lo, None)
+        lbl = local[own]
+        if n_local:
+            zz = np.arange(z0, z1)[:, None, None]
+            count, sum1, sumsq1 = label_sums(coi1[own], lbl, n_local)
+            _, sum2, _ = label_sums(coi2[own], lbl, n_local)
+            flat = lbl.ravel()
+            part = pd.DataFrame({
+                'id': np.arange(1, n_local + 1) + offset,
+                'cell': np.bincount(flat, weights=np.broadcast_to(cells, lbl.shape).ravel(), minlength=n_local + 1)[1:],
+                'volume': count[1:], 'sum1': sum1[1:], 'sumsq1': sumsq1[1:], 'sum2': sum2[1:],
+                'sum_z': np.bincount(flat, weights=np.broadcast_to(zz, lbl.shape).ravel(), minlength=n_local + 1)[1:],
+                'sum_y': np.bincount(flat, weights=np.broadcast_to(yy, lbl.shape).ravel(), minlength=n_local + 1)[1:],
+                'sum_x': np.bincount(flat, weights=np.broadcast_to(xx, lbl.shape).ravel(), minlength=n_local + 1)[1:],
+            })
+            # z range from the slices each label occupies
+            z_idx, lbl_idx = np.nonzero(np.stack([np.bincount(sl.ravel(), minlength=n_local + 1) for sl in lbl])[:, 1:])
+            z_range = pd.DataFrame({'z': z_idx + z0, 'i': lbl_idx}).groupby('i')['z'].agg(['min', 'max'])
+            part['z_min'] = z_range['min'].reindex(np.arange(n_local)).to_numpy()
+            part['z_max'] = z_range['max'].reindex(np.arange(n_local)).to_numpy()
+            part = part[part['volume'] > 0]
+            part['cell'] = np.round(part['cell'] / part['volume']).astype(int)  # every voxel has the same cell
+            parts.append(part)
+        offset += n_local
+
+    if not parts:
+        return pd.DataFrame()
+    puncta = pd.concat(parts, ignore_index=True)
+
+    # merge components linked across chunk boundaries
+    links = np.concatenate(links, axis=1) if links else np.empty((2, 0), dtype=int)
+    graph = coo_matrix((np.ones(links.shape[1]), (links[0], links[1])), shape=(offset + 1, offset + 1))
+    _, component = connected_components(graph, directed=False)
+    puncta['component'] = component[puncta['id']]
+    sums = puncta.groupby('component')[['volume', 'sum1', 'sumsq1', 'sum2', 'sum_z', 'sum_y', 'sum_x']].sum()
+    ranges = puncta.groupby('component').agg(cell=('cell', 'first'), z_min=('z_min', 'min'), z_max=('z_max', 'max'))
+    return sums.join(ranges).reset_index(drop=True)
+
+
+def collect_features_3d(stack_dict, cell_masks, STD_THRESHOLD=STD_THRESHOLD, z_chunk=Z_CHUNK, min_volume=MIN_PUNCTA_VOLUME):
+    """Detect puncta in 3D with voxel-based features, reading each z-stack in chunks along Z.
+
+    Cells are the 2D masks of the MIP, shared by every slice. As in collect_features, the threshold
+    of each cell is STD_THRESHOLD times the standard deviation of its coi1 voxels.
+
+    Args:
+        stack_dict (dict): image name -> CZYX stack, may be memory-mapped.
+        cell_masks (dict): image name -> 2D cell labels of the MIP.
+        STD_THRESHOLD (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+        z_chunk (int, optional): slices per chunk. Defaults to Z_CHUNK.
+        min_volume (int, optional): minimum puncta volume in voxels. Defaults to MIN_PUNCTA_VOLUME.
+
+    Returns:
+        pd.DataFrame: one row per puncta, with a placeholder row for cells without puncta.
+    """
+    logger.info('collecting 3D cell & puncta features...')
+    results = []
+    for name, stack in stack_dict.items():
+        cells = np.asarray(cell_masks[name])
+        n_cells = int(cells.max())
+        if n_cells == 0:
+            continue
+
+        # per-cell voxel statistics over the full depth, chunk by chunk
+        cell_count = np.zeros(n_cells + 1)
+        sum1, sumsq1, sum2 = np.zeros(n_cells + 1), np.zeros(n_cells + 1), np.zeros(n_cells + 1)
+        for z0 in range(0, stack.shape[1], z_chunk):
+            count, s1, sq1 = label_sums(np.asarray(stack[COI_1, z0:z0 + z_chunk]), cells, n_cells)
+            _, s2, _ = label_sums(np.asarray(stack[COI_2, z0:z0 + z_chunk]), cells, n_cells)
+            cell_count, sum1, sumsq1, sum2 = cell_count + count, sum1 + s1, sumsq1 + sq1, sum2 + s2
+        cell_mean, cell_std = moments_from_sums(cell_count, sum1, sumsq1)
+        threshold = cell_std * STD_THRESHOLD
+        threshold[0] = np.inf
+
+        puncta = label_puncta_3d(stack, cells, threshold, z_chunk)
+        if puncta.empty:
+            puncta = pd.DataFrame(columns=['cell', 'volume', 'sum1', 'sumsq1', 'sum2', 'sum_z', 'sum_y', 'sum_x', 'z_min', 'z_max'], dtype=float)
+        puncta = puncta[puncta['volume'] >= min_volume].reset_index(drop=True)
+        volume = puncta['volume'].to_numpy(dtype=float)
+        p_mean, p_std = moments_from_sums(volume, puncta['sum1'].to_numpy(dtype=float), puncta['sumsq1'].to_numpy(dtype=float))
+        df = pd.DataFrame({
+            'puncta_label': np.arange(1, len(puncta) + 1),
+            'cell_number': puncta['cell'].to_numpy(dtype=int),
+            'puncta_volume': volume,
+            'puncta_centroid_z': puncta['sum_z'].to_numpy(dtype=float) / volume,
+            'puncta_centroid_y': puncta['sum_y'].to_numpy(dtype=float) / volume,
+            'puncta_centroid_x': puncta['sum_x'].to_numpy(dtype=float) / volume,
+            'puncta_z_extent': (puncta['z_max'] - puncta['z_min'] + 1).to_numpy(dtype=float),
+            'puncta_cv': p_std / p_mean,
+            'puncta_intensity_mean': p_mean,
+            'puncta_intensity_mean_in_coi2': puncta['sum2'].to_numpy(dtype=float) / volume,
+        })
+
+        # placeholder row for cells without puncta, as in collect_features
+        present = np.unique(cells)[1:]
+        empty = np.setdiff1d(present, df['cell_number'])
+        df = pd.concat([df, pd.DataFrame({'cell_number': empty})], ignore_index=True).fillna(0)
+
+        cell = df['cell_number'].astype(int).to_numpy()
+        df['image_name'] = name
+        df['cell_volume'] = cell_count[cell]
+        df['cell_cv'] = cell_std[cell] / cell_mean[cell]
+        df['cell_coi1_intensity_mean'] = cell_mean[cell]
+        df['cell_coi2_intensity_mean'] = sum2[cell] / cell_count[cell]
+        results.append(df.sort_values(['cell_number', 'puncta_label'], ignore_index=True))
+
+    logger.info('3D feature extraction done.')
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+
+
+def label_puncta_above(frame, cells, threshold, min_size=MIN_PUNCTA_SIZE):
+    """Label pixels above the threshold of their cell, dropping puncta smaller than min_size.
+
+    Args:
+        frame (np.array): 2D intensities.
+        cells (np.array): 2D cell labels.
+        threshold (np.array): threshold per cell label, inf for the background label 0.
+        min_size (int, optional): minimum puncta area in pixels. Defaults to MIN_PUNCTA_SIZE.
+
+    Returns:
+        np.array: puncta labels numbered 1..n in the order measure.label found them.
+    """
+    # puncta never cross cells, as label only joins pixels of the same cell value
+    puncta = measure.label(np.where(frame > threshold[cells], cells, 0))
+    area = np.bincount(puncta.ravel())
+    keep = area >= min_size
+    keep[0] = False
+    relabel = np.zeros(len(area), dtype=np.int64)
+    relabel[keep] = np.arange(1, keep.sum() + 1)
+    return relabel[puncta]
+
+
+def frame_puncta(frame, cells, n_cells, STD_THRESHOLD=STD_THRESHOLD, min_size=MIN_PUNCTA_SIZE):
+    """Detect the puncta of one frame with a fixed cell label map, as in collect_features.
+
+    Args:
+        frame (np.array): 2D intensities of the channel of interest.
+        cells (np.array): 2D cell labels, reused for every frame.
+        n_cells (int): largest cell label.
+        STD_THRESHOLD (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+        min_size (int, optional): minimum puncta area in pixels. Defaults to MIN_PUNCTA_SIZE.
+
+    Returns:
+        pd.DataFrame: one row per puncta with cell, area, centroid and mean intensity.
+    """
+    frame = np.asarray(frame, dtype=np.float64)
+    count, total, total_sq = label_sums(frame, cells, n_cells)
+    _, cell_std = moments_from_sums(count, total, total_sq)
+    threshold = cell_std * STD_THRESHOLD
+    threshold[0] = np.inf
+
+    puncta = label_puncta_above(frame, cells, threshold, min_size)
+    n_puncta = int(puncta.max())
+    yy, xx = np.indices(frame.shape)
+    flat = puncta.ravel()
+    area = np.bincount(flat, minlength=n_puncta + 1)[1:]
+    df = pd.DataFrame({
+        'cell_number': np.bincount(flat, weights=cells.ravel(), minlength=n_puncta + 1)[1:] / area,
+        'puncta_area': area,
+        'puncta_y': np.bincount(flat, weights=yy.ravel(), minlength=n_puncta + 1)[1:] / area,
+        'puncta_x': np.bincount(flat, weights=xx.ravel(), minlength=n_puncta + 1)[1:] / area,
+        'puncta_intensity_mean': np.bincount(flat, weights=frame.ravel(), minlength=n_puncta + 1)[1:] / area,
+    })
+    df['cell_number'] = np.round(df['cell_number']).astype(int)
+    return df
+
+
+def link_frames(prev, curr, max_distance=MAX_LINK_DISTANCE):
+    """Link the puncta of two consecutive frames with KD-tree nearest-neighbour queries.
+
+    Each current puncta links to the nearest previous puncta of the same cell within max_distance;
+    when several current puncta share a previous one (split), only the nearest continues its track.
+    Previous puncta whose own nearest current puncta is the same one have fused into it.
+
+    Returns:
+        tuple: (index of the continued previous puncta or -1 for each current puncta,
+                number of previous puncta fused into each current puncta)
+    """
+    parent = np.full(len(curr), -1)
+    fused = np.zeros(len(curr), dtype=int)
+    if prev.empty or curr.empty:
+        return parent, fused
+
+    prev_xy, curr_xy = prev[['puncta_y', 'puncta_x']].to_numpy(), curr[['puncta_y', 'puncta_x']].to_numpy()
+    prev_cell, curr_cell = prev['cell_number'].to_numpy(), curr['cell_number'].to_numpy()
+
+    # forward links, nearest current puncta keeps the track on a split
+    dist, idx = cKDTree(prev_xy).query(curr_xy, distance_upper_bound=max_distance)
+    valid = np.isfinite(dist)
+    valid[valid] = prev_cell[idx[valid]] == curr_cell[valid]
+    candidates = np.flatnonzero(valid)
+    order = candidates[np.argsort(dist[candidates], kind='stable')]
+    _, first = np.unique(idx[order], return_index=True)
+    parent[order[first]] = idx[order[first]]
+
+    # backward links, several previous puncta sharing one current puncta is a fusion
+    dist, idx = cKDTree(curr_xy).query(prev_xy, distance_upper_bound=max_distance)
+    valid = np.isfinite(dist)
+    valid[valid] = curr_cell[idx[valid]] == prev_cell[valid]
+    n_sources = np.bincount(idx[valid], minlength=len(curr))
+    fused = np.maximum(n_sources - 1, 0)
+    return parent, fused
+
+
+def track_puncta(series_dict, cell_masks, STD_THRESHOLD=STD_THRESHOLD, min_size=MIN_PUNCTA_SIZE, max_distance=MAX_LINK_DISTANCE):
+    """Detect and track puncta frame by frame in time-series, reusing each image's cell label map.
+
+    Frames are streamed from (memory-mapped) TYX or CTYX arrays and only the previous frame's puncta
+    are kept for linking, so cost grows linearly with the number of frames.
+
+    Args:
+        series_dict (dict): image name -> TYX or CTYX array, may be memory-mapped.
+        cell_masks (dict): image name -> 2D cell labels, e.g. from the MIP.
+        STD_THRESHOLD (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+        min_size (int, optional): minimum puncta area in pixels. Defaults to MIN_PUNCTA_SIZE.
+        max_distance (float, optional): largest displacement between frames. Defaults to MAX_LINK_DISTANCE.
+
+    Returns:
+        tuple: tuple containing:
+            - detections (pd.DataFrame): one row per puncta per frame, with track_id and puncta_fused.
+            - tracks (pd.DataFrame): one row per track with lifetime, growth and fusion counts.
+    """
+    logger.info('tracking puncta over time...')
+    detections = []
+    for name, series in series_dict.items():
+        frames = series[COI_1] if series.ndim == 4 else series
+        cells = np.asarray(cell_masks[name])
+        n_cells = int(cells.max())
+        prev, prev_tracks, next_track = pd.DataFrame(), np.array([], dtype=int), 0
+
+        for t in range(frames.shape[0]):
+            curr = frame_puncta(frames[t], cells, n_cells, STD_THRESHOLD, min_size)
+            parent, fused = link_frames(prev, curr, max_distance)
+            tracks = np.full(len(curr), -1)
+            linked = parent >= 0
+            tracks[linked] = prev_tracks[parent[linked]]
+            new = ~linked
+            tracks[new] = np.arange(next_track, next_track + new.sum())
+            next_track += int(new.sum())
+
+            curr['image_name'], curr['frame'] = name, t
+            curr['track_id'], curr['puncta_fused'] = tracks, fused
+            detections.append(curr)
+            prev, prev_tracks = curr, tracks
+
+    detections = pd.concat(detections, ignore_index=True) if detections else pd.DataFrame()
+    logger.info('puncta tracking done.')
+    return detections, summarise_tracks(detections)
+
+
+def summarise_tracks(detections):
+    """Lifetime, area growth rate (least-squares slope per frame) and fusion count of each track."""
+    if detections.empty:
+        return pd.DataFrame()
+    df = detections.assign(frame_area=detections['frame'] * detections['puncta_area'],
+                           frame_sq=detections['frame'] ** 2)
+    tracks = df.groupby(['image_name', 'track_id']).agg(
+        cell_number=('cell_number', 'first'),
+        first_frame=('frame', 'min'),
+        last_frame=('frame', 'max'),
+        lifetime=('frame', 'count'),
+        area_start=('puncta_area', 'first'),
+        area_end=('puncta_area', 'last'),
+        sum_t=('frame', 'sum'),
+        sum_a=('puncta_area', 'sum'),
+        sum_ta=('frame_area', 'sum'),
+        sum_tt=('frame_sq', 'sum'),
+        fusions=('puncta_fused', 'sum'),
+    ).reset_index()
+    n = tracks['lifetime']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tracks['growth_rate'] = (n * tracks['sum_ta'] - tracks['sum_t'] * tracks['sum_a']) / (n * tracks['sum_tt'] - tracks['sum_t'] ** 2)
+    tracks.loc[n < 2, 'growth_rate'] = np.nan
+    return tracks.drop(columns=['sum_t', 'sum_a', 'sum_ta', 'sum_tt'])
+
+
+def collect_multichannel_puncta(image_dict, cell_masks, channels=DETECTION_CHANNELS, STD_THRESHOLD=STD_THRESHOLD, min_size=MIN_PUNCTA_SIZE):
+    """Detect puncta in several channels of each image in one pass and measure their overlap.
+
+    Every channel is thresholded as in collect_features, at STD_THRESHOLD standard deviations of
+    its own cell intensities, from the shared label_sums statistics. All cells are labelled at
+    once, and each puncta is measured in every channel.
+
+    Args:
+        image_dict (dict): image name -> image with shape (channels, height, width).
+        cell_masks (dict): image name -> 2D cell labels, e.g. after filter_saturated_images.
+        channels (dict, optional): channel name -> channel index. Defaults to DETECTION_CHANNELS.
+        STD_THRESHOLD (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+        min_size (int, optional): minimum puncta area in pixels. Defaults to MIN_PUNCTA_SIZE.
+
+    Returns:
+        tuple: tuple containing:
+            - puncta (pd.DataFrame): one row per puncta and channel, with its mean intensity in every
+              channel, the fraction of its area inside puncta of each other channel and the number of
+              those puncta, and the statistics of its cell in every channel.
+            - overlaps (pd.DataFrame): one row per pair of overlapping puncta from two channels, with
+              overlap area and intersection over union.
+    """
+    logger.info(f'detecting puncta in channels {list(channels)}...')
+    puncta_tables, overlap_tables = [], []
+    for name, image in image_dict.items():
+        cells = np.asarray(cell_masks[name])
+        n_cells = int(cells.max())
+        if n_cells == 0:
+            continue
+        values = {ch_name: np.asarray(image[ch], dtype=np.float64) for ch_name, ch in channels.items()}
+
+        # shared per-cell statistics, which also set each channel's thresholds
+        cell_stats, labels = {}, {}
+        for ch_name, frame in values.items():
+            count, total, total_sq = label_sums(frame, cells, n_cells)
+            cell_mean, cell_std = moments_from_sums(count, total, total_sq)
+            threshold = cell_std * STD_THRESHOLD
+            threshold[0] = np.inf
+            cell_stats[ch_name] = (cell_mean, cell_std)
+            labels[ch_name] = label_puncta_above(frame, cells, threshold, min_size)
+
+        yy, xx = np.indices(cells.shape)
+        for ch_name, puncta in labels.items():
+            flat = puncta.ravel()
+            n_puncta = int(flat.max())
+            area = np.bincount(flat, minlength=n_puncta + 1)[1:]
+            df = pd.DataFrame({
+                'image_name': name, 'channel': ch_name,
+                'puncta_label': np.arange(1, n_puncta + 1),
+                'cell_number': np.bincount(flat, weights=cells.ravel(), minlength=n_puncta + 1)[1:] / area,
+                'puncta_area': area,
+                'puncta_y': np.bincount(flat, weights=yy.ravel(), minlength=n_puncta + 1)[1:] / area,
+                'puncta_x': np.bincount(flat, weights=xx.ravel(), minlength=n_puncta + 1)[1:] / area,
+            })
+            df['cell_number'] = np.round(df['cell_number']).astype(int)
+            for other_name, frame in values.items():
+                df[f'puncta_intensity_mean_{other_name}'] = np.bincount(flat, weights=frame.ravel(), minlength=n_puncta + 1)[1:] / area
+
+            for other_name, other in labels.items():
+                if other_name == ch_name:
+                    continue
+                other_flat = other.ravel()
+                both = (flat > 0) & (other_flat > 0)
+                n_other = int(other_flat.max())
+                pairs, overlap_area = np.unique(flat[both] * (n_other + 1) + other_flat[both], return_counts=True)
+                label_a, label_b = pairs // (n_other + 1), pairs % (n_other + 1)
+                df[f'overlap_fraction_{other_name}'] = np.bincount(label_a, weights=overlap_area, minlength=n_puncta + 1)[1:] / area
+                df[f'overlapping_puncta_{other_name}'] = np.bincount(label_a, minlength=n_puncta + 1)[1:]
+
+                # each pair of channels once
+                if list(labels).index(ch_name) < list(labels).index(other_name):
+                    area_b = np.bincount(other_flat, minlength=n_other + 1)
+                    overlap_tables.append(pd.DataFrame({
+                        'image_name': name, 'channel_a': ch_name, 'puncta_label_a': label_a,
+                        'channel_b': other_name, 'puncta_label_b': label_b,
+                        'cell_number': df['cell_number'].to_numpy()[label_a - 1],
+                        'overlap_area': overlap_area,
+                        'iou': overlap_area / (area[label_a - 1] + area_b[label_b] - overlap_area),
+                    }))
+
+            cell = df['cell_number'].to_numpy()
+            for other_name, (cell_mean, cell_std) in cell_stats.items():
+                df[f'cell_{other_name}_intensity_mean'] = cell_mean[cell]
+                df[f'cell_cv_{other_name}'] = cell_std[cell] / cell_mean[cell]
+            puncta_tables.append(df)
+
+    logger.info('multi-channel puncta detection done.')
+    # without any cells, empty tables that still have the key columns
+    puncta = pd.concat(puncta_tables, ignore_index=True) if puncta_tables else pd.DataFrame(
+        columns=['image_name', 'channel', 'puncta_label', 'cell_number', 'puncta_area', 'puncta_y', 'puncta_x'])
+    overlaps = pd.concat(overlap_tables, ignore_index=True) if overlap_tables else pd.DataFrame(
+        columns=['image_name', 'channel_a', 'puncta_label_a', 'channel_b', 'puncta_label_b', 'cell_number',
+                 'overlap_area', 'iou'])
+    return puncta, overlaps
 
 
 def extra_puncta_features(df):
@@ -190,6 +1057,80 @@ def extra_puncta_features(df):
     return df
 
 
+def nearest_same_cell_distance(tree, centroids, cells):
+    """Distance from each puncta to the nearest other puncta in the same cell, NaN if it is alone."""
+    n_puncta = len(centroids)
+    nn_dist = np.full(n_puncta, np.nan)
+    unresolved = np.arange(n_puncta)
+    k = 2
+    while unresolved.size and k <= 2 * n_puncta:
+        k_query = min(k, n_puncta)
+        dist, idx = tree.query(centroids[unresolved], k=k_query)
+        dist, idx = dist.reshape(len(unresolved), -1), idx.reshape(len(unresolved), -1)
+        same = (cells[idx] == cells[unresolved, None]) & (idx != unresolved[:, None])
+        found = same.any(axis=1)
+        nn_dist[unresolved[found]] = np.where(same, dist, np.inf)[found].min(axis=1)
+        if k_query == n_puncta:
+            break
+        # neighbours of other cells came first, look further for the rest
+        unresolved = unresolved[~found]
+        k *= 4
+    return nn_dist
+
+
+def spatial_features(df, masks, radius=RIPLEY_RADIUS):
+    """Add puncta clustering and position features, computed in one batch per image.
+
+    A KD-tree over the puncta centroids of each image gives the nearest-neighbour distance to
+    another puncta of the same cell and the per-cell Ripley's L at the given radius. A signed
+    distance transform of the nucleus mask gives the distance of each puncta centroid to the
+    nearest nucleus edge (negative inside a nucleus), left NaN in images without nuclei.
+
+    Args:
+        df (pd.DataFrame): puncta features from collect_features.
+        masks (dict): image name -> mask stack of (cells, nuclei).
+        radius (float, optional): Ripley's L radius in pixels. Defaults to RIPLEY_RADIUS.
+
+    Returns:
+        pd.DataFrame: df with puncta_nn_distance, puncta_nucleus_distance and cell_ripley_l columns.
+    """
+    df = df.copy()
+    for col in ['puncta_nn_distance', 'puncta_nucleus_distance', 'cell_ripley_l']:
+        df[col] = np.nan
+
+    for name, rows in df.groupby('image_name').groups.items():
+        puncta = df.loc[rows]
+        puncta = puncta[puncta['puncta_label'] > 0]  # cells without puncta have a placeholder row
+        if puncta.empty:
+            continue
+        centroids = np.stack([np.asarray(coords).mean(axis=0) for coords in puncta['puncta_coords']])
+        cells = puncta['cell_number'].to_numpy()
+
+        # signed distance to the nucleus edge, one transform per image, NaN without any nucleus
+        nuclei = np.asarray(masks[name][1]) > 0
+        if nuclei.any():
+            signed_dist = ndimage.distance_transform_edt(~nuclei) - ndimage.distance_transform_edt(nuclei)
+            pixels = np.round(centroids).astype(int)
+            df.loc[puncta.index, 'puncta_nucleus_distance'] = signed_dist[pixels[:, 0], pixels[:, 1]]
+
+        tree = cKDTree(centroids)
+        df.loc[puncta.index, 'puncta_nn_distance'] = nearest_same_cell_distance(tree, centroids, cells)
+
+        # Ripley's K from same-cell pairs within radius, L = sqrt(K / pi)
+        cell_ids, cell_idx = np.unique(cells, return_inverse=True)
+        pairs = tree.query_pairs(radius, output_type='ndarray')
+        pairs = pairs[cell_idx[pairs[:, 0]] == cell_idx[pairs[:, 1]]]
+        n_pairs = np.bincount(cell_idx[pairs[:, 0]], minlength=len(cell_ids))
+        n_puncta = np.bincount(cell_idx, minlength=len(cell_ids))
+        cell_area = puncta.groupby('cell_number')['cell_size'].first().reindex(cell_ids).to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ripley_k = cell_area * 2 * n_pairs / (n_puncta * (n_puncta - 1))
+        ripley_l = np.where(n_puncta > 1, np.sqrt(ripley_k / np.pi), np.nan)
+        df.loc[puncta.index, 'cell_ripley_l'] = ripley_l[cell_idx]
+
+    return df
+
+
 def aggregate_features_by_group(df, group_cols, agg_cols, agg_func='mean'):
     """
     Aggregate multiple columns by group and merge results into a single DataFrame.
@@ -215,6 +1156,48 @@ def aggregate_features_by_group(df, group_cols, agg_cols, agg_func='mean'):
     return merged_df.reset_index(drop=True)
 
 
+def add_metadata(df):
+    """Add tag, condition and rep columns parsed from the image name."""
+    df = df.copy()
+    df['tag'] = df['image_name'].str.split('-').str[0].str.split('_').str[-1]
+    df['condition'] = df['image_name'].str.split('_').str[2].str.split('-').str[0]
+    df['rep'] = df['image_name'].str.split('_').str[-1].str.split('-').str[0]
+    return df
+
+
+def remove_outliers(df, cols=FEATURE_COLS):
+    """Remove rows with a z-score of 3 or more in any of cols, excluding the last one."""
+    return df[(np.abs(stats.zscore(df[cols[:-1]])) < 3).all(axis=1)]
+
+
+def feature_tables(features, cols=FEATURE_COLS):
+    """Puncta features raw, per replicate, normalized, and normalized per replicate, by output file name."""
+    # averages per biological replicate
+    rep_df = aggregate_features_by_group(features, ['condition', 'tag', 'rep'], cols)
+
+    # features normalized to cell intensity of channel of interest
+    df_norm = features.copy()
+    for col in cols:
+        df_norm[col] /= df_norm['cell_coi1_intensity_mean']
+
+    # normalized averages per biological replicate
+    rep_norm_df = aggregate_features_by_group(df_norm, ['condition', 'tag', 'rep'], cols)
+    return {
+        'puncta_features': features,
+        'puncta_features_reps': rep_df,
+        'puncta_features_normalized': df_norm,
+        'puncta_features_normalized_reps': rep_norm_df,
+    }
+
+
+def save_feature_tables(features, cols=FEATURE_COLS):
+    """Save puncta features raw, per replicate, normalized, and normalized per replicate."""
+    tables = feature_tables(features, cols)
+    for table_name, table in tables.items():
+        table.to_csv(f'{output_folder}{table_name}.csv', index=False)
+    return tables
+
+
 # --- Proof Plotting ---
 def generate_proofs(df, image_dict, coi1=COI_1_name, coi2=COI_2_name):
     logger.info('Generating proof plots...')
@@ -249,50 +1232,79 @@ def generate_proofs(df, image_dict, coi1=COI_1_name, coi2=COI_2_name):
 
 if __name__ == '__main__':
     logger.info('loading images and masks...')
-    images = load_images(image_folder)
-    masks = load_masks(mask_folder)
+    mmap_mode = 'r' if TILED_MODE else None  # whole slides stay on disk, tiles are read as needed
+    images = load_images(image_folder, mmap_mode=mmap_mode)
+    masks = load_masks(mask_folder, mmap_mode=mmap_mode)
+    corrected = load_images(background_folder, mmap_mode=mmap_mode) if USE_BACKGROUND_CORRECTION else None
+    qc_tables = load_qc_tables(mask_folder, masks)
 
-    cyto_masks = generate_cytoplasm_masks(masks)
-    filtered = filter_saturated_images(images, cyto_masks, masks)
-    features = collect_features(filtered)
-    features = extra_puncta_features(features)
+    if TILED_MODE:
+        # spatial features are measured per tile, the full-frame modes and proofs below are skipped
+        slides = filter_saturated_slides(images, masks, corrected=corrected, qc_tables=qc_tables)
+        features = collect_features(slides, checkpoint_folder=checkpoint_folder, image_features=collect_slide_features,
+                                    sources={name: input_files(name) for name in slides})
+        features = extra_puncta_features(features)
+    else:
+        indexes = build_label_indexes(masks)
+        cyto_masks = generate_cytoplasm_masks(masks, indexes=indexes)
+        filtered = filter_saturated_images(images, cyto_masks, masks, corrected=corrected, qc_tables=qc_tables, indexes=indexes)
+        features = collect_features(filtered, checkpoint_folder=checkpoint_folder, indexes=indexes,
+                                    sources={name: input_files(name) for name in filtered})
+        features = extra_puncta_features(features)
+        features = spatial_features(features, masks)
 
     # --- data wrangling and saving ---
     logger.info('starting data wrangling and saving...')
-    features['tag'] = features['image_name'].str.split('-').str[0].str.split('_').str[-1]
-    features['condition'] = features['image_name'].str.split('_').str[2].str.split('-').str[0]
-    features['rep'] = features['image_name'].str.split('_').str[-1].str.split('-').str[0]
-
-    cols = features.columns.tolist()
-    cols = [item for item in cols if '_coords' not in item]
-    cols = ['puncta_area', 'puncta_eccentricity', 'puncta_aspect_ratio',
-            'puncta_circularity', 'puncta_cv', 'puncta_skew',
-            'coi2_partition_coeff', 'coi1_partition_coeff',
-            'cell_cv', 'cell_skew']
-    
-    # remove outliers based on z-score
-    features = features[(np.abs(stats.zscore(features[cols[:-1]])) < 3).all(axis=1)]
-
-    # save the main features dataframe
-    features.to_csv(f'{output_folder}puncta_features.csv', index=False)
-
-    # save averages per biological replicate
-    rep_df = aggregate_features_by_group(features, ['condition', 'tag', 'rep'], cols)
-    rep_df.to_csv(f'{output_folder}puncta_features_reps.csv', index=False)
+    features = add_metadata(features)
+    features = remove_outliers(features, FEATURE_COLS)
+    save_feature_tables(features, FEATURE_COLS)
+    logger.info('data wrangling and saving complete.')
 
-    # save features normalized to cell intensity of channel of interest
-    df_norm = features.copy()
-    for col in cols:
-        df_norm[col] /= df_norm['cell_coi1_intensity_mean']
-    df_norm.to_csv(f'{output_folder}puncta_features_normalized.csv', index=False)
+    # --- optional 3D puncta detection on the full z-stacks ---
+    if Z_STACK_MODE and not TILED_MODE:
+        stacks = load_stacks(stack_folder)
+        cell_masks = {name: filtered[f'{name}_mip'][2] for name in stacks if f'{name}_mip' in filtered}
+        features_3d = collect_features_3d({name: stacks[name] for name in cell_masks}, cell_masks)
+        features_3d['coi2_partition_coeff'] = features_3d['puncta_intensity_mean_in_coi2'] / features_3d['cell_coi2_intensity_mean']
+        features_3d['coi1_partition_coeff'] = features_3d['puncta_intensity_mean'] / features_3d['cell_coi1_intensity_mean']
+        features_3d = add_metadata(features_3d)
+        features_3d.to_csv(f'{output_folder}puncta_features_3d.csv', index=False)
+        logger.info('3D puncta features saved.')
 
-    # save normalized averages per biological replicate
-    rep_norm_df = aggregate_features_by_group(df_norm, ['condition', 'tag', 'rep'], cols)
-    rep_norm_df.to_csv(f'{output_folder}puncta_features_normalized_reps.csv', index=False)
+    # --- optional time-lapse puncta tracking on the full time-series ---
+    if TIMESERIES_MODE and not TILED_MODE:
+        series = load_stacks(timeseries_folder)
+        cell_masks = {name: filtered[f'{name}_mip'][2] for name in series if f'{name}_mip' in filtered}
+        detections, tracks = track_puncta({name: series[name] for name in cell_masks}, cell_masks)
+        detections.to_csv(f'{output_folder}puncta_detections_timeseries.csv', index=False)
+        tracks.to_csv(f'{output_folder}puncta_tracks_timeseries.csv', index=False)
+        tracks.groupby(['image_name', 'cell_number']).agg(
+            track_count=('track_id', 'count'), mean_lifetime=('lifetime', 'mean'),
+            mean_growth_rate=('growth_rate', 'mean'), fusion_count=('fusions', 'sum'),
+        ).reset_index().to_csv(f'{output_folder}percell_tracks_timeseries.csv', index=False)
+        logger.info('time-lapse puncta tracks saved.')
 
-    logger.info('data wrangling and saving complete.')
+    # --- optional puncta detection in several channels ---
+    if MULTICHANNEL_MODE and not TILED_MODE:
+        measured = corrected if corrected is not None else images
+        multichannel, overlaps = collect_multichannel_puncta(
+            {name: measured[name] for name in filtered}, {name: img[2] for name, img in filtered.items()})
+        add_metadata(multichannel).to_csv(f'{output_folder}puncta_features_multichannel.csv', index=False)
+        overlaps.to_csv(f'{output_folder}puncta_overlaps_multichannel.csv', index=False)
+        logger.info('multi-channel puncta features saved.')
+
+    # --- optional threshold and minimum size sweep ---
+    if SWEEP_MODE and not TILED_MODE:
+        sweep = sweep_thresholds(filtered)
+        sweep.to_csv(f'{output_folder}puncta_threshold_sweep.csv', index=False)
+        sweep.groupby(['image_name', 'std_threshold', 'min_puncta_size']).agg(
+            cell_count=('cell_number', 'count'), puncta_count=('puncta_count', 'sum'),
+            puncta_area_total=('puncta_area_total', 'sum'),
+        ).reset_index().to_csv(f'{output_folder}puncta_threshold_sweep_summary.csv', index=False)
+        logger.info('threshold sweep saved.')
 
     # --- generate proofs ---
-    generate_proofs(features, filtered, coi1=COI_1, coi2=COI_2)
+    if not TILED_MODE:
+        generate_proofs(features, filtered, coi1=COI_1, coi2=COI_2)
 
     logger.info('pipeline complete.')
@@ -23,6 +23,20 @@ logger.info('import ok')
 # configuration
 input_folder = 'results/summary_calculations/'
 output_folder = 'results/summary_calculations/'
+# features of interest (excluding metadata columns), the last one is not used for outlier removal
+PERCELL_FEATURES = ['cell_size', 'mean_puncta_area', 'puncta_area_proportion', 'puncta_count',
+    'puncta_mean_minor_axis', 'puncta_mean_major_axis', 'avg_eccentricity',
+    'puncta_cv_mean', 'puncta_skew_mean', 'coi2_partition_coeff', 'coi1_partition_coeff',
+    'cell_cv', 'cell_skew', 'cell_coi1_intensity_mean']
+# puncta columns only in tables from newer versions of stage 4, averaged per cell when present
+OPTIONAL_COLUMNS = ['puncta_nn_distance', 'puncta_nucleus_distance', 'cell_ripley_l',
+                    'cell_pearson', 'cell_manders_m1', 'cell_manders_m2']
+PERCELL_FILENAMES = {
+    'percell': 'percell_puncta_features.csv',
+    'percell_reps': 'percell_puncta_features_reps.csv',
+    'percell_norm': 'percell_puncta_features_normalized.csv',
+    'percell_norm_reps': 'percell_puncta_features_normalized_reps.csv',
+}
 
 
 def calculate_cell_features(df):
@@ -31,7 +45,7 @@ def calculate_cell_features(df):
     group_cols = ['image_name', 'cell_number']
 
     # Use pandas groupby + agg with named aggregations
-    agg_df = df.groupby(group_cols).agg({
+    aggregations = {
         'puncta_minor_axis_length': 'mean',
         'puncta_major_axis_length': 'mean',
         'puncta_area': ['mean', 'sum', 'count'],
@@ -43,8 +57,16 @@ def calculate_cell_features(df):
         'coi1_partition_coeff': 'mean',
         'cell_cv': 'mean',
         'cell_skew': 'mean',
-        'cell_coi1_intensity_mean': 'mean'
-    })
+        'cell_coi1_intensity_mean': 'mean',
+        'puncta_nn_distance': 'mean',
+        'puncta_nucleus_distance': 'mean',
+        'cell_ripley_l': 'mean',
+        'cell_pearson': 'mean',
+        'cell_manders_m1': 'mean',
+        'cell_manders_m2': 'mean'
+    }
+    aggregations = {col: how for col, how in aggregations.items() if col not in OPTIONAL_COLUMNS or col in df.columns}
+    agg_df = df.groupby(group_cols).agg(aggregations)
 
     # Flatten MultiIndex columns from aggregation
     agg_df.columns = ['_'.join(col).strip() if isinstance(col, tuple) else col 
@@ -68,56 +90,70 @@ def calculate_cell_features(df):
         'cell_cv_mean': 'cell_cv',
         'cell_skew_mean': 'cell_skew',
         'cell_coi1_intensity_mean_mean': 'cell_coi1_intensity_mean',
-        'cell_size_mean': 'cell_size'
+        'cell_size_mean': 'cell_size',
+        'puncta_nn_distance_mean': 'puncta_mean_nn_distance',
+        'puncta_nucleus_distance_mean': 'puncta_mean_nucleus_distance',
+        'cell_ripley_l_mean': 'cell_ripley_l',
+        'cell_pearson_mean': 'cell_pearson',
+        'cell_manders_m1_mean': 'cell_manders_m1',
+        'cell_manders_m2_mean': 'cell_manders_m2'
     })
 
     return agg_df
 
 
-def save_dataframes(df, features, group_cols=['condition', 'tag', 'rep']):
-    # Save raw summary per cell
-    df.to_csv(f'{output_folder}percell_puncta_features.csv', index=False)
+def percell_summary(feature_information):
+    """Per-cell features with metadata, outliers removed.
+
+    Args:
+        feature_information (pd.DataFrame): puncta features as saved by stage 4.
+
+    Returns:
+        pd.DataFrame: one row per cell.
+    """
+    # Calculate summarized features per cell
+    summary = calculate_cell_features(feature_information)
+
+    # Add metadata columns
+    summary['tag'] = summary['image_name'].str.split('-').str[0].str.split('_').str[-1]
+    summary['condition'] = summary['image_name'].str.split('_').str[2].str.split('-').str[0]
+    summary['rep'] = summary['image_name'].str.split('_').str[-1].str.split('-').str[0]
+
+    # remove outliers based on z-score
+    return summary[(np.abs(stats.zscore(summary[PERCELL_FEATURES[:-1]])) < 3).all(axis=1)]
+
 
+def percell_tables(df, features, group_cols=['condition', 'tag', 'rep']):
+    """Per-cell features raw, per replicate, normalized, and normalized per replicate."""
     # Average by biological replicate using the aggregate_features_by_group function
     rep_df = aggregate_features_by_group(df, group_cols, features)
-    rep_df.to_csv(f'{output_folder}percell_puncta_features_reps.csv', index=False)
 
     # Normalize to cell_coi1_intensity_mean
     df_norm = df.copy()
     for col in features:
         df_norm[col] = df_norm[col] / df_norm['cell_coi1_intensity_mean']
 
-    df_norm.to_csv(f'{output_folder}percell_puncta_features_normalized.csv', index=False)
-
     # Average normalized data by biological replicate
     rep_norm_df = aggregate_features_by_group(df_norm, group_cols, features)
-    rep_norm_df.to_csv(f'{output_folder}percell_puncta_features_normalized_reps.csv', index=False)
+    return {'percell': df, 'percell_reps': rep_df, 'percell_norm': df_norm, 'percell_norm_reps': rep_norm_df}
+
+
+def save_dataframes(df, features, group_cols=['condition', 'tag', 'rep']):
+    """Save per-cell features raw, per replicate, normalized, and normalized per replicate."""
+    tables = percell_tables(df, features, group_cols)
+    for table_name, table in tables.items():
+        table.to_csv(f'{output_folder}{PERCELL_FILENAMES[table_name]}', index=False)
+    return tables
 
 
 if __name__ == '__main__':
     # Load feature information
     feature_information = pd.read_csv(f'{input_folder}puncta_features.csv')
 
-    # Calculate summarized features per cell
-    summary = calculate_cell_features(feature_information)
-
-    # Add metadata columns
-    summary['tag'] = summary['image_name'].str.split('-').str[0].str.split('_').str[-1]
-    summary['condition'] = summary['image_name'].str.split('_').str[2].str.split('-').str[0]
-    summary['rep'] = summary['image_name'].str.split('_').str[-1].str.split('-').str[0]
-
-    # Define features of interest (excluding metadata columns)
-    cols = summary.columns.tolist()
-    cols = [item for item in cols if '_coords' not in item]
-    cols = ['cell_size', 'mean_puncta_area', 'puncta_area_proportion', 'puncta_count',
-        'puncta_mean_minor_axis', 'puncta_mean_major_axis', 'avg_eccentricity',
-        'puncta_cv_mean', 'puncta_skew_mean', 'coi2_partition_coeff', 'coi1_partition_coeff',
-        'cell_cv', 'cell_skew', 'cell_coi1_intensity_mean']
-
-    # remove outliers based on z-score
-    summary = summary[(np.abs(stats.zscore(summary[cols[:-1]])) < 3).all(axis=1)]
+    # Calculate summarized features per cell, with metadata and without outliers
+    summary = percell_summary(feature_information)
 
     # Save dataframes (raw, averaged, normalized, normalized averaged)
-    save_dataframes(summary, cols)
+    save_dataframes(summary, PERCELL_FEATURES)
 
-    logger.info('saved puncta feature averaged-per-cell dataframes')
\ No newline at end of file
+    logger.info('saved puncta feature averaged-per-cell dataframes')
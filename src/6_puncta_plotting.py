@@ -1,10 +1,20 @@
 import os
+import sys
+import importlib.util
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 from itertools import combinations
 from statannotations.Annotator import Annotator
 from loguru import logger
+# special import, path to script
+group_stats_path = 'src/group_stats.py'
+
+# load the module dynamically to test every feature x pair in one batch before plotting
+spec = importlib.util.spec_from_file_location('group_stats', group_stats_path)
+group_stats = importlib.util.module_from_spec(spec)
+sys.modules['group_stats'] = group_stats
+spec.loader.exec_module(group_stats)
 
 logger.info('import ok')
 
@@ -15,6 +25,8 @@ sns.set_palette('Paired')
 # configuration
 input_folder = 'results/summary_calculations/'
 output_folder = 'results/plotting/'
+STATS_TEST = group_stats.TEST  # 'mann-whitney', 'permutation' or 'bootstrap'
+STATS_CORRECTION = group_stats.CORRECTION  # corrected across all features and pairs of one figure
 
 os.makedirs(output_folder, exist_ok=True)
 
@@ -32,7 +44,14 @@ def load_summary_data(input_folder):
     }
 
 # --- Plotting Functions ---
-def plot_stats(data_raw, data_agg, features, title, save_name, x='condition', hue='tag', pairs=None, order=None):
+def stats_pairs(stats_table, feature, x='condition', hue='tag'):
+    """Read the tested pairs and their corrected p-values of one feature from a group_stats table."""
+    rows = stats_table[stats_table['feature'] == feature]
+    pairs = [((row[f'{x}_1'], row[f'{hue}_1']), (row[f'{x}_2'], row[f'{hue}_2'])) for _, row in rows.iterrows()]
+    return pairs, rows['p_adjusted'].tolist()
+
+
+def plot_stats(data_raw, data_agg, features, title, save_name, x='condition', hue='tag', stats_table=None, order=None):
     fig, axes = plt.subplots(nrows=5, ncols=3, figsize=(15, 15))
     axes = axes.flatten()
 
@@ -48,11 +67,14 @@ def plot_stats(data_raw, data_agg, features, title, save_name, x='condition', hu
         ax.legend_.remove()
         sns.despine()
 
-        if pairs:
-            annotator = Annotator(ax, pairs, data=data_agg, x=x, y=feature, hue=hue, order=order)
-            annotator.configure(test='Mann-Whitney', verbose=0)
-            annotator.apply_test()
-            annotator.annotate()
+        if stats_table is not None:
+            # p-values were tested and corrected beforehand, the annotator only draws them
+            pairs, pvalues = stats_pairs(stats_table, feature, x=x, hue=hue)
+            if pairs:
+                annotator = Annotator(ax, pairs, data=data_agg, x=x, y=feature, hue=hue, order=order)
+                annotator.configure(test=None, text_format='star', verbose=0)
+                annotator.set_pvalues(pvalues)
+                annotator.annotate()
 
     for ax in axes[len(features):]:
         ax.axis('off')
@@ -124,10 +146,17 @@ def plot_partition_coefficients(data_raw, data_agg, save_name, x='tag', hue='con
     plt.close(g.fig)
 
 
-if __name__ == '__main__':
-    logger.info('Loading data...')
-    dfs = load_summary_data(input_folder)
+def plot_all(dfs):
+    """Generate every summary figure from the eight summary tables of stages 4 and 5.
+
+    The paired tag comparisons of every figure are tested first and saved as group_stats.csv.
+
+    Args:
+        dfs (dict): tables by name, as returned by load_summary_data.
 
+    Returns:
+        pd.DataFrame: the group_stats table, one row per figure, feature and pair.
+    """
     puncta_features = ['puncta_area', 'puncta_eccentricity', 'puncta_aspect_ratio',
                 'puncta_circularity', 'puncta_cv', 'puncta_skew',
                 'coi2_partition_coeff', 'coi1_partition_coeff',
@@ -155,10 +184,18 @@ if __name__ == '__main__':
         ('per cell, normalized', percell_features, dfs['percell_norm'], dfs['percell_norm_reps'], 'tag-paired_percell_normalized.png'),
     ]
 
+    logger.info('Testing paired tags...')
+    stats_tables = {}
+    for title, features, raw_df, reps_df, filename in plotting_configs:
+        stats_tables[title] = group_stats.compare_groups(reps_df, features, paired_conditions, x='condition', hue='tag',
+                                                         test=STATS_TEST, correction=STATS_CORRECTION)
+    stats = pd.concat(stats_tables, names=['dataset']).reset_index(level=0)
+    stats.to_csv(os.path.join(output_folder, 'group_stats.csv'), index=False)
+
     logger.info('Generating paired tag plots with stats...')
     for title, features, raw_df, reps_df, filename in plotting_configs:
         plot_stats(raw_df, reps_df, features, f'Calculated Parameters - {title}', filename,
-                   x='condition', hue='tag', pairs=paired_conditions, order=order)
+                   x='condition', hue='tag', stats_table=stats_tables[title], order=order)
 
     logger.info('Generating paired condition plots (no stats)...')
     for title, features, raw_df, reps_df, filename in plotting_configs:
@@ -168,3 +205,10 @@ if __name__ == '__main__':
 
     logger.info('Generating partition coefficient plots...')
     plot_partition_coefficients(dfs['percell'], dfs['percell_reps'], 'condition-paired_percell_raw_partition-only.png', order=order)
+    return stats
+
+
+if __name__ == '__main__':
+    logger.info('Loading data...')
+    dfs = load_summary_data(input_folder)
+    plot_all(dfs)
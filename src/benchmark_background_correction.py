@@ -0,0 +1,76 @@
+"""
+Benchmark the downsampled background estimate of stage 1b against a full-resolution opening
+"""
+
+import os
+import time
+import importlib.util
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from loguru import logger
+
+# special import, path to script
+background_path = 'src/1b_background_correction.py'
+
+# load the module dynamically, due to the annoying file name
+spec = importlib.util.spec_from_file_location('background_correction', background_path)
+background_correction = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(background_correction)
+estimate_background = background_correction.estimate_background
+BALL_RADIUS = background_correction.BALL_RADIUS
+
+logger.info('import ok')
+
+# configuration
+IMAGE_SIZE = 2048
+N_PUNCTA = 2000
+N_REPEATS = 5
+output_folder = 'results/benchmarks/'
+
+
+def synthetic_channel(image_size=IMAGE_SIZE, n_puncta=N_PUNCTA, seed=0):
+    """Build a noisy uint16 channel with uneven illumination and bright puncta, and its true background."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:image_size, :image_size]
+    illumination = 1000 + 800 * np.exp(-((yy - 0.3 * image_size) ** 2 + (xx - 0.6 * image_size) ** 2)
+                                       / (2 * (0.4 * image_size) ** 2))
+    channel = rng.normal(illumination, 30)
+    for y, x in rng.integers(0, image_size, size=(n_puncta, 2)):
+        channel[y:y + 6, x:x + 6] += 2000
+    return np.clip(channel, 0, 65535).astype(np.uint16), illumination
+
+
+def time_it(func, n_repeats=N_REPEATS):
+    """Return the best wall time over n_repeats and the last result."""
+    best = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_benchmark():
+    channel, illumination = synthetic_channel()
+    values = channel.astype(np.float32)
+    size = 2 * BALL_RADIUS + 1
+    results = []
+
+    estimators = {
+        'full resolution opening': (lambda: ndimage.grey_opening(values, size=(size, size), mode='nearest'), 1),
+        'downsampled opening': (lambda: estimate_background(values), N_REPEATS),
+    }
+    for method, (func, n_repeats) in estimators.items():
+        seconds, background = time_it(func, n_repeats)
+        error = background - illumination
+        results.append({'method': method, 'seconds': seconds,
+                        'bias': error.mean(), 'mean_abs_error': np.abs(error).mean()})
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    os.makedirs(output_folder, exist_ok=True)
+    summary = run_benchmark()
+    logger.info(f'background correction benchmark:\n{summary.to_string(index=False)}')
+    summary.to_csv(f'{output_folder}background_correction_benchmark.csv', index=False)
@@ -0,0 +1,113 @@
+"""
+Benchmark memory and bandwidth of the previous platform-int dtypes against the compact dtype policy
+"""
+
+import os
+import sys
+import time
+import importlib.util
+import numpy as np
+import pandas as pd
+from skimage.transform import resize
+from loguru import logger
+
+# special import, path to script
+dtype_policy_path = 'src/dtype_policy.py'
+
+# load the module dynamically to share the dtype policy between stages
+spec = importlib.util.spec_from_file_location('dtype_policy', dtype_policy_path)
+dtype_policy = importlib.util.module_from_spec(spec)
+sys.modules['dtype_policy'] = dtype_policy
+spec.loader.exec_module(dtype_policy)
+as_labels = dtype_policy.as_labels
+as_intensity = dtype_policy.as_intensity
+
+logger.info('import ok')
+
+# configuration
+IMAGE_SIZE = 2048
+N_CELLS = 150
+N_REPEATS = 5
+output_folder = 'results/benchmarks/'
+
+
+def synthetic_field(image_size=IMAGE_SIZE, n_cells=N_CELLS, seed=0):
+    """Build a synthetic 3-channel uint16 image with square cells and nuclei."""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(100, 4000, size=(3, image_size, image_size), dtype=np.uint16)
+    cells = np.zeros((image_size, image_size), dtype=np.uint16)
+    nuclei = np.zeros_like(cells)
+    side = int(np.sqrt(n_cells))
+    step = image_size // side
+    lbl = 1
+    for row in range(side):
+        for col in range(side):
+            y, x = row * step, col * step
+            cells[y + 2:y + step - 2, x + 2:x + step - 2] = lbl
+            nuclei[y + step // 3:y + 2 * step // 3, x + step // 3:x + 2 * step // 3] = lbl
+            lbl += 1
+    return image, np.stack([cells, nuclei])
+
+
+def time_it(func, n_repeats=N_REPEATS):
+    """Return the best wall time over n_repeats and the last result."""
+    best = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def cytoplasm_mask(cell_mask, nuc_mask, binary_dtype, zero_dtype):
+    """Per-label cytoplasm mask, as in generate_cytoplasm_masks, with the given intermediate dtypes."""
+    cell_bin = (cell_mask > 0).astype(binary_dtype)
+    nuc_bin = (nuc_mask > 0).astype(binary_dtype)
+    single_cyto = []
+    for lbl in np.unique(cell_mask)[1:]:
+        cyto = np.where(cell_mask == lbl, cell_bin, 0).astype(binary_dtype)
+        cyto_minus_nuc = cyto & ~nuc_bin
+        single_cyto.append(np.where(cyto_minus_nuc, lbl, 0).astype(zero_dtype))
+    return sum(single_cyto)
+
+
+def run_benchmark():
+    image, masks = synthetic_field()
+    results = []
+
+    def record(step, dtype, seconds, arrays):
+        nbytes = sum(arr.nbytes for arr in arrays)
+        results.append({'step': step, 'dtype': dtype, 'seconds': seconds, 'MB': nbytes / 1e6})
+
+    # label masks as saved by stage 2
+    seconds, out = time_it(lambda: masks.astype(int))
+    record('label masks', 'int64', seconds, [out])
+    seconds, out = time_it(lambda: as_labels(masks.astype(int)))
+    record('label masks', str(out.dtype), seconds, [out])
+
+    # cytoplasm masks in stage 4
+    seconds, out = time_it(lambda: cytoplasm_mask(masks[0].astype(int), masks[1].astype(int), int, int), n_repeats=1)
+    record('cytoplasm masks', 'int64', seconds, [out])
+    seconds, out = time_it(lambda: cytoplasm_mask(masks[0], masks[1], bool, masks.dtype), n_repeats=1)
+    record('cytoplasm masks', str(out.dtype), seconds, [out])
+
+    # stack of intensities and cell masks in filter_saturated_images
+    seconds, out = time_it(lambda: np.stack([image[0], image[1], masks[0].astype(int)]))
+    record('saturation stack', 'int64', seconds, [out])
+    seconds, out = time_it(lambda: (image[0], image[1], as_labels(masks[0])))
+    record('saturation stack', 'uint16 tuple', seconds, list(out))
+
+    # resampled intensities in the big_images path
+    seconds, out = time_it(lambda: resize(image[0], (1024, 1024), preserve_range=True), n_repeats=1)
+    record('resized intensities', 'float64', seconds, [out])
+    seconds, out = time_it(lambda: as_intensity(resize(image[0], (1024, 1024), preserve_range=True)), n_repeats=1)
+    record('resized intensities', str(out.dtype), seconds, [out])
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    os.makedirs(output_folder, exist_ok=True)
+    summary = run_benchmark()
+    logger.info(f'dtype policy benchmark:\n{summary.to_string(index=False)}')
+    summary.to_csv(f'{output_folder}dtype_policy_benchmark.csv', index=False)
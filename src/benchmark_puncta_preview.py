@@ -0,0 +1,106 @@
+"""
+Benchmark the napari puncta preview against the 100 ms budget per slider change, and check its
+puncta against stage 4 detection on the same field
+"""
+
+import os
+import sys
+import time
+import importlib.util
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# special import, path to script
+puncta_preview_path = 'src/puncta_preview.py'
+
+# load the module dynamically, it loads stage 4 for its settings
+spec = importlib.util.spec_from_file_location('puncta_preview', puncta_preview_path)
+puncta_preview = importlib.util.module_from_spec(spec)
+sys.modules['puncta_preview'] = puncta_preview
+spec.loader.exec_module(puncta_preview)
+puncta_detection = puncta_preview.puncta_detection
+
+logger.info('import ok')
+
+# configuration
+IMAGE_SIZE = 2048
+N_CELLS_SIDE = 16  # cells per side of the synthetic field
+N_PUNCTA = 4000
+BUDGET_SECONDS = 0.1  # per slider change
+SLIDER_THRESHOLDS = [3.0, 3.4, 3.8, 4.2, 4.6]
+SLIDER_MIN_SIZES = [4, 8, 16, 32]
+output_folder = 'results/benchmarks/'
+
+
+def synthetic_field(image_size=IMAGE_SIZE, n_side=N_CELLS_SIDE, n_puncta=N_PUNCTA, seed=0):
+    """Build a uint16 image with a grid of square cells and bright puncta, and its cell labels."""
+    rng = np.random.default_rng(seed)
+    channel = rng.normal(300, 40, (image_size, image_size))
+    cells = np.zeros((image_size, image_size), dtype=np.uint16)
+    step = image_size // n_side
+    for i in range(n_side):
+        for j in range(n_side):
+            cells[i * step + 3:(i + 1) * step - 3, j * step + 3:(j + 1) * step - 3] = i * n_side + j + 1
+    for y, x in rng.integers(0, image_size - 8, size=(n_puncta, 2)):
+        size = rng.integers(2, 8)
+        channel[y:y + size, x:x + size] += rng.uniform(1500, 4000)
+    image = np.zeros((puncta_preview.COI + 1, image_size, image_size), dtype=np.uint16)
+    image[puncta_preview.COI] = np.clip(channel, 0, 65535)
+    return image, cells
+
+
+def time_steps(func, arguments):
+    """Wall time of func for each argument in turn, as slider steps."""
+    seconds = []
+    for argument in arguments:
+        start = time.perf_counter()
+        func(argument)
+        seconds.append(time.perf_counter() - start)
+    return np.array(seconds)
+
+
+def stage4_counts(image, cells, std_threshold, min_size):
+    """Puncta count and total area per cell from the stage 4 threshold sweep, as collect_features counts them."""
+    channel = image[puncta_preview.COI]
+    sweep = puncta_detection.sweep_image_thresholds('benchmark', (channel, channel, cells), [std_threshold], [min_size])
+    return sweep.set_index('cell_number')[['puncta_count', 'puncta_area_total']].set_axis(['count', 'sum'], axis=1)
+
+
+def preview_counts(labels, cells):
+    """Puncta count and total area per cell from preview labels."""
+    areas = np.bincount(labels.ravel())
+    puncta = np.flatnonzero(areas[1:]) + 1
+    # each puncta lies in one cell, read the cell of its first pixel
+    first_pixel = np.unique(labels.ravel(), return_index=True)[1][1:]
+    df = pd.DataFrame({'cell_number': cells.ravel()[first_pixel], 'area': areas[puncta]})
+    return df.groupby('cell_number')['area'].agg(['count', 'sum'])
+
+
+def run_benchmark():
+    image, cells = synthetic_field()
+    start = time.perf_counter()
+    preview = puncta_preview.PunctaPreview(image[puncta_preview.COI], cells)
+    cache_seconds = time.perf_counter() - start
+
+    threshold_seconds = time_steps(lambda t: preview.puncta(t, puncta_preview.MIN_PUNCTA_SIZE), SLIDER_THRESHOLDS)
+    size_seconds = time_steps(lambda s: preview.puncta(SLIDER_THRESHOLDS[-1], s), SLIDER_MIN_SIZES)
+
+    labels = preview.puncta(puncta_preview.STD_THRESHOLD, puncta_preview.MIN_PUNCTA_SIZE)
+    reference = stage4_counts(image, cells, puncta_preview.STD_THRESHOLD, puncta_preview.MIN_PUNCTA_SIZE)
+    counts = preview_counts(labels, cells).reindex(reference.index, fill_value=0)
+    matching_cells = int((counts == reference).all(axis=1).sum())
+    logger.info(f'preview matches stage 4 puncta count and area in {matching_cells} of {len(reference)} cells')
+
+    return pd.DataFrame([
+        {'step': 'cache cell statistics', 'seconds': cache_seconds},
+        {'step': 'threshold slider change', 'seconds': threshold_seconds.max()},
+        {'step': 'minimum size slider change', 'seconds': size_seconds.max()},
+    ]).assign(within_budget=lambda df: df['seconds'] < BUDGET_SECONDS)
+
+
+if __name__ == '__main__':
+    os.makedirs(output_folder, exist_ok=True)
+    summary = run_benchmark()
+    logger.info(f'puncta preview benchmark:\n{summary.to_string(index=False)}')
+    summary.to_csv(f'{output_folder}puncta_preview_benchmark.csv', index=False)
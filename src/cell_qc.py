@@ -0,0 +1,86 @@
+"""
+Per-cell quality-control table, measured once per mask and shared by stages 3 and 4.
+
+Every measurement is a bincount over the cell labels, so a whole image takes one pass per
+column instead of one boolean mask per cell. Stage 3 saves the table of each validated mask as
+<image_name>_qc.csv next to the mask, and stage 4 filters cells by looking the table up. The
+thresholds come from the calling stage and are saved in the table, so stage 4 only uses a table
+measured with its own thresholds.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+QC_SUFFIX = '_qc.csv'
+
+
+def qc_path(folder, image_name):
+    return os.path.join(folder, f'{image_name}{QC_SUFFIX}')
+
+
+def border_labels(cells, buffer_size):
+    """Labels with pixels in the border frame that clear_border clears for the same buffer_size."""
+    frame = np.ones(cells.shape, dtype=bool)
+    width = buffer_size + 1
+    frame[width:-width, width:-width] = False
+    labels = np.unique(cells[frame])
+    return labels[labels > 0]
+
+
+def compute_qc_table(image_stack, mask_stack, coi, saturation_threshold, fluoro_threshold, border_buffer):
+    """Measure every cell of one image.
+
+    Args:
+        image_stack (np.array): image with shape (channels, height, width).
+        mask_stack (np.array): cell and nuclei masks with shape (2, height, width).
+        coi (int): channel checked for saturation and brightness.
+        saturation_threshold (int): intensity above which a pixel is saturated.
+        fluoro_threshold (int): intensity above which a pixel is bright.
+        border_buffer (int): buffer_size of the border check.
+
+    Returns:
+        pd.DataFrame: one row per cell with cell_number, pixel_count, saturated_fraction,
+        bright_fraction, border_contact, nucleus_area, and the checked channel and thresholds
+        as coi, saturation_threshold, fluoro_threshold and border_buffer.
+    """
+    cells = np.asarray(mask_stack[0])
+    flat = cells.ravel()
+    channel = np.asarray(image_stack[coi]).ravel()
+    minlength = int(flat.max()) + 1
+
+    pixel_count = np.bincount(flat, minlength=minlength)
+    saturated = np.bincount(flat[channel > saturation_threshold], minlength=minlength)
+    bright = np.bincount(flat[channel > fluoro_threshold], minlength=minlength)
+    nucleus_area = np.bincount(flat[np.asarray(mask_stack[1]).ravel() > 0], minlength=minlength)
+    border = np.zeros(minlength, dtype=bool)
+    border[border_labels(cells, border_buffer)] = True
+
+    labels = np.flatnonzero(pixel_count[1:]) + 1
+    return pd.DataFrame({
+        'cell_number': labels,
+        'pixel_count': pixel_count[labels],
+        'saturated_fraction': saturated[labels] / pixel_count[labels],
+        'bright_fraction': bright[labels] / pixel_count[labels],
+        'border_contact': border[labels],
+        'nucleus_area': nucleus_area[labels],
+        'coi': coi,
+        'saturation_threshold': saturation_threshold,
+        'fluoro_threshold': fluoro_threshold,
+        'border_buffer': border_buffer,
+    })
+
+
+def measured_with(table, **settings):
+    """Whether every cell of table was measured with settings, e.g. coi=1, False for tables saved without them."""
+    return all(col in table and (table[col] == value).all() for col, value in settings.items())
+
+
+def save_qc_table(folder, image_name, table):
+    table.to_csv(qc_path(folder, image_name), index=False)
+
+
+def load_qc_table(folder, image_name):
+    """Read the saved table of one image, None if there is none."""
+    path = qc_path(folder, image_name)
+    return pd.read_csv(path) if os.path.exists(path) else None
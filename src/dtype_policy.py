@@ -0,0 +1,48 @@
+"""
+Shared dtype policy for masks and intermediate arrays across the pipeline.
+
+- label masks: smallest of uint16/uint32 that holds the largest label
+- binary masks: bool
+- resampled intensities: float32
+"""
+
+import numpy as np
+
+LABEL_DTYPES = (np.uint16, np.uint32)
+BINARY_DTYPE = np.bool_
+INTENSITY_DTYPE = np.float32
+
+
+def label_dtype(max_label):
+    """Return the smallest label dtype that can hold max_label.
+
+    Args:
+        max_label (int): largest label value to be stored.
+
+    Returns:
+        np.dtype: np.uint16 or np.uint32.
+    """
+    for dtype in LABEL_DTYPES:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f'label {max_label} does not fit in {LABEL_DTYPES[-1].__name__}')
+
+
+def as_labels(mask):
+    """Cast a label mask to the compact label dtype, without copying if already compact."""
+    mask = np.asarray(mask)
+    max_label = int(mask.max()) if mask.size else 0
+    return mask.astype(label_dtype(max_label), copy=False)
+
+
+def as_binary(mask):
+    """Return a bool mask of the non-zero pixels."""
+    mask = np.asarray(mask)
+    if mask.dtype == BINARY_DTYPE:
+        return mask
+    return mask > 0
+
+
+def as_intensity(image):
+    """Cast resampled intensities to float32, without copying if already float32."""
+    return np.asarray(image).astype(INTENSITY_DTYPE, copy=False)
@@ -0,0 +1,387 @@
+"""
+Equivalence harness: run reference implementations and alternative engines on the same fixtures,
+and report per feature whether each alternative reproduces the reference within tolerance.
+
+Each entry of CHECKS names a reference engine and any number of candidate engines. An engine takes
+one fixture, a dict with name, image (channels, height, width) and masks (cells, nuclei), and
+returns either a label array or a DataFrame with the key columns of its check. A faster code path
+can be adopted once it is registered as a candidate and every feature of the report passes.
+"""
+
+import os
+import sys
+import importlib.util
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# special import, path to script
+napari_utils_path = 'src/3_napari.py'
+puncta_detection_path = 'src/4_puncta_detection.py'
+percell_path = 'src/5_puncta_percell_calculations.py'
+
+
+def load_script(path, name):
+    """Load one of the numbered stage scripts as a module, due to annoying file names."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+napari_utils = load_script(napari_utils_path, 'napari_utils')
+puncta = load_script(puncta_detection_path, 'puncta_detection')
+percell = load_script(percell_path, 'percell_calculations')
+
+logger.info('import ok')
+
+# configuration
+image_folder = 'results/initial_cleanup/'
+mask_folder = 'results/napari_masking/'
+output_folder = 'results/equivalence/'
+N_SYNTHETIC_FIXTURES = 3
+N_REAL_FIXTURES = 2  # real images used as fixtures, 0 for synthetic fixtures only
+FIXTURE_SIZE = 512  # size of synthetic fixtures, real fixtures are cropped to it
+RTOL = 1e-7  # default relative tolerance of numeric features
+ATOL = 1e-9  # default absolute tolerance of numeric features
+TOLERANCES = {  # (rtol, atol) of features that are sums of many terms in a different order
+    'puncta_skew': (1e-6, 1e-9),
+    'cell_skew': (1e-6, 1e-9),
+    'puncta_skew_mean': (1e-6, 1e-9),
+    'cell_pearson': (1e-6, 1e-9),  # covariance from sums of products
+}
+IGNORED_COLUMNS = ['cell_coords']  # contour lists, not features
+
+
+# --- Fixtures ---
+def synthetic_fixture(seed, image_size=FIXTURE_SIZE, n_side=4, n_puncta=60):
+    """Square cells with nuclei and puncta; some cells are saturated, the outer ones touch the border and the last has no puncta."""
+    rng = np.random.default_rng(seed)
+    coi1 = rng.normal(300, 40, (image_size, image_size)).clip(0)
+    coi2 = rng.normal(500, 60, (image_size, image_size)).clip(0)
+    cells = np.zeros((image_size, image_size), dtype=np.uint16)
+    nuclei = np.zeros_like(cells)
+    step = image_size // n_side
+    lbl = 1
+    for row in range(n_side):
+        for col in range(n_side):
+            y, x = row * step, col * step
+            cells[y + 3:y + step - 3, x + 3:x + step - 3] = lbl
+            nuclei[y + step // 3:y + step // 2, x + step // 3:x + step // 2] = lbl
+            lbl += 1
+
+    yy, xx = np.mgrid[:image_size, :image_size]
+    for cy, cx in rng.integers(0, image_size, size=(n_puncta, 2)):
+        disk = (yy - cy) ** 2 + (xx - cx) ** 2 < rng.uniform(2, 6) ** 2
+        coi1[disk] += rng.uniform(1500, 4000)
+        coi2[disk] += rng.uniform(0, 1000)
+
+    # the last cell gets no puncta: dim, with a few bright dots below MIN_PUNCTA_SIZE
+    quiet = lbl - 1
+    in_quiet = cells == quiet
+    coi1[in_quiet] = rng.normal(20, 2, in_quiet.sum())
+    y, x = (n_side - 1) * step + 10, (n_side - 1) * step + 10
+    for k in range(5):
+        coi1[y + 20 * k:y + 20 * k + 3, x + 20 * k:x + 20 * k + 3] = 1000
+
+    image = np.stack([coi2, coi1, np.full_like(coi1, 100)]).clip(0, 65535).astype(np.uint16)
+    for lbl in rng.choice(np.arange(1, quiet), size=2, replace=False):
+        pixels = np.flatnonzero(cells.ravel() == lbl)
+        saturated = rng.choice(pixels, size=len(pixels) // 10, replace=False)
+        image[puncta.COI_1].ravel()[saturated] = 65535
+    return {'name': f'synthetic_{seed}', 'image': image, 'masks': np.stack([cells, nuclei])}
+
+
+def real_fixtures(image_folder=image_folder, mask_folder=mask_folder, n=N_REAL_FIXTURES, crop=FIXTURE_SIZE):
+    """The first n images with validated masks, cropped to keep the reference engines fast."""
+    if n == 0 or not (os.path.exists(image_folder) and os.path.exists(mask_folder)):
+        return []
+    names = sorted(fn.removesuffix('_mask.npy') for fn in os.listdir(mask_folder) if fn.endswith('_mask.npy'))
+    names = [name for name in names if os.path.exists(f'{image_folder}{name}.npy')][:n]
+    return [{'name': name,
+             'image': np.load(f'{image_folder}{name}.npy')[:, :crop, :crop],
+             'masks': np.load(f'{mask_folder}{name}_mask.npy')[:, :crop, :crop]}
+            for name in names]
+
+
+# --- Reference implementations kept for comparison ---
+def reference_remove_saturated_cells(image_stack, mask_stack, COI=napari_utils.COI):
+    """Per-label loop of remove_saturated_cells before the per-cell QC table."""
+    raw = image_stack[COI, :, :]
+    cells = mask_stack[0, :, :]
+
+    valid_labels = []
+    for label in np.unique(cells)[1:]:
+        pixel_mask = (cells == label)
+        pixel_count = np.count_nonzero(pixel_mask)
+        saturated = np.count_nonzero(raw[pixel_mask] > napari_utils.SATURATION_THRESHOLD)
+        if saturated / pixel_count < napari_utils.SATURATION_FRAC_CUTOFF:
+            valid_labels.append(label)
+    return np.where(np.isin(cells, valid_labels), cells, 0)
+
+
+def reference_filter_cells_by_fluoro_expression(image_stack, cells_mask):
+    """Per-label loop of filter_cells_by_fluoro_expression before the per-cell QC table."""
+    fluoro = image_stack[napari_utils.COI, :, :]
+    valid_labels = []
+    for label in np.unique(cells_mask)[1:]:
+        mask = (cells_mask == label)
+        bright_pixels = np.count_nonzero(fluoro[mask] > napari_utils.FLUORO_INTENSITY_THRESHOLD)
+        if bright_pixels / np.count_nonzero(mask) > napari_utils.FLUORO_FRACTION_CUTOFF:
+            valid_labels.append(label)
+    return np.where(np.isin(cells_mask, valid_labels), cells_mask, 0)
+
+
+def reference_colocalization(coi1, coi2, cells, thresholds=puncta.MANDERS_THRESHOLDS):
+    """Per-cell mask loop of Pearson and Manders coefficients."""
+    rows = []
+    for lbl in np.unique(cells)[1:]:
+        cell_mask = cells == lbl
+        vals1, vals2 = coi1[cell_mask].astype(float), coi2[cell_mask].astype(float)
+        rows.append({
+            'cell_number': lbl,
+            'cell_pearson': np.corrcoef(vals1, vals2)[0, 1],
+            'cell_manders_m1': vals1[vals2 > thresholds[puncta.COI_2_name]].sum() / vals1.sum(),
+            'cell_manders_m2': vals2[vals1 > thresholds[puncta.COI_1_name]].sum() / vals2.sum(),
+        })
+    return pd.DataFrame(rows)
+
+
+# --- Engines ---
+_cache = {}
+
+
+def cached(key, fixture, func):
+    """Compute func(fixture) once per fixture, the reference feature tables are slow."""
+    if (key, fixture['name']) not in _cache:
+        _cache[(key, fixture['name'])] = func(fixture)
+    return _cache[(key, fixture['name'])]
+
+
+def detection_input(fixture):
+    """(coi2, coi1, cell mask) of the fixture after the stage 4 saturation filter."""
+    name = fixture['name']
+    return cached('detection_input', fixture, lambda f: puncta.filter_saturated_images(
+        {name: f['image']}, None, {name: f['masks']})[name])
+
+
+def summarise_cells(features, size_col='cell_size', area_col='puncta_area'):
+    """Per-cell puncta count, total puncta area and cell intensity statistics of a puncta table."""
+    keys = ['image_name', 'cell_number']
+    summary = features.groupby(keys).agg(
+        cell_size=(size_col, 'first'), cell_cv=('cell_cv', 'first'),
+        cell_coi1_intensity_mean=('cell_coi1_intensity_mean', 'first'),
+        cell_coi2_intensity_mean=('cell_coi2_intensity_mean', 'first'),
+    )
+    with_puncta = features[features[area_col] > 0].groupby(keys)[area_col]
+    summary['puncta_count'] = with_puncta.size().reindex(summary.index, fill_value=0)
+    summary['puncta_area_total'] = with_puncta.sum().reindex(summary.index, fill_value=0)
+    return summary.reset_index()
+
+
+def cytoplasm_reference(fixture):
+    return puncta.generate_cytoplasm_masks({fixture['name']: fixture['masks']})[fixture['name']]
+
+
+def cytoplasm_label_index(fixture):
+    masks = {fixture['name']: fixture['masks']}
+    return puncta.generate_cytoplasm_masks(masks, indexes=puncta.build_label_indexes(masks))[fixture['name']]
+
+
+def saturated_reference(fixture):
+    return reference_remove_saturated_cells(fixture['image'], fixture['masks'])
+
+
+def saturated_qc_table(fixture):
+    return napari_utils.remove_saturated_cells(fixture['image'], fixture['masks'])
+
+
+def saturated_label_index(fixture):
+    index = napari_utils.label_index.LabelIndex(fixture['masks'][0])
+    return napari_utils.remove_saturated_cells(fixture['image'], fixture['masks'], index=index)
+
+
+def fluoro_reference(fixture):
+    return reference_filter_cells_by_fluoro_expression(fixture['image'], fixture['masks'][0])
+
+
+def fluoro_qc_table(fixture):
+    return napari_utils.filter_cells_by_fluoro_expression(fixture['image'], fixture['masks'][0])
+
+
+def fluoro_label_index(fixture):
+    index = napari_utils.label_index.LabelIndex(fixture['masks'][0])
+    return napari_utils.filter_cells_by_fluoro_expression(fixture['image'], fixture['masks'][0], index=index)
+
+
+def small_nuclei_reference(fixture):
+    return napari_utils.filter_small_nuclei(np.asarray(fixture['masks'][1]))
+
+
+def small_nuclei_label_index(fixture):
+    nuclei = np.asarray(fixture['masks'][1])
+    return napari_utils.filter_small_nuclei(nuclei, index=napari_utils.label_index.LabelIndex(nuclei))
+
+
+def features_reference(fixture):
+    return cached('features', fixture, lambda f: puncta.collect_image_features(f['name'], detection_input(f)))
+
+
+def features_label_index(fixture):
+    """Indexed features, with the index of the unfiltered cells as built once in stage 4."""
+    index = puncta.build_label_indexes({fixture['name']: fixture['masks']})[fixture['name']]
+    return puncta.collect_image_features(fixture['name'], detection_input(fixture), index=index)
+
+
+def cell_summary_reference(fixture):
+    return summarise_cells(features_reference(fixture))
+
+
+def cell_summary_sweep(fixture):
+    sweep = puncta.sweep_image_thresholds(fixture['name'], detection_input(fixture),
+                                          [puncta.STD_THRESHOLD], [puncta.MIN_PUNCTA_SIZE])
+    return sweep[['image_name', 'cell_number', 'cell_size', 'puncta_count', 'puncta_area_total']]
+
+
+def cell_summary_label_sums(fixture):
+    coi2, coi1, cells = detection_input(fixture)
+    n_cells = int(cells.max())
+    count, sum1, sumsq1 = puncta.label_sums(coi1, cells, n_cells)
+    _, sum2, _ = puncta.label_sums(coi2, cells, n_cells)
+    mean1, std1 = puncta.moments_from_sums(count, sum1, sumsq1)
+    labels = np.flatnonzero(count[1:]) + 1
+    return pd.DataFrame({
+        'image_name': fixture['name'], 'cell_number': labels, 'cell_size': count[labels],
+        'cell_cv': std1[labels] / mean1[labels], 'cell_coi1_intensity_mean': mean1[labels],
+        'cell_coi2_intensity_mean': sum2[labels] / count[labels],
+    })
+
+
+def cell_summary_single_slice(fixture):
+    """3D detection on a one-slice stack, which should find the 2D puncta."""
+    coi2, coi1, cells = detection_input(fixture)
+    stack = np.zeros((max(puncta.COI_1, puncta.COI_2) + 1, 1) + coi1.shape, dtype=coi1.dtype)
+    stack[puncta.COI_1, 0], stack[puncta.COI_2, 0] = coi1, coi2
+    features = puncta.collect_features_3d({fixture['name']: stack}, {fixture['name']: cells},
+                                          min_volume=puncta.MIN_PUNCTA_SIZE)
+    return summarise_cells(features, size_col='cell_volume', area_col='puncta_volume')
+
+
+def colocalization_reference(fixture):
+    coi2, coi1, cells = detection_input(fixture)
+    return reference_colocalization(coi1, coi2, cells)
+
+
+def colocalization_label_sums(fixture):
+    coi2, coi1, cells = detection_input(fixture)
+    return puncta.colocalization_features(coi1, coi2, cells, int(cells.max()))
+
+
+def percell_reference(fixture):
+    features = puncta.extra_puncta_features(features_reference(fixture).copy())
+    features = puncta.spatial_features(features, {fixture['name']: fixture['masks']})
+    return percell.calculate_cell_features(features)
+
+
+CHECKS = {
+    'cytoplasm_masks': {'reference': cytoplasm_reference, 'candidates': {'label_index': cytoplasm_label_index}, 'keys': None},
+    'saturated_cells': {'reference': saturated_reference,
+                        'candidates': {'qc_table': saturated_qc_table, 'label_index': saturated_label_index}, 'keys': None},
+    'fluoro_cells': {'reference': fluoro_reference,
+                     'candidates': {'qc_table': fluoro_qc_table, 'label_index': fluoro_label_index}, 'keys': None},
+    'small_nuclei': {'reference': small_nuclei_reference, 'candidates': {'label_index': small_nuclei_label_index}, 'keys': None},
+    'puncta_features': {'reference': features_reference, 'candidates': {'label_index': features_label_index},
+                        'keys': ['image_name', 'cell_number', 'puncta_label']},
+    'cell_summary': {'reference': cell_summary_reference,
+                     'candidates': {'threshold_sweep': cell_summary_sweep,
+                                    'label_sums': cell_summary_label_sums,
+                                    'single_slice_3d': cell_summary_single_slice},
+                     'keys': ['image_name', 'cell_number']},
+    'colocalization': {'reference': colocalization_reference, 'candidates': {'label_sums': colocalization_label_sums},
+                       'keys': ['cell_number']},
+    'percell_features': {'reference': percell_reference, 'candidates': {}, 'keys': ['image_name', 'cell_number']},
+}
+
+
+# --- Comparison ---
+def compare_arrays(reference, candidate):
+    """One report row for label arrays, which must match exactly."""
+    if reference.shape != candidate.shape:
+        return [{'feature': 'labels', 'n_compared': reference.size, 'n_mismatched': reference.size,
+                 'max_abs_diff': np.nan, 'max_rel_diff': np.nan, 'rtol': 0, 'atol': 0, 'passed': False}]
+    mismatched = np.count_nonzero(np.asarray(reference) != np.asarray(candidate))
+    return [{'feature': 'labels', 'n_compared': reference.size, 'n_mismatched': mismatched,
+             'max_abs_diff': np.nan, 'max_rel_diff': np.nan, 'rtol': 0, 'atol': 0, 'passed': mismatched == 0}]
+
+
+def compare_tables(reference, candidate, keys, tolerances=TOLERANCES):
+    """One report row for the row matching and one per feature the candidate provides.
+
+    Numeric features pass when every matched row is within (rtol, atol) of the reference, NaN
+    matching NaN; other features must be equal.
+    """
+    merged = reference.merge(candidate, on=keys, how='outer', suffixes=('_reference', '_candidate'), indicator=True)
+    both = merged['_merge'] == 'both'
+    rows = [{'feature': 'rows', 'n_compared': len(merged), 'n_mismatched': int((~both).sum()),
+             'max_abs_diff': np.nan, 'max_rel_diff': np.nan, 'rtol': 0, 'atol': 0, 'passed': bool(both.all())}]
+
+    for col in reference.columns:
+        if col in keys or col in IGNORED_COLUMNS or col not in candidate.columns:
+            continue
+        ref, alt = merged.loc[both, f'{col}_reference'], merged.loc[both, f'{col}_candidate']
+        rtol, atol = tolerances.get(col, (RTOL, ATOL))
+        if pd.api.types.is_numeric_dtype(ref) and pd.api.types.is_numeric_dtype(alt):
+            ref, alt = ref.to_numpy(dtype=float), alt.to_numpy(dtype=float)
+            close = np.isclose(alt, ref, rtol=rtol, atol=atol, equal_nan=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                diff = np.abs(alt - ref)
+                rel = diff / np.abs(ref)
+            max_abs = np.nanmax(diff) if np.isfinite(diff).any() else 0.0
+            max_rel = np.nanmax(rel[np.isfinite(rel)]) if np.isfinite(rel).any() else 0.0
+        else:
+            close = (ref.astype(str) == alt.astype(str)).to_numpy()
+            max_abs, max_rel = np.nan, np.nan
+        rows.append({'feature': col, 'n_compared': len(ref), 'n_mismatched': int((~close).sum()),
+                     'max_abs_diff': max_abs, 'max_rel_diff': max_rel, 'rtol': rtol, 'atol': atol,
+                     'passed': bool(close.all())})
+    return rows
+
+
+def run_harness(fixtures, checks=CHECKS):
+    """Compare every candidate of every check with its reference on every fixture.
+
+    Returns:
+        pd.DataFrame: one row per check, engine, fixture and feature.
+    """
+    report = []
+    for check_name, check in checks.items():
+        if not check['candidates']:
+            logger.info(f'{check_name}: no candidate engines registered, skipping')
+            continue
+        for fixture in fixtures:
+            reference = check['reference'](fixture)
+            for engine, func in check['candidates'].items():
+                candidate = func(fixture)
+                if check['keys'] is None:
+                    rows = compare_arrays(reference, candidate)
+                else:
+                    rows = compare_tables(reference, candidate, check['keys'])
+                report += [{'check': check_name, 'engine': engine, 'fixture': fixture['name'], **row} for row in rows]
+                logger.info(f'{check_name} / {engine} / {fixture["name"]}: '
+                            f'{"passed" if all(row["passed"] for row in rows) else "FAILED"}')
+    return pd.DataFrame(report)
+
+
+if __name__ == '__main__':
+    os.makedirs(output_folder, exist_ok=True)
+    fixtures = [synthetic_fixture(seed) for seed in range(N_SYNTHETIC_FIXTURES)] + real_fixtures()
+    report = run_harness(fixtures)
+    report.to_csv(f'{output_folder}equivalence_report.csv', index=False)
+
+    failed = report[~report['passed']]
+    if failed.empty:
+        logger.info(f'all {len(report)} feature comparisons passed')
+    else:
+        logger.error(f'{len(failed)} feature comparisons failed:\n{failed.to_string(index=False)}')
+        sys.exit(1)
@@ -0,0 +1,121 @@
+"""
+Batched group comparisons for the plotting stage.
+
+Every feature x pair comparison of a table is tested in one batch. Resampling tests run in
+parallel processes. p-values are corrected for multiple testing across the batch, and results
+come back as one tidy table. The plotting functions only read p-values from that table.
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import stats
+from loguru import logger
+
+# configuration
+TEST = 'mann-whitney'  # 'mann-whitney' (as statannotations), 'permutation' or 'bootstrap'
+CORRECTION = 'fdr_bh'  # 'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or None
+N_RESAMPLES = 10000  # resamples of the permutation and bootstrap tests
+N_WORKERS = None  # processes for resampling tests, None uses every core
+SEED = 0  # seed of the resampling tests, each comparison gets its own stream
+
+
+def mann_whitney(a, b, n_resamples=None, seed=None):
+    """Two-sided Mann-Whitney U test, as run by statannotations' 'Mann-Whitney'."""
+    result = stats.mannwhitneyu(a, b, alternative='two-sided')
+    return result.statistic, result.pvalue
+
+
+def mean_difference(a, b, axis=-1):
+    return np.mean(a, axis=axis) - np.mean(b, axis=axis)
+
+
+def permutation(a, b, n_resamples=N_RESAMPLES, seed=None):
+    """Two-sided permutation test of the difference in means."""
+    result = stats.permutation_test((a, b), mean_difference, vectorized=True, n_resamples=n_resamples,
+                                    alternative='two-sided', random_state=np.random.default_rng(seed))
+    return result.statistic, result.pvalue
+
+
+def bootstrap(a, b, n_resamples=N_RESAMPLES, seed=None):
+    """Two-sided bootstrap test of the difference in means, resampling both groups shifted to the pooled mean."""
+    rng = np.random.default_rng(seed)
+    observed = np.mean(a) - np.mean(b)
+    pooled = np.mean(np.concatenate([a, b]))
+    null_a = rng.choice(a - np.mean(a) + pooled, size=(n_resamples, len(a)))
+    null_b = rng.choice(b - np.mean(b) + pooled, size=(n_resamples, len(b)))
+    extreme = np.count_nonzero(np.abs(mean_difference(null_a, null_b)) >= abs(observed))
+    return observed, (extreme + 1) / (n_resamples + 1)
+
+
+TESTS = {'mann-whitney': mann_whitney, 'permutation': permutation, 'bootstrap': bootstrap}
+
+
+def run_comparison(job):
+    """Run one comparison, job is (test, a, b, n_resamples, seed)."""
+    test, a, b, n_resamples, seed = job
+    if len(a) < 2 or len(b) < 2:
+        return np.nan, np.nan
+    return TESTS[test](a, b, n_resamples=n_resamples, seed=seed)
+
+
+def adjust_pvalues(pvalues, correction=CORRECTION):
+    """Correct p-values for multiple testing, NaN p-values are left out of the family."""
+    pvalues = np.asarray(pvalues, dtype=float)
+    adjusted = pvalues.copy()
+    tested = ~np.isnan(pvalues)
+    if correction is None or not tested.any():
+        return adjusted
+    if correction == 'fdr_bh':
+        adjusted[tested] = stats.false_discovery_control(pvalues[tested], method='bh')
+    elif correction == 'bonferroni':
+        adjusted[tested] = np.minimum(pvalues[tested] * tested.sum(), 1)
+    else:
+        raise ValueError(f'unknown correction {correction}, use fdr_bh, bonferroni or None')
+    return adjusted
+
+
+def compare_groups(df, features, pairs, x='condition', hue='tag', test=TEST, correction=CORRECTION,
+                   n_resamples=N_RESAMPLES, n_workers=N_WORKERS, seed=SEED):
+    """Test every feature for every pair of groups and correct across all of them.
+
+    Args:
+        df (pd.DataFrame): one row per observation, e.g. per replicate.
+        features (list): columns to test.
+        pairs (list): pairs of groups as ((x value, hue value), (x value, hue value)), as for statannotations.
+        x (str, optional): column of the first group level. Defaults to 'condition'.
+        hue (str, optional): column of the second group level. Defaults to 'tag'.
+        test (str, optional): one of TESTS. Defaults to TEST.
+        correction (str, optional): multiple-testing correction. Defaults to CORRECTION.
+        n_resamples (int, optional): resamples of the resampling tests. Defaults to N_RESAMPLES.
+        n_workers (int, optional): processes for the resampling tests. Defaults to N_WORKERS.
+        seed (int, optional): seed of the resampling tests. Defaults to SEED.
+
+    Returns:
+        pd.DataFrame: one row per feature and pair with group sizes, statistic, p_value and p_adjusted.
+    """
+    if test not in TESTS:
+        raise ValueError(f'unknown test {test}, use one of {list(TESTS)}')
+    rows, jobs = [], []
+    seeds = np.random.SeedSequence(seed).spawn(len(features) * len(pairs))
+    for feature in features:
+        for (x_1, hue_1), (x_2, hue_2) in pairs:
+            a = df.loc[(df[x] == x_1) & (df[hue] == hue_1), feature].dropna().to_numpy(dtype=float)
+            b = df.loc[(df[x] == x_2) & (df[hue] == hue_2), feature].dropna().to_numpy(dtype=float)
+            rows.append({'feature': feature, f'{x}_1': x_1, f'{hue}_1': hue_1, f'{x}_2': x_2, f'{hue}_2': hue_2,
+                         'n_1': len(a), 'n_2': len(b)})
+            jobs.append((test, a, b, n_resamples, seeds[len(jobs)]))
+
+    if test == 'mann-whitney' or n_workers == 1:
+        results = [run_comparison(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(run_comparison, jobs, chunksize=max(1, len(jobs) // 64)))
+
+    table = pd.DataFrame(rows)
+    table['statistic'] = [statistic for statistic, _ in results]
+    table['p_value'] = [pvalue for _, pvalue in results]
+    table['p_adjusted'] = adjust_pvalues(table['p_value'], correction)
+    table['test'], table['correction'] = test, correction
+    logger.info(f'{len(table)} comparisons tested with {test}')
+    return table
@@ -1,38 +1,166 @@
+"""
+Sample intensity line profiles directly from .npy images in one batch, and plot a thumbnail per line
+"""
+
 import os
 import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
-import seaborn as sns
-import skimage.io
-import functools
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
+from scipy import ndimage
 from scipy.signal import savgol_filter
-from scipy.interpolate import make_interp_spline
 plt.rcParams.update({'font.size': 14})
 
 logger.info('import OK')
 
-input_folder = 'raw_data/'
+# configuration
+input_folder = 'results/initial_cleanup/'
+lines_folder = 'raw_data/lines/'  # line coordinates, one .csv table or napari shapes export per file
 output_folder = 'results/plotting/'
+PROFILE_CHANNELS = [1, 0]  # channels to sample, previously Sheet1 and Sheet2
+PROFILE_COLOURS = ['m', 'g']  # one colour per channel in PROFILE_CHANNELS
+SCALE_PX = 0.0779907  # size of one pixel in microns, as in 4_puncta_detection.py
+SMOOTH_WINDOW = 20  # Savitzky-Golay window length
+SMOOTH_ORDER = 4  # Savitzky-Golay polynomial order
+N_WORKERS = None  # processes for rendering thumbnails, None uses every core
 
 if not os.path.exists(output_folder):
     os.mkdir(output_folder)
 
 
-# ---------------- initialize file lists ----------------
-# read in calculated pixel data
-file_list = [filename for filename in os.listdir(input_folder) if '.xlsx' in filename]
-pixels = {filename.replace('.xlsx', ''): pd.read_excel(f'{input_folder}{filename}', sheet_name=['Sheet1', 'Sheet2']) for filename in file_list}
+def load_lines(lines_folder):
+    """Read line coordinates as one row per line: image_name, line_id, y0, x0, y1, x1.
+
+    Each .csv file is either a table with those columns, or a napari shapes layer saved with
+    layer.save('<image_name>.csv'), in which case the image name is taken from the file name and
+    every shape of type 'line' (or 'path', first and last vertex) becomes one line.
+    """
+    tables = []
+    for fn in sorted(os.listdir(lines_folder)):
+        if not fn.endswith('.csv'):
+            continue
+        df = pd.read_csv(os.path.join(lines_folder, fn))
+        if 'shape-type' in df.columns:
+            df = df[df['shape-type'].isin(['line', 'path'])]
+            axes = sorted(col for col in df.columns if col.startswith('axis-'))
+            ends = df.sort_values(['index', 'vertex-index']).groupby('index')[axes[-2:]].agg(['first', 'last'])
+            df = pd.DataFrame({
+                'image_name': fn.removesuffix('.csv'),
+                'line_id': ends.index,
+                'y0': ends[(axes[-2], 'first')].to_numpy(), 'x0': ends[(axes[-1], 'first')].to_numpy(),
+                'y1': ends[(axes[-2], 'last')].to_numpy(), 'x1': ends[(axes[-1], 'last')].to_numpy(),
+            })
+        tables.append(df[['image_name', 'line_id', 'y0', 'x0', 'y1', 'x1']])
+    lines = pd.concat(tables, ignore_index=True)
+
+    duplicated = lines.duplicated(['image_name', 'line_id'])
+    if duplicated.any():
+        logger.warning(f'{duplicated.sum()} lines share an image_name and line_id with an earlier line, keeping the first')
+    return lines[~duplicated].reset_index(drop=True)
+
+
+def sample_profiles(image, lines, channels=PROFILE_CHANNELS, scale=SCALE_PX):
+    """Sample every line of one image at 1 pixel spacing with a single interpolation call per channel.
+
+    Args:
+        image (np.array): image with shape (channels, height, width).
+        lines (pd.DataFrame): rows of load_lines for this image.
+        channels (list, optional): channels to sample. Defaults to PROFILE_CHANNELS.
+        scale (float, optional): microns per pixel. Defaults to SCALE_PX.
+
+    Returns:
+        pd.DataFrame: long table with line_id, channel, distance_um and gray_value.
+    """
+    y0, x0, y1, x1 = (lines[col].to_numpy(dtype=float) for col in ['y0', 'x0', 'y1', 'x1'])
+    length = np.hypot(y1 - y0, x1 - x0)
+    n_samples = np.floor(length).astype(int) + 1
+
+    # flat sample positions of all lines: line index and distance along the line
+    line_idx = np.repeat(np.arange(len(lines)), n_samples)
+    distance = np.arange(n_samples.sum()) - np.repeat(np.cumsum(n_samples) - n_samples, n_samples)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.nan_to_num(distance / length[line_idx])
+    rows = y0[line_idx] + frac * (y1 - y0)[line_idx]
+    cols = x0[line_idx] + frac * (x1 - x0)[line_idx]
+
+    profiles = []
+    for ch in channels:
+        values = ndimage.map_coordinates(np.asarray(image[ch], dtype=np.float32), [rows, cols], order=1)
+        profiles.append(pd.DataFrame({
+            'line_id': lines['line_id'].to_numpy()[line_idx],
+            'channel': ch,
+            'distance_um': distance * scale,
+            'gray_value': values,
+        }))
+    return pd.concat(profiles, ignore_index=True)
+
+
+def smooth_profiles(profiles, window=SMOOTH_WINDOW, order=SMOOTH_ORDER):
+    """Max-normalise and Savitzky-Golay smooth every profile, batched over profiles of equal length.
 
-for name, val in pixels.items():
+    Adds gray_val_corrected (profile / its max) and gray_val_smoothed columns.
+    """
+    profiles = profiles.copy()
+    keys = ['image_name', 'line_id', 'channel']
+    profiles['gray_val_corrected'] = profiles['gray_value'] / profiles.groupby(keys)['gray_value'].transform('max')
+
+    # profiles are contiguous blocks, so equal-length blocks stack into one 2D array
+    block = profiles.groupby(keys, sort=False).ngroup().to_numpy()
+    starts = np.flatnonzero(np.r_[True, block[1:] != block[:-1]])
+    lengths = np.diff(np.r_[starts, len(profiles)])
+    values = profiles['gray_val_corrected'].to_numpy()
+    smoothed = values.copy()
+    for length in np.unique(lengths):
+        win = min(window, length)
+        if win <= order:
+            continue  # too short to smooth
+        idx = starts[lengths == length][:, None] + np.arange(length)
+        smoothed[idx] = savgol_filter(values[idx], win, order, axis=1)
+    profiles['gray_val_smoothed'] = smoothed
+    return profiles
+
+
+def plot_thumbnail(args):
+    """Render one line's smoothed profiles, one colour per channel."""
+    name, line_id, curves = args
+    matplotlib.use('Agg')
     fig, ax = plt.subplots(figsize=(2.4, 2))
-    max_val = val['Sheet2']['Gray_Value'].max()
-    val['Sheet2']['gray_val_corrected'] = val['Sheet2']['Gray_Value']/max_val
-    max_val = val['Sheet1']['Gray_Value'].max()
-    val['Sheet1']['gray_val_corrected'] = val['Sheet1']['Gray_Value']/max_val
-    mhat = savgol_filter(val['Sheet1']['gray_val_corrected'], 20, 4)
-    ghat = savgol_filter(val['Sheet2']['gray_val_corrected'], 20, 4)
-    plt.plot(val['Sheet1']['Distance_(microns)'], mhat, color='m')
-    plt.plot(val['Sheet2']['Distance_(microns)'], ghat, color='g')
-    plt.tight_layout()
-    plt.savefig(f'{output_folder}{name}_intensitythumbnail.png', format='png', dpi=300)
+    for distance, smoothed, colour in curves:
+        ax.plot(distance, smoothed, color=colour)
+    fig.tight_layout()
+    fig.savefig(f'{output_folder}{name}_{line_id}_intensitythumbnail.png', format='png', dpi=300)
+    plt.close(fig)
+
+
+def render_thumbnails(profiles, channels=PROFILE_CHANNELS, colours=PROFILE_COLOURS, n_workers=N_WORKERS):
+    """Render all thumbnails in parallel processes."""
+    colour_of = dict(zip(channels, colours))
+    jobs = []
+    for (name, line_id), line in profiles.groupby(['image_name', 'line_id'], sort=False):
+        curves = [(ch_df['distance_um'].to_numpy(), ch_df['gray_val_smoothed'].to_numpy(), colour_of[ch])
+                  for ch, ch_df in line.groupby('channel', sort=False)]
+        jobs.append((name, line_id, curves))
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(plot_thumbnail, jobs, chunksize=8))
+
+
+if __name__ == '__main__':
+    # ---------------- read line coordinates ----------------
+    lines = load_lines(lines_folder)
+    logger.info(f'{len(lines)} lines in {lines["image_name"].nunique()} images')
+
+    # ---------------- sample profiles from images ----------------
+    profiles = []
+    for name, image_lines in lines.groupby('image_name', sort=False):
+        image = np.load(f'{input_folder}{name}.npy', mmap_mode='r')
+        profiles.append(sample_profiles(image, image_lines).assign(image_name=name))
+    profiles = smooth_profiles(pd.concat(profiles, ignore_index=True))
+
+    profiles.to_csv(f'{output_folder}line_profiles.csv', index=False)
+    logger.info('line profiles saved')
+
+    # ---------------- plot thumbnails ----------------
+    render_thumbnails(profiles)
+    logger.info('thumbnails saved')
@@ -0,0 +1,75 @@
+"""
+Sparse per-label pixel index, built once per mask and shared by the label-wise routines.
+
+One stable argsort of the non-zero pixels groups the flat pixel indices by label, in raster order
+within each label, with offsets marking where each label starts. Looking up the pixels or the
+bounding box of one label then costs O(label size) instead of a full-image equality test. Filters
+only ever remove whole labels, so an index stays valid for every mask cut from the mask it was
+built on.
+"""
+
+import numpy as np
+
+
+class LabelIndex:
+    """Flat pixel indices of every label of a 2D label mask.
+
+    Attributes:
+        shape (tuple): shape of the mask.
+        labels (np.array): sorted non-zero labels.
+        sizes (np.array): pixel count of each label.
+        order (np.array): flat pixel indices grouped by label, raster order within a label.
+        offsets (np.array): the pixels of labels[i] are order[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask)
+        flat = mask.ravel()
+        nonzero = np.flatnonzero(flat)
+        sort = np.argsort(flat[nonzero], kind='stable')
+        self.shape = mask.shape
+        self.order = nonzero[sort]
+        self.labels, starts, self.sizes = np.unique(flat[self.order], return_index=True, return_counts=True)
+        self.offsets = np.append(starts, len(self.order))
+
+    def _position(self, label):
+        i = np.searchsorted(self.labels, label)
+        if i == len(self.labels) or self.labels[i] != label:
+            raise KeyError(f'label {label} not in index')
+        return i
+
+    def flat_pixels(self, label):
+        """Flat indices of the pixels of one label, in raster order."""
+        i = self._position(label)
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+    def pixels(self, label):
+        """(rows, cols) of the pixels of one label, usable to index an image."""
+        return np.unravel_index(self.flat_pixels(label), self.shape)
+
+    def bbox(self, label):
+        """Bounding box of one label as (row slice, column slice)."""
+        rows, cols = self.pixels(label)
+        return slice(rows[0], rows[-1] + 1), slice(cols.min(), cols.max() + 1)
+
+    def present(self, mask):
+        """Labels of the index still in mask, a mask cut from the indexed one by removing whole labels."""
+        first_pixels = self.order[self.offsets[:-1]]
+        return self.labels[np.asarray(mask).ravel()[first_pixels] == self.labels]
+
+    def remove_labels(self, mask, labels):
+        """Copy of mask with the pixels of labels set to 0, touching only those pixels.
+
+        Args:
+            mask (np.array): the indexed mask, or a mask cut from it by removing whole labels.
+            labels (array-like): labels to remove, labels missing from the index are ignored.
+
+        Returns:
+            np.array: filtered copy of mask.
+        """
+        positions = np.flatnonzero(np.isin(self.labels, labels))
+        removed = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in positions]) \
+            if positions.size else np.empty(0, dtype=self.order.dtype)
+        filtered = np.array(mask, copy=True)
+        filtered.reshape(-1)[removed] = 0
+        return filtered
@@ -0,0 +1,69 @@
+"""
+Keyed mask store: one memory-mappable .npy entry per image name.
+
+Replaces the single stacked cellpose_cellmasks.npy so that masks are written as segmentation
+finishes, images can have different shapes, and readers can open one image's masks without
+loading the rest of the cohort.
+"""
+
+import os
+import sys
+import uuid
+import importlib.util
+import numpy as np
+
+# special import, path to script
+dtype_policy_path = 'src/dtype_policy.py'
+
+# load the module dynamically to share the dtype policy between stages
+spec = importlib.util.spec_from_file_location('dtype_policy', dtype_policy_path)
+dtype_policy = importlib.util.module_from_spec(spec)
+sys.modules['dtype_policy'] = dtype_policy
+spec.loader.exec_module(dtype_policy)
+as_labels = dtype_policy.as_labels
+
+MASK_SUFFIX = '_cellmasks.npy'
+
+
+def mask_path(store_folder, image_name):
+    return os.path.join(store_folder, f'{image_name}{MASK_SUFFIX}')
+
+
+def save_masks(store_folder, image_name, masks):
+    """Write the masks of one image; the entry only appears once it is complete.
+
+    Args:
+        store_folder (str): folder of the mask store.
+        image_name (str): key of the image, as used for the image file name.
+        masks (np.array): label masks of the image.
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    tmp_path = os.path.join(store_folder, f'.{image_name}.{uuid.uuid4().hex}.tmp.npy')
+    np.save(tmp_path, as_labels(masks))
+    os.replace(tmp_path, mask_path(store_folder, image_name))
+
+
+def load_masks(store_folder, image_name, mmap_mode='r'):
+    """Open the masks of one image, memory-mapped by default so nothing is read until used.
+
+    Args:
+        store_folder (str): folder of the mask store.
+        image_name (str): key of the image.
+        mmap_mode (str, optional): np.load memory-map mode, None to read into memory. Defaults to 'r'.
+
+    Returns:
+        np.array: label masks of the image.
+    """
+    return np.load(mask_path(store_folder, image_name), mmap_mode=mmap_mode)
+
+
+def has_masks(store_folder, image_name):
+    return os.path.exists(mask_path(store_folder, image_name))
+
+
+def list_masks(store_folder):
+    """Return the image names with masks in the store."""
+    if not os.path.exists(store_folder):
+        return []
+    return sorted(fn.removesuffix(MASK_SUFFIX) for fn in os.listdir(store_folder)
+                  if fn.endswith(MASK_SUFFIX) and not fn.startswith('.'))
@@ -0,0 +1,124 @@
+"""
+Live preview of puncta detection in napari, to tune STD_THRESHOLD and MIN_PUNCTA_SIZE of stage 4
+while reviewing masks in stage 3.
+
+The per-cell standard deviations are computed once per cell mask, with one bincount each, and kept
+as a z map: every pixel divided by the standard deviation of its cell. Moving the threshold slider
+compares that map to the threshold and labels the image once, as stage 4 does per cell. Only the
+pixels above the threshold are kept for the rest. Moving the minimum size slider only hides puncta
+by their cached areas, without labelling again. The defaults, the channel and the saturated-cell
+filter are those of stage 4, read from 4_puncta_detection.py.
+"""
+
+import sys
+import importlib.util
+import numpy as np
+from skimage import measure
+from magicgui import magicgui
+
+# special import, path to script
+puncta_detection_path = 'src/4_puncta_detection.py'
+
+# load the module dynamically to preview with the settings of stage 4
+spec = importlib.util.spec_from_file_location('puncta_detection', puncta_detection_path)
+puncta_detection = importlib.util.module_from_spec(spec)
+sys.modules['puncta_detection'] = puncta_detection
+spec.loader.exec_module(puncta_detection)
+cell_qc = puncta_detection.cell_qc
+
+# defaults, from 4_puncta_detection.py
+STD_THRESHOLD = puncta_detection.STD_THRESHOLD
+MIN_PUNCTA_SIZE = puncta_detection.MIN_PUNCTA_SIZE
+COI = puncta_detection.COI_1  # channel puncta are detected in
+STD_THRESHOLD_RANGE = (1.0, 8.0)  # slider range of the threshold in cell standard deviations
+MIN_SIZE_RANGE = (1, 100)  # slider range of the minimum puncta size in pixels
+
+
+class PunctaPreview:
+    """Puncta labels of one image for any threshold and minimum size, from cached cell statistics."""
+
+    def __init__(self, channel, cells):
+        self.channel = np.asarray(channel)
+        self.set_cells(cells)
+
+    def set_cells(self, cells):
+        """Cache the standard deviation of every cell, again after the cell mask was edited."""
+        self.cells = np.asarray(cells)
+        flat = self.cells.ravel()
+        values = self.channel.ravel().astype(np.float64)
+        count = np.bincount(flat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.bincount(flat, weights=values) / count
+            std = np.sqrt(np.maximum(np.bincount(flat, weights=values ** 2) / count - mean ** 2, 0))
+            std[0] = np.inf  # background never passes the threshold
+            self.z_map = (values / std[flat]).astype(np.float32).reshape(self.cells.shape)
+        self.std_threshold, self.pixels, self.pixel_labels, self.areas = None, None, None, None
+
+    def detect(self, std_threshold):
+        """Label the pixels above std_threshold cell standard deviations, puncta never cross cells."""
+        # label only joins pixels of the same cell value
+        labels = measure.label(self.cells * (self.z_map > std_threshold))
+        self.pixels = np.flatnonzero(labels)
+        self.pixel_labels = labels.ravel()[self.pixels].astype(np.int32)
+        self.areas = np.bincount(self.pixel_labels, minlength=1)  # at least the background, for images without puncta
+        self.std_threshold = std_threshold
+
+    def puncta(self, std_threshold=STD_THRESHOLD, min_size=MIN_PUNCTA_SIZE):
+        """Puncta labels for the threshold and minimum size, labelling only when the threshold changed.
+
+        Args:
+            std_threshold (float, optional): threshold in cell standard deviations. Defaults to STD_THRESHOLD.
+            min_size (int, optional): minimum puncta area in pixels. Defaults to MIN_PUNCTA_SIZE.
+
+        Returns:
+            np.array: puncta labels, 0 where no puncta of at least min_size pixels was found.
+        """
+        if std_threshold != self.std_threshold:
+            self.detect(std_threshold)
+        keep = self.areas >= min_size
+        keep[0] = False
+        puncta = np.zeros(self.cells.shape, dtype=np.int32)
+        puncta.reshape(-1)[self.pixels] = np.where(keep[self.pixel_labels], self.pixel_labels, 0)
+        return puncta
+
+
+def unsaturated_cells(image_stack, cells):
+    """Cells stage 4 detects puncta in, without the saturated cells that filter_saturated_images drops."""
+    cells = np.asarray(cells)
+    table = cell_qc.compute_qc_table(image_stack, np.stack([cells, np.zeros_like(cells)]), **puncta_detection.QC_SETTINGS)
+    valid_labels = table.loc[table['saturated_fraction'] < puncta_detection.SAT_FRAC_CUTOFF, 'cell_number']
+    return np.where(np.isin(cells, valid_labels), cells, 0)
+
+
+def add_preview_widget(viewer, image_stack, cells_layer, coi=COI):
+    """Dock the threshold sliders in viewer and overlay the puncta they detect in the cells of cells_layer.
+
+    Saturated cells are left out as in stage 4, measured on the channel of stage 4's QC_SETTINGS.
+
+    Args:
+        viewer (napari.Viewer): viewer showing the image.
+        image_stack (np.array): image with shape (channels, height, width).
+        cells_layer (napari.layers.Labels): cell masks under review, edits refresh the cached statistics.
+        coi (int, optional): channel puncta are detected in. Defaults to COI.
+
+    Returns:
+        magicgui.widgets.FunctionGui: the docked widget.
+    """
+    preview = PunctaPreview(image_stack[coi], unsaturated_cells(image_stack, cells_layer.data))
+    puncta_layer = viewer.add_labels(preview.puncta(), name='puncta preview')
+
+    @magicgui(auto_call=True,
+              std_threshold={'widget_type': 'FloatSlider', 'min': STD_THRESHOLD_RANGE[0],
+                             'max': STD_THRESHOLD_RANGE[1], 'step': 0.1},
+              min_size={'widget_type': 'Slider', 'min': MIN_SIZE_RANGE[0], 'max': MIN_SIZE_RANGE[1]})
+    def puncta_threshold(std_threshold: float = STD_THRESHOLD, min_size: int = MIN_PUNCTA_SIZE):
+        puncta_layer.data = preview.puncta(std_threshold, min_size)
+
+    def refresh_cells(event=None):
+        preview.set_cells(unsaturated_cells(image_stack, cells_layer.data))
+        puncta_threshold()
+
+    # painting emits paint events on recent napari versions, data events otherwise
+    getattr(cells_layer.events, 'paint', cells_layer.events.data).connect(refresh_cells)
+    viewer.window.add_dock_widget(puncta_threshold, area='right', name='puncta preview')
+    return puncta_threshold
@@ -0,0 +1,191 @@
+"""
+Run stages 1 to 6 in one process, passing images, masks and tables in memory between stages.
+
+Meant for headless batch runs: stage 3 applies only the automated mask filters, so manual QC in
+napari is skipped (or was done before, in which case start at stage 4). Stages 4 to 6 always write
+their usual outputs, the final artifacts. Stages 1 to 3 only write theirs when listed in
+--checkpoint, e.g. to keep the cellpose masks for a later manual QC. When the first selected stage
+is not stage 1, its inputs are read from the usual outputs of the stage before it.
+
+Usage (from the repository root):
+    python src/run_pipeline.py
+    python src/run_pipeline.py --stages 4 5 6
+    python src/run_pipeline.py --checkpoint 2 3
+"""
+
+import os
+import sys
+import argparse
+import importlib.util
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+logger.info('import ok')
+
+# configuration
+STAGE_ORDER = ['1', '1b', '2', '3', '4', '5', '6']
+CHECKPOINT_STAGES = []  # stages 1 to 3 whose outputs are also written to disk
+CELLPOSE_KWARGS = {'niter': 2000, 'big_images': True}  # as in the main block of 2_cellpose.py
+FILTER_FLUORO = True  # as in the main block of 3_napari.py
+SAVE_PROOFS = True  # proof plots of stage 4
+
+
+def load_script(path, name):
+    """Load one of the numbered stage scripts as a module, due to annoying file names."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# --- Stages ---
+# each stage reads what it needs from state, loading it from disk when an earlier stage did not run
+def run_cleanup(state, checkpoint):
+    cleanup = load_script('src/1_initial_cleanup.py', 'initial_cleanup')
+    images = {}
+    for path in cleanup.find_images(cleanup.input_path):
+        converted = cleanup.image_converter(path, output_folder=cleanup.output_folder, tiff=False, MIP=True,
+                                            stack_folder=cleanup.stack_folder if cleanup.SAVE_ZSTACKS else None,
+                                            timeseries_folder=cleanup.timeseries_folder if cleanup.SAVE_TIMESERIES else None,
+                                            save=checkpoint)
+        if converted is not None:
+            name, image = converted
+            images[name] = image
+    state['images'] = images
+
+
+def run_background_correction(state, checkpoint):
+    background = load_script('src/1b_background_correction.py', 'background_correction')
+    if 'images' not in state:
+        state['images'] = load_images(background.image_folder)
+    if checkpoint:
+        background.prepare_output_folder(background.output_folder)
+    corrected = {}
+    for name, image in state['images'].items():
+        corrected[name] = background.correct_image(image)
+        if checkpoint:
+            np.save(os.path.join(background.output_folder, f'{name}.npy'), corrected[name])
+    state['corrected'] = corrected
+
+
+def run_cellpose(state, checkpoint):
+    cellpose = load_script('src/2_cellpose.py', 'cellpose_masking')
+    # background corrected images when stage 1b ran, else those of stage 1 or of the stage 2 image_folder
+    segmented = state.get('corrected') or state.get('images') or load_images(cellpose.image_folder)
+
+    model = cellpose.models.CellposeModel(model_type=cellpose.IMAGE_TYPE, gpu=cellpose.USE_GPU)
+    cellpose_masks = {}
+    for name, img in zip(segmented, cellpose.prepare_images(segmented)):
+        masks, _, _ = cellpose.apply_cellpose([img], model=model, **CELLPOSE_KWARGS)
+        cellpose_masks[name] = masks[0]
+        if checkpoint:
+            cellpose.mask_store.save_masks(cellpose.output_folder, name, masks[0])
+    state['cellpose_masks'] = cellpose_masks
+
+
+def run_mask_filtering(state, checkpoint):
+    napari_utils = load_script('src/3_napari.py', 'napari_utils')
+    if 'images' not in state:
+        state['images'] = load_images(napari_utils.image_folder)
+    if 'cellpose_masks' not in state:
+        state['cellpose_masks'] = napari_utils.load_masks(napari_utils.mask_folder, state['images'].keys())
+    if checkpoint:
+        napari_utils.ensure_output_folder(napari_utils.output_folder)
+
+    masks, qc_tables = {}, {}
+    for name, cellpose_masks in state['cellpose_masks'].items():
+        image = state['images'][name]
+        masks[name] = napari_utils.filter_masks_auto(image, cellpose_masks, filter_fluoro=FILTER_FLUORO)
+        qc_tables[name] = napari_utils.compute_qc_table(image, masks[name])
+        if checkpoint:
+            napari_utils.save_mask(name, masks[name], image_stack=image)
+    state['masks'], state['qc_tables'] = masks, qc_tables
+
+
+def run_puncta_detection(state, checkpoint):
+    puncta = load_script('src/4_puncta_detection.py', 'puncta_detection')
+    if 'images' not in state:
+        state['images'] = puncta.load_images(puncta.image_folder)
+    if 'masks' not in state:
+        state['masks'] = puncta.load_masks(puncta.mask_folder)
+        state['qc_tables'] = puncta.load_qc_tables(puncta.mask_folder, state['masks'])
+    images = {name: state['images'][name] for name in state['masks']}
+    corrected = None
+    if puncta.USE_BACKGROUND_CORRECTION:
+        corrected = state.get('corrected') or puncta.load_images(puncta.background_folder)
+
+    indexes = puncta.build_label_indexes(state['masks'])
+    cyto_masks = puncta.generate_cytoplasm_masks(state['masks'], indexes=indexes)
+    filtered = puncta.filter_saturated_images(images, cyto_masks, state['masks'], corrected=corrected,
+                                              qc_tables=state.get('qc_tables'), indexes=indexes)
+    features = puncta.collect_features(filtered, indexes=indexes)
+    features = puncta.extra_puncta_features(features)
+    features = puncta.spatial_features(features, state['masks'])
+
+    features = puncta.add_metadata(features)
+    features = puncta.remove_outliers(features, puncta.FEATURE_COLS)
+    state['tables'] = puncta.save_feature_tables(features, puncta.FEATURE_COLS)
+    if SAVE_PROOFS:
+        puncta.generate_proofs(features, filtered, coi1=puncta.COI_1, coi2=puncta.COI_2)
+
+
+def run_percell(state, checkpoint):
+    percell = load_script('src/5_puncta_percell_calculations.py', 'percell_calculations')
+    if 'tables' not in state:
+        state['tables'] = {'puncta_features': pd.read_csv(f'{percell.input_folder}puncta_features.csv')}
+    summary = percell.percell_summary(state['tables']['puncta_features'])
+    state['tables'].update(percell.save_dataframes(summary, percell.PERCELL_FEATURES))
+
+
+def run_plotting(state, checkpoint):
+    plotting = load_script('src/6_puncta_plotting.py', 'puncta_plotting')
+    tables = state.get('tables', {})
+    if 'puncta_features_reps' in tables and 'percell' in tables:
+        plotting.plot_all(tables)
+    else:
+        plotting.plot_all(plotting.load_summary_data(plotting.input_folder))
+
+
+STAGES = {
+    '1': run_cleanup,
+    '1b': run_background_correction,
+    '2': run_cellpose,
+    '3': run_mask_filtering,
+    '4': run_puncta_detection,
+    '5': run_percell,
+    '6': run_plotting,
+}
+
+
+def load_images(image_folder):
+    return {fn.removesuffix('.npy'): np.load(os.path.join(image_folder, fn))
+            for fn in sorted(os.listdir(image_folder)) if fn.endswith('.npy') and not fn.endswith('.tmp.npy')}
+
+
+def run_pipeline(stages=STAGE_ORDER, checkpoint_stages=CHECKPOINT_STAGES):
+    """Run the selected stages in pipeline order and return the in-memory state.
+
+    Args:
+        stages (list, optional): stages to run. Defaults to every stage.
+        checkpoint_stages (list, optional): stages 1 to 3 whose outputs are written. Defaults to CHECKPOINT_STAGES.
+
+    Returns:
+        dict: outputs of the stages that ran, by name.
+    """
+    state = {}
+    for stage in [stage for stage in STAGE_ORDER if stage in stages]:
+        logger.info(f'running stage {stage}')
+        STAGES[stage](state, checkpoint=stage in checkpoint_stages)
+    logger.info('pipeline complete')
+    return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run stages 1 to 6 in memory')
+    parser.add_argument('--stages', nargs='+', choices=STAGE_ORDER, default=STAGE_ORDER, help='stages to run')
+    parser.add_argument('--checkpoint', nargs='*', choices=['1', '1b', '2', '3'], default=CHECKPOINT_STAGES,
+                        help='stages whose outputs are also written to disk')
+    args = parser.parse_args()
+    run_pipeline(args.stages, args.checkpoint)
@@ -0,0 +1,492 @@
+"""
+Distribute stages 1, 1b, 2 and 4 over any number of workers on any number of nodes.
+
+The image list of a stage is split into work units on a shared filesystem. Workers claim units with
+lease files (atomic exclusive create), refresh the lease while they work, and mark units done when
+their outputs are written. Leases that are not refreshed within LEASE_SECONDS belong to crashed
+workers and are reclaimed by the next worker. Per-unit outputs are staged per worker and only
+moved into the parts folder while the worker still holds the lease, so a worker that lost its lease
+never commits. Once every unit is done, merge combines the per-unit outputs into the usual stage
+outputs. Rerunning init only redoes the units whose image list changed.
+
+Usage (from the repository root, on every node that should take part):
+    python src/scheduler.py init 4
+    python src/scheduler.py work 4
+    python src/scheduler.py merge 4
+or, for a single machine with several local processes:
+    python src/scheduler.py local 4 --workers 4
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import shutil
+import argparse
+import threading
+import importlib.util
+import multiprocessing
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+logger.info('import ok')
+
+# configuration
+queue_folder = 'results/queue/'
+UNIT_SIZE = 10  # images per work unit
+LEASE_SECONDS = 600  # leases older than this are considered abandoned by a crashed worker
+HEARTBEAT_SECONDS = 60  # how often a worker refreshes its lease, and polls while waiting for others
+CELLPOSE_KWARGS = {'niter': 2000, 'big_images': True}  # as in 2_cellpose.py
+
+
+# --- Stage modules ---
+def load_script(path, name):
+    """Load one of the numbered stage scripts as a module, due to annoying file names."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def cleanup_items():
+    cleanup = load_script('src/1_initial_cleanup.py', 'initial_cleanup')
+    return cleanup.find_images(cleanup.input_path)
+
+
+def cleanup_process(items, parts_folder, unit_id):
+    cleanup = load_script('src/1_initial_cleanup.py', 'initial_cleanup')
+    for path in items:
+        cleanup.image_converter(path, output_folder=cleanup.output_folder, tiff=False, MIP=True)
+
+
+def cleanup_merge(unit_ids, parts_folder):
+    logger.info('stage 1 writes one array per image, nothing to merge')
+
+
+def background_items():
+    background = load_script('src/1b_background_correction.py', 'background_correction')
+    background.prepare_output_folder(background.output_folder)
+    return background.find_images(background.image_folder)
+
+
+def background_process(items, parts_folder, unit_id):
+    background = load_script('src/1b_background_correction.py', 'background_correction')
+    for fn in items:
+        background.correct_file(fn, background.image_folder, background.output_folder)
+
+
+def background_merge(unit_ids, parts_folder):
+    logger.info('stage 1b writes one array per image, nothing to merge')
+
+
+def cellpose_items():
+    cellpose = load_script('src/2_cellpose.py', 'cellpose_masking')
+    return cellpose.find_images(cellpose.image_folder)
+
+
+def cellpose_process(items, parts_folder, unit_id):
+    """Segment a unit with the model settings of 2_cellpose.py into a mask store in the staging folder."""
+    cellpose = load_script('src/2_cellpose.py', 'cellpose_masking')
+    # tiled segmentation reads each tile from disk, so large fields are never loaded whole
+    mmap_mode = 'r' if cellpose.TILE_SIZE is not None else None
+    model = cellpose.models.CellposeModel(model_type=cellpose.IMAGE_TYPE, gpu=cellpose.USE_GPU)
+    unit_store = os.path.join(parts_folder, f'{unit_id}.masks')
+    for name in items:
+        if cellpose.mask_store.has_masks(cellpose.output_folder, name):
+            logger.info(f'masks already saved for {name}, skipping')
+            continue
+        image = np.load(f'{cellpose.image_folder}{name}.npy', mmap_mode=mmap_mode)
+        if cellpose.TILE_SIZE is not None:
+            masks, _, _ = cellpose.apply_cellpose([cellpose.PreparedTiles(image)], niter=CELLPOSE_KWARGS['niter'],
+                                                  tile_size=cellpose.TILE_SIZE, tile_overlap=cellpose.TILE_OVERLAP,
+                                                  model=model)
+        else:
+            img = cellpose.prepare_images({name: image})[0]
+            masks, _, _ = cellpose.apply_cellpose([img], model=model, **CELLPOSE_KWARGS)
+        cellpose.mask_store.save_masks(unit_store, name, masks[0])
+
+
+def cellpose_merge(unit_ids, parts_folder):
+    cellpose = load_script('src/2_cellpose.py', 'cellpose_masking')
+    os.makedirs(cellpose.output_folder, exist_ok=True)
+    n_masks = 0
+    for unit_id in unit_ids:
+        unit_store = os.path.join(parts_folder, f'{unit_id}.masks')
+        for name in cellpose.mask_store.list_masks(unit_store):
+            os.replace(cellpose.mask_store.mask_path(unit_store, name), cellpose.mask_store.mask_path(cellpose.output_folder, name))
+            n_masks += 1
+    logger.info(f'{n_masks} committed masks moved to the mask store')
+
+
+def puncta_items():
+    puncta = load_script('src/4_puncta_detection.py', 'puncta_detection')
+    images = {fn.removesuffix('.npy') for fn in os.listdir(puncta.image_folder) if fn.endswith('.npy')}
+    return sorted(fn.removesuffix('_mask.npy') for fn in os.listdir(puncta.mask_folder)
+                  if fn.endswith('_mask.npy') and fn.removesuffix('_mask.npy') in images)
+
+
+def puncta_process(items, parts_folder, unit_id):
+    puncta = load_script('src/4_puncta_detection.py', 'puncta_detection')
+    images = {name: np.load(f'{puncta.image_folder}/{name}.npy') for name in items}
+    masks = {name: np.load(f'{puncta.mask_folder}/{name}_mask.npy', allow_pickle=True) for name in items}
+    corrected = None
+    if puncta.USE_BACKGROUND_CORRECTION:
+        corrected = {name: np.load(f'{puncta.background_folder}/{name}.npy') for name in items}
+
+    qc_tables = puncta.load_qc_tables(puncta.mask_folder, items)
+
+    indexes = puncta.build_label_indexes(masks)
+    cyto_masks = puncta.generate_cytoplasm_masks(masks, indexes=indexes)
+    filtered = puncta.filter_saturated_images(images, cyto_masks, masks, corrected=corrected, qc_tables=qc_tables, indexes=indexes)
+    features = puncta.collect_features(filtered, indexes=indexes)
+    features = puncta.extra_puncta_features(features)
+    features = puncta.spatial_features(features, masks)
+
+    atomic_pickle(os.path.join(parts_folder, f'{unit_id}.pkl'), features)
+    puncta.generate_proofs(features, filtered, coi1=puncta.COI_1, coi2=puncta.COI_2)
+
+
+def puncta_merge(unit_ids, parts_folder):
+    puncta = load_script('src/4_puncta_detection.py', 'puncta_detection')
+    features = pd.concat([pd.read_pickle(os.path.join(parts_folder, f'{unit_id}.pkl')) for unit_id in unit_ids],
+                         ignore_index=True)
+
+    # outliers are defined over the whole cohort, so only remove them after merging
+    features = puncta.add_metadata(features)
+    features = puncta.remove_outliers(features, puncta.FEATURE_COLS)
+    puncta.save_feature_tables(features, puncta.FEATURE_COLS)
+    logger.info('puncta feature tables saved')
+
+
+STAGES = {
+    '1': {'items': cleanup_items, 'process': cleanup_process, 'merge': cleanup_merge},
+    '1b': {'items': background_items, 'process': background_process, 'merge': background_merge},
+    '2': {'items': cellpose_items, 'process': cellpose_process, 'merge': cellpose_merge},
+    '4': {'items': puncta_items, 'process': puncta_process, 'merge': puncta_merge},
+}
+
+
+# --- Shared filesystem helpers ---
+def atomic_write(path, text):
+    """Write text to path via a temporary file so readers never see a partial file."""
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def atomic_pickle(path, df):
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def stage_folders(stage, queue_folder=queue_folder):
+    stage_folder = os.path.join(queue_folder, f'stage_{stage}')
+    folders = {sub: os.path.join(stage_folder, sub) for sub in ['units', 'leases', 'done', 'parts']}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    return folders
+
+
+def list_units(folders):
+    return sorted(fn.removesuffix('.json') for fn in os.listdir(folders['units']) if fn.endswith('.json'))
+
+
+def is_done(folders, unit_id):
+    return os.path.exists(os.path.join(folders['done'], f'{unit_id}.done'))
+
+
+# --- Queue operations ---
+def create_work_units(stage, items, unit_size=UNIT_SIZE, queue_folder=queue_folder):
+    """Split items into work units of unit_size; unchanged units are kept so init can be rerun safely.
+
+    A unit whose item list changed, e.g. after images were added or removed, is rewritten and its
+    done marker and outputs are removed so it is processed again, and units beyond the new item
+    list are removed. Run init again only while no worker is processing the stage.
+
+    Args:
+        stage (str): stage key in STAGES.
+        items (list): image paths or names processed by the stage.
+        unit_size (int, optional): number of items per unit. Defaults to UNIT_SIZE.
+        queue_folder (str, optional): shared queue folder. Defaults to queue_folder.
+
+    Returns:
+        list: unit ids.
+    """
+    folders = stage_folders(stage, queue_folder)
+    unit_ids = []
+    for i, start in enumerate(range(0, len(items), unit_size)):
+        unit_id = f'{i:06d}'
+        unit_path = os.path.join(folders['units'], f'{unit_id}.json')
+        unit_items = list(items[start:start + unit_size])
+        if os.path.exists(unit_path):
+            with open(unit_path) as f:
+                if json.load(f) == unit_items:
+                    unit_ids.append(unit_id)
+                    continue
+            logger.info(f'stage {stage}: items of unit {unit_id} changed, it is processed again')
+            remove_unit_outputs(folders, unit_id)
+        atomic_write(unit_path, json.dumps(unit_items))
+        unit_ids.append(unit_id)
+
+    for unit_id in set(list_units(folders)) - set(unit_ids):
+        remove_unit_outputs(folders, unit_id)
+        os.remove(os.path.join(folders['units'], f'{unit_id}.json'))
+    logger.info(f'stage {stage}: {len(items)} items in {len(unit_ids)} work units')
+    return unit_ids
+
+
+def remove_unit_outputs(folders, unit_id):
+    """Remove the done marker, lease and outputs of a unit."""
+    for path in [os.path.join(folders['done'], f'{unit_id}.done'), os.path.join(folders['leases'], f'{unit_id}.lease')]:
+        if os.path.exists(path):
+            os.remove(path)
+    for fn in os.listdir(folders['parts']):
+        if fn.startswith(f'{unit_id}.'):
+            path = os.path.join(folders['parts'], fn)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def try_create_lease(lease_path, worker_id):
+    """Atomically create a lease file, return False if another worker holds it."""
+    try:
+        fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(json.dumps({'worker': worker_id, 'claimed': time.time()}))
+    return True
+
+
+def lease_owner(lease_path):
+    try:
+        with open(lease_path) as f:
+            return json.loads(f.read() or '{}').get('worker')
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def reclaim_stale_lease(lease_path, lease_seconds):
+    """Remove a lease that has not been refreshed for lease_seconds.
+
+    Several workers can see the same stale lease, and by the time a slow one renames it, another may
+    already have reclaimed it and created a fresh lease. The age is therefore checked again on the
+    renamed file, and a fresh lease is linked back in place, which fails if a third worker has
+    created one meanwhile; that worker then holds the unit and the previous owner loses its lease.
+    """
+    try:
+        age = time.time() - os.path.getmtime(lease_path)
+    except FileNotFoundError:
+        return True
+    if age < lease_seconds:
+        return False
+    tombstone = f'{lease_path}.stale-{uuid.uuid4().hex}'
+    try:
+        os.rename(lease_path, tombstone)
+    except FileNotFoundError:
+        return False
+    age = time.time() - os.path.getmtime(tombstone)  # rename keeps the mtime
+    if age < lease_seconds:
+        try:
+            os.link(tombstone, lease_path)
+        except FileExistsError:
+            pass
+        os.remove(tombstone)
+        return False
+    os.remove(tombstone)
+    logger.warning(f'reclaimed stale lease {os.path.basename(lease_path)} ({age:.0f} s old)')
+    return True
+
+
+def claim_unit(folders, worker_id, lease_seconds=LEASE_SECONDS):
+    """Claim the first unit that is neither done nor held by a live lease.
+
+    Returns:
+        str or None: claimed unit id, or None if nothing can be claimed right now.
+    """
+    for unit_id in list_units(folders):
+        if is_done(folders, unit_id):
+            continue
+        lease_path = os.path.join(folders['leases'], f'{unit_id}.lease')
+        claimed = try_create_lease(lease_path, worker_id) or (
+            reclaim_stale_lease(lease_path, lease_seconds) and try_create_lease(lease_path, worker_id))
+        if not claimed:
+            continue
+        if is_done(folders, unit_id):
+            # finished by another worker between the check and the claim
+            os.remove(lease_path)
+            continue
+        return unit_id
+    return None
+
+
+def holds_lease(lease_path, worker_id, retry_seconds=1):
+    """Whether worker_id still holds the lease, looking twice if it is briefly renamed by a reclaim check."""
+    owner = lease_owner(lease_path)
+    if owner is None:
+        time.sleep(retry_seconds)
+        owner = lease_owner(lease_path)
+    return owner == worker_id
+
+
+def commit_unit(folders, unit_id, worker_id, staging_folder):
+    """Move the outputs of a unit from the worker's staging folder into parts and mark it done.
+
+    Returns:
+        bool: False if the lease was lost meanwhile, the outputs are then discarded.
+    """
+    lease_path = os.path.join(folders['leases'], f'{unit_id}.lease')
+    if not holds_lease(lease_path, worker_id):
+        logger.warning(f'{worker_id} lost the lease of unit {unit_id}, discarding its outputs')
+        shutil.rmtree(staging_folder)
+        return False
+    for fn in os.listdir(staging_folder):
+        os.replace(os.path.join(staging_folder, fn), os.path.join(folders['parts'], fn))
+    os.rmdir(staging_folder)
+    complete_unit(folders, unit_id, worker_id)
+    return True
+
+
+def complete_unit(folders, unit_id, worker_id):
+    atomic_write(os.path.join(folders['done'], f'{unit_id}.done'), worker_id)
+    lease_path = os.path.join(folders['leases'], f'{unit_id}.lease')
+    if lease_owner(lease_path) == worker_id:
+        os.remove(lease_path)
+
+
+class Heartbeat:
+    """Refresh a lease in a background thread while its unit is processed."""
+
+    def __init__(self, lease_path, worker_id, interval=HEARTBEAT_SECONDS):
+        self.lease_path = lease_path
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            owner = lease_owner(self.lease_path)
+            if owner is None:
+                continue  # briefly renamed by another worker checking its age
+            if owner != self.worker_id:
+                logger.warning(f'lease {os.path.basename(self.lease_path)} was reclaimed by another worker')
+                return
+            try:
+                os.utime(self.lease_path)
+            except FileNotFoundError:
+                continue
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(stage, worker_id=None, queue_folder=queue_folder, lease_seconds=LEASE_SECONDS,
+               heartbeat_seconds=HEARTBEAT_SECONDS):
+    """Claim and process units of a stage until every unit is done.
+
+    Args:
+        stage (str): stage key in STAGES.
+        worker_id (str, optional): unique worker name. Defaults to hostname-pid.
+        queue_folder (str, optional): shared queue folder. Defaults to queue_folder.
+        lease_seconds (int, optional): age after which a lease is reclaimed. Defaults to LEASE_SECONDS.
+        heartbeat_seconds (int, optional): lease refresh and polling interval. Defaults to HEARTBEAT_SECONDS.
+
+    Returns:
+        int: number of units processed by this worker.
+    """
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    folders = stage_folders(stage, queue_folder)
+    process = STAGES[stage]['process']
+    n_processed = 0
+
+    while True:
+        unit_id = claim_unit(folders, worker_id, lease_seconds)
+        if unit_id is None:
+            if all(is_done(folders, unit) for unit in list_units(folders)):
+                break
+            # remaining units are held by other workers, wait for them to finish or go stale
+            time.sleep(heartbeat_seconds)
+            continue
+
+        with open(os.path.join(folders['units'], f'{unit_id}.json')) as f:
+            items = json.load(f)
+        logger.info(f'{worker_id} processing stage {stage} unit {unit_id} ({len(items)} items)')
+
+        # outputs are staged per worker and only committed while the lease is still held
+        lease_path = os.path.join(folders['leases'], f'{unit_id}.lease')
+        staging_folder = os.path.join(folders['parts'], f'{unit_id}.{worker_id}.staging')
+        os.makedirs(staging_folder, exist_ok=True)
+        with Heartbeat(lease_path, worker_id, heartbeat_seconds):
+            process(items, staging_folder, unit_id)
+        n_processed += commit_unit(folders, unit_id, worker_id, staging_folder)
+
+    logger.info(f'{worker_id} finished stage {stage}, processed {n_processed} units')
+    return n_processed
+
+
+def merge_stage(stage, queue_folder=queue_folder):
+    """Merge per-unit outputs once every unit of the stage is done."""
+    folders = stage_folders(stage, queue_folder)
+    unit_ids = list_units(folders)
+    pending = [unit_id for unit_id in unit_ids if not is_done(folders, unit_id)]
+    if pending:
+        raise RuntimeError(f'stage {stage} has {len(pending)} unfinished units, e.g. {pending[0]}')
+    STAGES[stage]['merge'](unit_ids, folders['parts'])
+
+
+def stage_status(stage, queue_folder=queue_folder):
+    folders = stage_folders(stage, queue_folder)
+    unit_ids = list_units(folders)
+    n_done = sum(is_done(folders, unit_id) for unit_id in unit_ids)
+    n_leased = sum(os.path.exists(os.path.join(folders['leases'], f'{unit_id}.lease')) for unit_id in unit_ids)
+    logger.info(f'stage {stage}: {n_done}/{len(unit_ids)} units done, {n_leased} leased')
+    return {'units': len(unit_ids), 'done': n_done, 'leased': n_leased}
+
+
+def run_local(stage, n_workers, unit_size=UNIT_SIZE, queue_folder=queue_folder):
+    """Initialise a stage, process it with n_workers local processes, and merge the outputs."""
+    create_work_units(stage, STAGES[stage]['items'](), unit_size, queue_folder)
+    workers = [multiprocessing.Process(target=run_worker, args=(stage, f'local-{i}', queue_folder))
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    merge_stage(stage, queue_folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='shared-filesystem work queue for stages 1, 1b, 2 and 4')
+    parser.add_argument('command', choices=['init', 'work', 'merge', 'status', 'local'])
+    parser.add_argument('stage', choices=sorted(STAGES))
+    parser.add_argument('--workers', type=int, default=2, help='number of local worker processes (local only)')
+    parser.add_argument('--worker-id', default=None, help='unique worker name (work only)')
+    parser.add_argument('--unit-size', type=int, default=UNIT_SIZE, help='images per work unit (init/local only)')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        create_work_units(args.stage, STAGES[args.stage]['items'](), args.unit_size)
+    elif args.command == 'work':
+        run_worker(args.stage, args.worker_id)
+    elif args.command == 'merge':
+        merge_stage(args.stage)
+    elif args.command == 'status':
+        stage_status(args.stage)
+    else:
+        run_local(args.stage, args.workers, args.unit_size)
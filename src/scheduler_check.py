@@ -0,0 +1,144 @@
+"""
+Multi-process check of the work queue in scheduler.py: several local workers process a dummy stage
+and every unit must be committed exactly once, including a unit left behind by a crashed worker
+and a unit whose worker stalls past its lease and loses it.
+
+The dummy stage records every call in a log and writes one part per unit, so the report counts
+calls and committed parts per unit. A stalled worker may repeat work, but its outputs must be
+discarded and only the worker that holds the lease commits.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import importlib.util
+import multiprocessing
+import pandas as pd
+from loguru import logger
+
+# special import, path to script
+scheduler_path = 'src/scheduler.py'
+
+# load the module dynamically to register the dummy stage with the queue
+spec = importlib.util.spec_from_file_location('scheduler', scheduler_path)
+scheduler = importlib.util.module_from_spec(spec)
+sys.modules['scheduler'] = scheduler
+spec.loader.exec_module(scheduler)
+
+logger.info('import ok')
+
+# configuration
+output_folder = 'results/scheduler_check/'
+queue_folder = f'{output_folder}queue/'
+calls_path = f'{output_folder}calls.log'
+N_WORKERS = 6
+N_ITEMS = 48
+UNIT_SIZE = 4
+LEASE_SECONDS = 2  # short leases, so the stale and stalled leases are reclaimed within the check
+HEARTBEAT_SECONDS = 0.2
+WORK_SECONDS = 0.3  # time a unit takes
+STALLED_WORKER = 'stalled'  # worker that stops refreshing its lease and works past it
+CRASHED_WORKER = 'crashed'  # worker that left a stale lease behind
+STAGE = 'check'
+
+
+def dummy_process(items, parts_folder, unit_id):
+    """Log the call and write the items of the unit as its part; the stalled worker outlives its lease."""
+    with open(calls_path, 'a') as f:
+        f.write(f'{unit_id} {os.path.basename(parts_folder)}\n')
+    stalled = f'.{STALLED_WORKER}.' in os.path.basename(parts_folder)
+    time.sleep(3 * LEASE_SECONDS if stalled else WORK_SECONDS)
+    with open(os.path.join(parts_folder, f'{unit_id}.json'), 'w') as f:
+        json.dump(items, f)
+
+
+def dummy_merge(unit_ids, parts_folder):
+    logger.info('dummy stage, nothing to merge')
+
+
+scheduler.STAGES[STAGE] = {'items': lambda: [f'item_{i:03d}' for i in range(N_ITEMS)],
+                           'process': dummy_process, 'merge': dummy_merge}
+
+
+def run_worker(worker_id, heartbeat_seconds=HEARTBEAT_SECONDS):
+    return scheduler.run_worker(STAGE, worker_id, queue_folder, LEASE_SECONDS, heartbeat_seconds)
+
+
+def plant_stale_lease(folders, unit_id):
+    """Leave the lease of a crashed worker on a unit, older than LEASE_SECONDS."""
+    lease_path = os.path.join(folders['leases'], f'{unit_id}.lease')
+    scheduler.try_create_lease(lease_path, CRASHED_WORKER)
+    stale = time.time() - 10 * LEASE_SECONDS
+    os.utime(lease_path, (stale, stale))
+
+
+def run_check():
+    """Process the dummy stage with N_WORKERS processes, a crashed and a stalled worker.
+
+    Returns:
+        pd.DataFrame: one row per check with passed.
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    items = scheduler.STAGES[STAGE]['items']()
+    unit_ids = scheduler.create_work_units(STAGE, items, UNIT_SIZE, queue_folder)
+    folders = scheduler.stage_folders(STAGE, queue_folder)
+    plant_stale_lease(folders, unit_ids[-1])
+
+    # the stalled worker claims a unit first, its heartbeat never fires before the lease runs out
+    stalled = multiprocessing.Process(target=run_worker, args=(STALLED_WORKER, 100 * LEASE_SECONDS))
+    stalled.start()
+    while not any(scheduler.lease_owner(os.path.join(folders['leases'], f'{unit_id}.lease')) == STALLED_WORKER
+                  for unit_id in unit_ids):
+        time.sleep(0.01)
+    with multiprocessing.Pool(N_WORKERS) as pool:
+        n_processed = pool.map(run_worker, [f'local-{i}' for i in range(N_WORKERS)])
+    stalled.join()
+
+    with open(calls_path) as f:
+        calls = pd.Series([line.split()[0] for line in f]).value_counts()
+    parts = sorted(fn for fn in os.listdir(folders['parts']))
+    part_items = []
+    for fn in parts:
+        with open(os.path.join(folders['parts'], fn)) as f:
+            part_items += json.load(f)
+    done_by = {}
+    for unit_id in unit_ids:
+        with open(os.path.join(folders['done'], f'{unit_id}.done')) as f:
+            done_by[unit_id] = f.read()
+
+    checks = {
+        'every unit done': all(scheduler.is_done(folders, unit_id) for unit_id in unit_ids),
+        'one part per unit': parts == [f'{unit_id}.json' for unit_id in unit_ids],
+        'every item committed once': sorted(part_items) == sorted(items),
+        'units committed by the workers = units': sum(n_processed) == len(unit_ids),
+        'no unit committed by the stalled or crashed worker': not {STALLED_WORKER, CRASHED_WORKER} & set(done_by.values()),
+        'stale lease reclaimed': calls.get(unit_ids[-1], 0) == 1,
+        'stalled unit processed again': (calls > 1).sum() == 1,
+        'no leases left': not os.listdir(folders['leases']),
+    }
+
+    # rerunning init with one more image only rebuilds the last unit
+    scheduler.create_work_units(STAGE, items + ['item_extra'], UNIT_SIZE, queue_folder)
+    checks['init rerun keeps unchanged units'] = all(scheduler.is_done(folders, unit_id) for unit_id in unit_ids)
+    new_units = scheduler.list_units(folders)
+    checks['init rerun adds the new unit'] = len(new_units) == len(unit_ids) + 1 and not scheduler.is_done(folders, new_units[-1])
+    scheduler.create_work_units(STAGE, items[UNIT_SIZE:], UNIT_SIZE, queue_folder)
+    checks['init rerun redoes changed units'] = (not any(scheduler.is_done(folders, unit_id) for unit_id in unit_ids)
+                                                 and len(scheduler.list_units(folders)) == len(unit_ids) - 1)
+    logger.info(f'calls per unit:\n{calls.sort_index().to_string()}')
+    return pd.DataFrame({'check': list(checks), 'passed': list(checks.values())})
+
+
+if __name__ == '__main__':
+    report = run_check()
+    report.to_csv(f'{output_folder}scheduler_check_report.csv', index=False)
+
+    failed = report[~report['passed']]
+    if failed.empty:
+        logger.info(f'all {len(report)} scheduler checks passed')
+    else:
+        logger.error(f'{len(failed)} scheduler checks failed:\n{failed.to_string(index=False)}')
+        sys.exit(1)
@@ -0,0 +1,165 @@
+"""
+Tiles with a halo for whole-slide images that do not fit in memory as one array.
+
+The slide is cut into core tiles that cover it exactly once, and each core is read with a halo of
+extra pixels around it (its window). A cell belongs to the tile whose core holds its bounding-box
+minimum corner (top-left), so every cell, and every puncta inside it, is measured exactly once.
+A cell fits in the window of its owner as long as it is at most TILE_HALO pixels tall and wide.
+Per-cell decisions then come out the same in every window that sees the cell, and the same as on
+the full slide.
+"""
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# defaults
+TILE_SIZE = 2048  # core tile size in pixels
+TILE_HALO = 256  # extra pixels read around each core, must exceed the largest cell
+
+
+def tile_windows(shape, tile_size=TILE_SIZE, halo=TILE_HALO):
+    """Cut a 2D shape into core tiles and their halo windows.
+
+    Args:
+        shape (tuple): (height, width) of the slide.
+        tile_size (int, optional): core tile size. Defaults to TILE_SIZE.
+        halo (int, optional): halo around each core, clipped at the slide edge. Defaults to TILE_HALO.
+
+    Returns:
+        list: (core, window) pairs of (row slice, column slice), in slide coordinates.
+    """
+    height, width = shape[-2:]
+    tiles = []
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            core = (slice(row, min(row + tile_size, height)), slice(col, min(col + tile_size, width)))
+            window = (slice(max(row - halo, 0), min(row + tile_size + halo, height)),
+                      slice(max(col - halo, 0), min(col + tile_size + halo, width)))
+            tiles.append((core, window))
+    return tiles
+
+
+def window_origin(window):
+    """Slide coordinates of the top-left pixel of a window, to offset window coordinates."""
+    return np.array([window[0].start, window[1].start])
+
+
+def local_slices(core, window):
+    """Core slices relative to the window, to cut the core out of a window array."""
+    return (slice(core[0].start - window[0].start, core[0].stop - window[0].start),
+            slice(core[1].start - window[1].start, core[1].stop - window[1].start))
+
+
+def cut_labels(cells, window, shape):
+    """Labels reaching an edge of the window that lies inside the slide, so they continue past the window."""
+    cells = np.asarray(cells)
+    edges = [cells[0, :]] if window[0].start > 0 else []
+    edges += [cells[-1, :]] if window[0].stop < shape[-2] else []
+    edges += [cells[:, 0]] if window[1].start > 0 else []
+    edges += [cells[:, -1]] if window[1].stop < shape[-1] else []
+    labels = np.unique(np.concatenate(edges)) if edges else np.empty(0, dtype=cells.dtype)
+    return labels[labels > 0]
+
+
+def truncated_labels(cells, tiles, shape):
+    """Labels of the cells that any tile sees cut by its window, read window by window.
+
+    Args:
+        cells (np.array): cell labels of the slide, e.g. memory-mapped.
+        tiles (list): (core, window) pairs from tile_windows.
+        shape (tuple): (height, width) of the slide.
+
+    Returns:
+        np.array: labels of cells with pixels in a core that continue past the window of that core.
+    """
+    truncated = [np.empty(0, dtype=cells.dtype)]
+    for core, window in tiles:
+        window_cells = np.asarray(cells[window[0], window[1]])
+        in_core = np.unique(window_cells[local_slices(core, window)])
+        truncated.append(np.intersect1d(in_core, cut_labels(window_cells, window, shape)))
+    return np.unique(np.concatenate(truncated))
+
+
+def warn_truncated(n_cells):
+    if n_cells:
+        logger.warning(f'{n_cells} cells extend past the tile halo and are skipped, increase the halo')
+
+
+def owned_labels(cells, core, window, shape):
+    """Labels of the cells a tile owns: bounding-box minimum in the core, and not cut by the window.
+
+    Args:
+        cells (np.array): cell labels of the window.
+        core (tuple): core slices of the tile.
+        window (tuple): window slices of the tile.
+        shape (tuple): (height, width) of the slide.
+
+    Returns:
+        np.array: owned labels, without those of cells larger than the halo.
+    """
+    cells = np.asarray(cells)
+    # the first pixel of a label in row-major order is on its top row, in column-major order on its left column
+    labels, first_row = np.unique(cells.ravel(), return_index=True)
+    _, first_col = np.unique(cells.T.ravel(), return_index=True)
+    min_row = first_row // cells.shape[1] + window[0].start
+    min_col = first_col // cells.shape[0] + window[1].start
+    owned = ((labels > 0) & (min_row >= core[0].start) & (min_row < core[0].stop)
+             & (min_col >= core[1].start) & (min_col < core[1].stop))
+
+    truncated = owned & np.isin(labels, cut_labels(cells, window, shape))
+    warn_truncated(truncated.sum())
+    return labels[owned & ~truncated]
+
+
+def slide_border_labels(cells, window, shape, buffer_size):
+    """Labels within buffer_size + 1 pixels of the slide edge, as clear_border clears on the whole slide.
+
+    Args:
+        cells (np.array): cell labels of the window.
+        window (tuple): window slices of the tile.
+        shape (tuple): (height, width) of the slide.
+        buffer_size (int): buffer_size of clear_border.
+
+    Returns:
+        np.array: labels touching the slide border frame, only where the window reaches the slide edge.
+    """
+    cells = np.asarray(cells)
+    frame = np.zeros(cells.shape, dtype=bool)
+    width = buffer_size + 1
+    if window[0].start == 0:
+        frame[:width, :] = True
+    if window[0].stop == shape[-2]:
+        frame[-width:, :] = True
+    if window[1].start == 0:
+        frame[:, :width] = True
+    if window[1].stop == shape[-1]:
+        frame[:, -width:] = True
+    labels = np.unique(cells[frame])
+    return labels[labels > 0]
+
+
+def compute_qc_table_tiled(image_stack, mask_stack, compute_qc_table, border_buffer,
+                           tile_size=TILE_SIZE, halo=TILE_HALO):
+    """Per-cell QC table of a whole slide, measured tile by tile.
+
+    Args:
+        image_stack (np.array): slide with shape (channels, height, width), e.g. memory-mapped.
+        mask_stack (np.array): cell and nuclei masks with shape (2, height, width), e.g. memory-mapped.
+        compute_qc_table (callable): per-image QC table function, image_stack, mask_stack -> pd.DataFrame.
+        border_buffer (int): buffer_size of the border check against the slide edge.
+        tile_size (int, optional): core tile size. Defaults to TILE_SIZE.
+        halo (int, optional): halo around each core. Defaults to TILE_HALO.
+
+    Returns:
+        pd.DataFrame: the table compute_qc_table gives for the whole slide, one row per cell.
+    """
+    shape = mask_stack.shape[-2:]
+    tables = []
+    for core, window in tile_windows(shape, tile_size, halo):
+        masks = np.asarray(mask_stack[:, window[0], window[1]])
+        table = compute_qc_table(np.asarray(image_stack[:, window[0], window[1]]), masks)
+        table = table[table['cell_number'].isin(owned_labels(masks[0], core, window, shape))].copy()
+        table['border_contact'] = table['cell_number'].isin(slide_border_labels(masks[0], window, shape, border_buffer))
+        tables.append(table)
+    return pd.concat(tables).sort_values('cell_number', ignore_index=True)